@@ -63,6 +63,8 @@ from .pointpairs import PointPairs
 
 from . import config
 from . import gm
+from . import uncertainty
+from . import inversion
 
 # If we have no GUI available, put a placeholder function to print a message about why where the GUI launcher would normally be.
 if no_gui_reason is not None:
@@ -25,15 +25,22 @@ import os
 import json
 import copy
 import warnings
+import zipfile
+import pickle
+import hashlib
+import struct
+import collections
+import multiprocessing
+import io
 
 from scipy.ndimage.measurements import center_of_mass as CoM
-from scipy.optimize import minimize
 
 from .io import ZipSaveFile
 from .coordtransformer import CoordTransformer
 from .pointpairs import PointPairs
 from . import __version__ as calcam_version
 from . import misc
+from . import config
 from .raycast import raycast_sightlines, RayData
 
 try:
@@ -230,9 +237,8 @@ class RectilinearViewModel(ViewModel):
         y = np.reshape(y,np.size(y),order='F')
 
         input_points = np.zeros([x.size,1,2])
-        for point in range(len(x)):
-            input_points[point,0,0] = x[point]
-            input_points[point,0,1] = y[point]
+        input_points[:,0,0] = x
+        input_points[:,0,1] = y
 
         undistorted = cv2.undistortPoints(input_points,self.cam_matrix,self.kc)
 
@@ -263,6 +269,24 @@ class RectilinearViewModel(ViewModel):
 
 
 
+    # Given NORMALISED un-distorted coordinates, return the normalised
+    # distorted coordinates (i.e. apply the distortion model). Works
+    # on arrays of any shape.
+    def distort_normalised(self,x,y):
+
+        kc = np.zeros(8)
+        kc[:min(8,self.kc.size)] = np.ravel(self.kc)[:8]
+        k1,k2,p1,p2,k3,k4,k5,k6 = kc
+
+        r2 = x**2 + y**2
+        radial = (1 + k1*r2 + k2*r2**2 + k3*r2**3) / (1 + k4*r2 + k5*r2**2 + k6*r2**3)
+
+        xd = x*radial + 2*p1*x*y + p2*(r2 + 2*x**2)
+        yd = y*radial + p1*(r2 + 2*y**2) + 2*p2*x*y
+
+        return xd,yd
+
+
     # Un-distort an image based on the calibration
     def undistort_image(self,image):
 
@@ -338,9 +362,8 @@ class FisheyeeViewModel(ViewModel):
         y = np.reshape(y,np.size(y),order='F')
 
         input_points = np.zeros([x.size,1,2])
-        for point in range(len(x)):
-            input_points[point,0,0] = x[point]
-            input_points[point,0,1] = y[point]
+        input_points[:,0,0] = x
+        input_points[:,0,1] = y
 
         undistorted = cv2.fisheye.undistortPoints(input_points,self.cam_matrix,self.kc)
 
@@ -372,6 +395,23 @@ class FisheyeeViewModel(ViewModel):
         return np.squeeze(points)
 
 
+    # Given NORMALISED un-distorted coordinates, return the normalised
+    # distorted coordinates (i.e. apply the distortion model). Works
+    # on arrays of any shape.
+    def distort_normalised(self,x,y):
+
+        k1,k2,k3,k4 = np.ravel(self.kc)[:4]
+
+        r = np.sqrt(x**2 + y**2)
+        theta = np.arctan(r)
+        theta_d = theta * (1 + k1*theta**2 + k2*theta**4 + k3*theta**6 + k4*theta**8)
+
+        with np.errstate(divide='ignore',invalid='ignore'):
+            scale = np.where(r > 0,theta_d / r,1.)
+
+        return x*scale,y*scale
+
+
     # Un-distort an image based on the calibration
     def undistort_image(self,image):
 
@@ -380,6 +420,186 @@ class FisheyeeViewModel(ViewModel):
 
 
 
+# Version number of the calibration cache file format, increment if the cache contents change.
+_cache_version = 1
+
+class _DeferredArray():
+    '''
+    Holds what is needed to create an array, so that the (slow) work
+    of creating it can be deferred until the array is actually needed.
+    '''
+    def __init__(self,function,*args):
+        self.function = function
+        self.args = args
+
+    def get(self):
+        return self.function(*self.args)
+
+
+# Decode an image from PNG file contents in the same way Calibration._load() reads images,
+# optionally converting it from display to original orientation.
+def _decode_png(png_data,geometry=None,interpolation='cubic'):
+
+    image = cv2.imdecode(np.frombuffer(png_data,dtype=np.uint8),cv2.IMREAD_COLOR)
+
+    if image is not None:
+        if len(image.shape) == 3:
+            if image.shape[2] == 3:
+                image[:,:,:3] = image[:,:,2::-1]
+
+        if geometry is not None:
+            image = geometry.display_to_original_image(image,interpolation=interpolation)
+
+    return image
+
+
+# Get the (width, height) of a PNG image from its header, without decoding the image.
+def _png_shape(png_data):
+
+    if png_data[:8] != b'\x89PNG\r\n\x1a\n' or png_data[12:16] != b'IHDR':
+        raise IOError('Not a valid PNG image.')
+
+    return struct.unpack('>II',png_data[16:24])
+
+
+# Run-length encoding of a sub-view mask. Since sub-view masks consist of a small number
+# of contiguous regions, this is a very compact way of storing them.
+def _rle_encode(mask):
+
+    flat = np.ravel(mask)
+    starts = np.concatenate(([0],np.flatnonzero(np.diff(flat)) + 1))
+    lengths = np.diff(np.concatenate((starts,[flat.size])))
+
+    return flat[starts].astype(np.int8),lengths.astype(np.int64)
+
+
+def _decode_subview_mask(encoded_mask,geometry):
+
+    if encoded_mask[0] == 'png':
+        mask = cv2.imdecode(np.frombuffer(encoded_mask[1],dtype=np.uint8),cv2.IMREAD_COLOR)[:,:,0].astype(np.int8)
+    else:
+        values,lengths,shape = encoded_mask[1:]
+        mask = np.repeat(values,lengths).reshape(shape)
+
+    return geometry.display_to_original_image(mask,interpolation='nearest')
+
+
+def _decode_intrinsics_constraints(encoded_constraints):
+
+    return [[_decode_png(im_data) if im_data is not None else None, PointPairs(io.StringIO(pp_data))] for im_data,pp_data in encoded_constraints]
+
+
+# Get the cache file name used for a given calibration file name.
+def _get_cache_filename(filename):
+
+    return os.path.join(config.cache_path,hashlib.sha1(os.path.abspath(filename).encode('utf-8')).hexdigest() + '.ccc_cache')
+
+
+def _read_calib_contents(filename):
+    '''
+    Read the contents of a calibration file needed to set up a Calibration object,
+    without extracting the file or decoding any images. Returns a dictionary of the file
+    contents or None if the file needs the full loading procedure.
+    '''
+    try:
+        zf = zipfile.ZipFile(filename,'r')
+    except (zipfile.BadZipFile,IOError):
+        raise IOError('"{:s}" does not appear to be a Calcam calibration file!'.format(filename))
+
+    with zf:
+
+        namelist = [name.replace('\\','/') for name in zf.namelist()]
+        def read(name):
+            return zf.read(zf.namelist()[namelist.index(name)])
+
+        if 'calibration.json' not in namelist:
+            raise IOError('"{:s}" does not appear to be a Calcam calibration file!'.format(filename))
+
+        # Calibrations created with Calcam 2.0.0-dev need the full load procedure.
+        if 'intrinsics_constraints/intrinsics_calib.ccc' in namelist:
+            return None
+
+        contents = {'meta':json.loads(read('calibration.json').decode('utf-8'))}
+
+        contents['subview_mask'] = ('png',read('subview_mask.png'))
+
+        if 'image.png' in namelist:
+            contents['image'] = read('image.png')
+        else:
+            contents['image'] = None
+
+        if 'pointpairs.csv' in namelist:
+            contents['pointpairs'] = read('pointpairs.csv').decode('utf-8')
+        else:
+            contents['pointpairs'] = None
+
+        contents['view_models'] = []
+        for nview in range(contents['meta']['n_subviews']):
+            if 'calib_params_{:d}.json'.format(nview) in namelist:
+                contents['view_models'].append(json.loads(read('calib_params_{:d}.json'.format(nview)).decode('utf-8')))
+            else:
+                contents['view_models'].append(None)
+
+        if 'cad_config.json' in namelist:
+            contents['cad_config'] = json.loads(read('cad_config.json').decode('utf-8'))
+        else:
+            contents['cad_config'] = None
+
+        contents['intrinsics_constraints'] = []
+        for i in range( len( [f for f in namelist if f.startswith('intrinsics_constraints') and 'points_' in f] ) ):
+            im_name = 'intrinsics_constraints/im_{:03d}.png'.format(i)
+            contents['intrinsics_constraints'].append( ( read(im_name) if im_name in namelist else None, read('intrinsics_constraints/points_{:03d}.csv'.format(i)).decode('utf-8') ) )
+
+    return contents
+
+
+def _read_calib_cache(filename):
+    '''
+    Read calibration file contents from the cache, if there is an up-to-date
+    cache for the given file. Otherwise returns None.
+    '''
+    file_stat = os.stat(filename)
+
+    try:
+        with open(_get_cache_filename(filename),'rb') as cache_file:
+            cached = pickle.load(cache_file)
+    except Exception:
+        return None
+
+    if cached.get('version') != _cache_version or cached.get('source') != (os.path.abspath(filename),file_stat.st_mtime_ns,file_stat.st_size):
+        return None
+
+    return cached['contents']
+
+
+def _write_calib_cache(filename,contents):
+    '''
+    Write calibration file contents to the cache. The sub-view mask is
+    stored run-length encoded so that it does not need decoding when loaded.
+    '''
+    contents = dict(contents)
+
+    if contents['subview_mask'][0] == 'png':
+        mask = cv2.imdecode(np.frombuffer(contents['subview_mask'][1],dtype=np.uint8),cv2.IMREAD_COLOR)[:,:,0].astype(np.int8)
+        contents['subview_mask'] = ('rle',) + _rle_encode(mask) + (mask.shape,)
+
+    file_stat = os.stat(filename)
+    cache_filename = _get_cache_filename(filename)
+
+    try:
+        if not os.path.isdir(config.cache_path):
+            os.makedirs(config.cache_path)
+
+        with open(cache_filename + '.tmp','wb') as cache_file:
+            pickle.dump({'version':_cache_version,'source':(os.path.abspath(filename),file_stat.st_mtime_ns,file_stat.st_size),'contents':contents},cache_file,protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(cache_filename + '.tmp',cache_filename)
+
+    except Exception as e:
+        warnings.warn('Could not write calibration cache file "{:s}": {:}'.format(cache_filename,e))
+
+
+
 class Calibration():
     '''
     Class representing a camera view calibration. 
@@ -401,8 +621,14 @@ class Calibration():
        cal_type (str)     :  Required only if load_file is not specified i.e. creating an empty \
                              calibration object. Must be one of "fit", "alignment" or "virtual".\
                              If load_file is provided, this is ignored.
+       lazy_load (bool)   :  If set to True when loading a calibration, the calibration image, sub-view mask and \
+                             intrinsics constraint images are only decoded when they are first used. This makes \
+                             loading much faster if only the calibration model and geometry are needed.
+       use_cache (bool)   :  If set to True when loading a calibration, the file contents are also stored in a \
+                             binary cache file in the user's home directory, and subsequent loads of the same \
+                             (unmodified) file are read from this cache. Implies lazy_load = True.
     '''
-    def __init__(self,load_filename = None,cal_type = None):
+    def __init__(self,load_filename = None,cal_type = None,lazy_load=False,use_cache=False):
 
       # Start off with mostly empty properties
         self.image = None
@@ -421,7 +647,7 @@ class Calibration():
 
         # Load calibration from disk if requested.
         if load_filename is not None:
-            self._load(load_filename)
+            self._load(load_filename,lazy=lazy_load,use_cache=use_cache)
 
         # Otherwise, check the specified cal_type is allowed.
         elif cal_type.lower() not in ['fit','alignment','virtual']:
@@ -446,6 +672,41 @@ class Calibration():
 
 
 
+    # The image, sub-view mask and intrinsics constraints are properties so that,
+    # when lazy loading, they can be decoded the first time they are accessed.
+    @property
+    def image(self):
+        if isinstance(self._image,_DeferredArray):
+            self._image = self._image.get()
+        return self._image
+
+    @image.setter
+    def image(self,image):
+        self._image = image
+
+
+    @property
+    def subview_mask(self):
+        if isinstance(self._subview_mask,_DeferredArray):
+            self._subview_mask = self._subview_mask.get()
+        return self._subview_mask
+
+    @subview_mask.setter
+    def subview_mask(self,subview_mask):
+        self._subview_mask = subview_mask
+
+
+    @property
+    def intrinsics_constraints(self):
+        if isinstance(self._intrinsics_constraints,_DeferredArray):
+            self._intrinsics_constraints = self._intrinsics_constraints.get()
+        return self._intrinsics_constraints
+
+    @intrinsics_constraints.setter
+    def intrinsics_constraints(self,intrinsics_constraints):
+        self._intrinsics_constraints = intrinsics_constraints
+
+
     def set_pointpairs(self,pointpairs,src=None,history=None):
         '''
         Add a set of point pairs with the calibration. This replaces
@@ -697,18 +958,37 @@ class Calibration():
         self.history['intrinsics_constraints'] = []
 
 
-    def _load(self,filename):
+    def _load(self,filename,lazy=False,use_cache=False):
         '''
         Load calibration from a file in to this object.
 
         Parameters:
 
-            filename (str) : Name of the file to load.
+            filename (str)   : Name of the file to load.
+            lazy (bool)      : Whether to defer decoding the images and sub-view mask until they are needed.
+            use_cache (bool) : Whether to load from / save to the calibration cache.
         '''
 
         self.filename = os.path.abspath(filename)
         self.name = os.path.split(filename)[-1].split('.')[0]
 
+        if lazy or use_cache:
+
+            contents = None
+            if use_cache:
+                contents = _read_calib_cache(filename)
+
+            if contents is None:
+                contents = _read_calib_contents(filename)
+                if use_cache and contents is not None:
+                    _write_calib_cache(filename,contents)
+
+            # If we can't do the fast load for this file, fall through to the normal loading.
+            if contents is not None:
+                self._load_contents(contents)
+                self.readonly = not os.access(self.filename,os.W_OK)
+                return
+
         with ZipSaveFile(filename,'r') as save_file:
 
             # Load the general information
@@ -791,38 +1071,96 @@ class Calibration():
             if os.path.join('intrinsics_constraints','intrinsics_calib.ccc') in save_file.list_contents():
                 self.add_intrinsics_constraints( calibration = Calibration(os.path.join(save_file.get_temp_path(),'intrinsics_constraints','intrinsics_calib.ccc')) )
             
-            if type(self.history) is list:
-                old_history = self.history
-                self.history = {}
-                if  self._type != 'virtual':
-                    self.history['image'] = None
-                if self._type != 'fit':
-                    self.history['extrinsics'] = None
-                    self.history['intrinsics'] = None
-                if self._type == 'fit':
-                    self.history['pointpairs'] = [None,None]
-                    self.history['intrinsics_constraints'] = []
-                    self.history['fit'] = [None] * self.n_subviews
-
-                if self._type != 'fit':
-                    self.intrisnics_type = None
-
-                for event in old_history:
-                    if 'Image' in event[3]:
-                        self.history['image'] = event[3] + ' by {:s} on {:s} at {:s}'.format(event[1],event[2],misc.get_formatted_time(event[0]))
-                    elif 'Point pairs' in event[3]:
-                        if self.history['pointpairs'][0] is None:
-                            self.history['pointpairs'][0] = event[3] + ' by {:s} on {:s} at {:s}'.format(event[1],event[2],misc.get_formatted_time(event[0]))
-                        else:
-                            self.history['pointpairs'][1] = self.history['pointpairs'][1] = 'Last modified by {:s} on {:s} at {:s}'.format(event[1],event[2],misc.get_formatted_time(event[0]))
-                    elif 'Fit' in event[3]:
-                        subview_ind = self.subview_names.index(event[3].split('for ')[1])
-                        self.history['fit'][subview_ind] = 'Modified by {:s} on {:s} at {:s}'.format(event[1],event[2],misc.get_formatted_time(event[0]))
+            self._convert_legacy_history()
 
             self.readonly = save_file.is_readonly()
 
 
 
+    def _load_contents(self,contents):
+        '''
+        Set up this object from calibration file contents read by _read_calib_contents(),
+        leaving the image, sub-view mask and intrinsics constraints to be decoded when needed.
+        '''
+        meta = contents['meta']
+
+        if 'image_offset' not in meta:
+            meta['image_offset'] = (0,0)
+
+        self.geometry = CoordTransformer(transform_actions=meta['image_transform_actions'],paspect=meta['orig_paspect'],offset=meta['image_offset'])
+        if contents['subview_mask'][0] == 'png':
+            mask_shape = _png_shape(contents['subview_mask'][1])
+        else:
+            mask_shape = contents['subview_mask'][3][::-1]
+        self.geometry.set_image_shape(mask_shape[0],mask_shape[1],coords='Display')
+
+        # Note these get a copy of the geometry because it will later be modified if the detector window is changed.
+        self.subview_mask = _DeferredArray(_decode_subview_mask,contents['subview_mask'],copy.deepcopy(self.geometry))
+
+        if contents['image'] is not None:
+            self.image = _DeferredArray(_decode_png,contents['image'],copy.deepcopy(self.geometry),'cubic')
+
+        self.n_subviews = meta['n_subviews']
+        self.history = meta['history']
+        self.subview_names = meta['subview_names']
+        self._type = meta['calib_type']
+        self.pixel_size = meta['pixel_size']
+
+        if self._type != 'fit':
+            self.intrinsics_type = meta['intrinsics_type']
+
+        if contents['pointpairs'] is not None:
+            try:
+                self.pointpairs = PointPairs(io.StringIO(contents['pointpairs']))
+            except:
+                self.pointpairs = None
+
+        self.view_models = [ViewModel.from_dict(coeffs_dict) if coeffs_dict is not None else None for coeffs_dict in contents['view_models']]
+
+        self.cad_config = contents['cad_config']
+        if self.cad_config is not None and type(self.cad_config['viewport']) is list:
+            self.cad_config['viewport'] = {'cam_x':self.cad_config['viewport'][0],'cam_y':self.cad_config['viewport'][1],'cam_z':self.cad_config['viewport'][2],'tar_x':self.cad_config['viewport'][3],'tar_y':self.cad_config['viewport'][4],'tar_z':self.cad_config['viewport'][5],'fov':self.cad_config['viewport'][6],'roll':0.}
+
+        if len(contents['intrinsics_constraints']) > 0:
+            self.intrinsics_constraints = _DeferredArray(_decode_intrinsics_constraints,contents['intrinsics_constraints'])
+
+        self._convert_legacy_history()
+
+
+    def _convert_legacy_history(self):
+        '''
+        Convert the history information from calibrations saved with Calcam 2.0.0-dev to the current format.
+        '''
+        if type(self.history) is list:
+            old_history = self.history
+            self.history = {}
+            if  self._type != 'virtual':
+                self.history['image'] = None
+            if self._type != 'fit':
+                self.history['extrinsics'] = None
+                self.history['intrinsics'] = None
+            if self._type == 'fit':
+                self.history['pointpairs'] = [None,None]
+                self.history['intrinsics_constraints'] = []
+                self.history['fit'] = [None] * self.n_subviews
+
+            if self._type != 'fit':
+                self.intrisnics_type = None
+
+            for event in old_history:
+                if 'Image' in event[3]:
+                    self.history['image'] = event[3] + ' by {:s} on {:s} at {:s}'.format(event[1],event[2],misc.get_formatted_time(event[0]))
+                elif 'Point pairs' in event[3]:
+                    if self.history['pointpairs'][0] is None:
+                        self.history['pointpairs'][0] = event[3] + ' by {:s} on {:s} at {:s}'.format(event[1],event[2],misc.get_formatted_time(event[0]))
+                    else:
+                        self.history['pointpairs'][1] = self.history['pointpairs'][1] = 'Last modified by {:s} on {:s} at {:s}'.format(event[1],event[2],misc.get_formatted_time(event[0]))
+                elif 'Fit' in event[3]:
+                    subview_ind = self.subview_names.index(event[3].split('for ')[1])
+                    self.history['fit'][subview_ind] = 'Modified by {:s} on {:s} at {:s}'.format(event[1],event[2],misc.get_formatted_time(event[0]))
+
+
+
     def set_image(self,image,src,coords='Display',transform_actions = [],subview_mask=None,pixel_aspect=1.,subview_names = None,pixel_size=None,offset=(0.,0.)):
         '''
         Set the main image associated with the calibration.
@@ -1865,32 +2203,41 @@ class Calibration():
             self.history['extrinsics'] = src
 
 
-    def get_undistort_coeffs(self,radial_terms=None,include_tangential=None,subview=None):
+    def get_undistort_coeffs(self,radial_terms=None,include_tangential=None,subview=None,n_points=32):
         '''
         Get a set of parameters which can be used to analytically calculate image coordinate un-distortion.
         This can be useful if you need to calculate point un-distortion faster than the usual numerical method.
-        This fits a model of the form of the :ref:`perspective distortion model <distortion_eqn>` but with coordinate vectors
-        :math:`(x_n, y_n)` and :math:`(x_d,y_d)` interchanged. Which coefficients are included can be set by optional input
-        arguments; by default the same terms which were enabled in the calibration fit are also included in this
-        fit. Note: this function does not work with fisheye calibrations.
+        For rectilinear calibrations, this fits a model of the form of the :ref:`perspective distortion model <distortion_eqn>`
+        but with coordinate vectors :math:`(x_n, y_n)` and :math:`(x_d,y_d)` interchanged. For fisheye calibrations, this fits
+        a polynomial of the form :math:`\\theta = \\theta_d\\left[1 + k_1\\theta_d^2 + k_2\\theta_d^4 + k_3\\theta_d^6 + k_4\\theta_d^8\\right]`,
+        where :math:`\\theta_d = \\sqrt{x_d^2 + y_d^2}` and the un-distorted normalised coordinates are then given by
+        :math:`(x_n,y_n) = \\tan(\\theta)(x_d,y_d)/\\theta_d`. Which coefficients are included can be set by optional input
+        arguments; by default the same terms which were enabled in the calibration fit are also included in this fit.
+
+        Since the un-distortion models are linear in their coefficients, the fit is done as a direct linear least-squares solve
+        and is therefore fast enough to call for many calibrations.
 
         Parameters:
 
             radial_terms (int)        : Number of terms to include in the radial distortion model, can be in \
-                                        the range 1 - 3. If < 3, higher order coefficients are set to 0. \
-                                        If not provided, uses the same number of terms as the calibration fit.
+                                        the range 1 - 3 (1 - 4 for fisheye calibrations). Higher order coefficients \
+                                        are set to 0. If not provided, uses the same number of terms as the calibration fit.
 
             include_tangential (bool) : Whether to include the tangential distortion coefficients p1 and p2. \
-                                        If not given, uses the same option as was used in the calibration.
+                                        If not given, uses the same option as was used in the calibration. \
+                                        Not applicable for fisheye calibrations.
                                         
             subview (int)             : For calibrations with multiple sub-views, what sub-view to get the parameters for.
 
+            n_points (int)            : The fit is performed using an n_points x n_points grid of points spread \
+                                        over the image. Larger values give a more accurate fit at the expense of speed.
+
         Returns:
 
             dict : A dictionary containing the fitted coeffcients. Radial distortion coefficients are in keys: \
-                   'k1', 'k2' and 'k3'; tangential coefficients are in keys 'p1' and 'p2'. An additional key 'rms_error' \
-                   gives the RMS fit error, in pixels, which indicates how well these fitted parameters reproduce \
-                   the full numerical distortion inversion.
+                   'k1', 'k2' and 'k3' (and 'k4' for fisheye calibrations); tangential coefficients are in keys 'p1' and 'p2'. \
+                   An additional key 'rms_error' gives the RMS fit error, in pixels, which indicates how well these fitted \
+                   parameters reproduce the full numerical distortion inversion.
 
         '''
 
@@ -1900,64 +2247,67 @@ class Calibration():
             else:
                 raise Exception('This calibration contains muyltiple sub-views; therefore the subview number must be specified.')
 
-        if self.view_models[subview].model == 'fisheye':
-            raise Exception('Undistortion parameter getting is not supported for fisheye lenses.')
+        view_model = self.view_models[subview]
+        fisheye = view_model.model == 'fisheye'
 
         if radial_terms is None:
-            if 'Disable k3' in self.view_models[subview].fit_options:
-                if 'Disable k2' in self.view_models[subview].fit_options:
-                    radial_terms = 1
+            radial_terms = 4 if fisheye else 3
+            for k in range(radial_terms,0,-1):
+                if 'Disable k{:d}'.format(k) in view_model.fit_options:
+                    radial_terms = k - 1
                 else:
-                    rdial_terms = 2
-            else:
-                radial_terms = 3
+                    break
+            radial_terms = max(radial_terms,1)
 
-        if include_tangential is None:
-            if 'Disable Tangential Distortion' in self.view_models[subview].fit_options:
+        if fisheye:
+            include_tangential = False
+        elif include_tangential is None:
+            if 'Disable Tangential Distortion' in view_model.fit_options:
                 include_tangential = False
             else:
                 include_tangential = True
 
 
-        # First we make a 32x32 array of points over the image (these are our distorted points)
-        px,py = np.meshgrid(np.linspace(0,self.geometry.get_display_shape()[0]-1,32),np.linspace(0,self.geometry.get_display_shape()[1]-1,32))
+        # First we make an n_points x n_points array of points over the image (these are our distorted points)
+        px,py = np.meshgrid(np.linspace(0,self.geometry.get_display_shape()[0]-1,n_points),np.linspace(0,self.geometry.get_display_shape()[1]-1,n_points))
         xd = np.hstack((px.flatten()[:,np.newaxis],py.flatten()[:,np.newaxis]))
 
         # Now run the numerical un-distoirtion on these points
-        px,py = self.view_models[subview].normalise(xd[:,0],xd[:,1])
+        px,py = view_model.normalise(xd[:,0],xd[:,1])
         xn = np.hstack((px.flatten()[:,np.newaxis],py.flatten()[:,np.newaxis]))
 
         # We actually need xd in normalised coordinates, also...
-        xd[:,0] = (xd[:,0] - self.view_models[subview].cam_matrix[0,2]) / self.view_models[subview].cam_matrix[0,0]
-        xd[:,1] = (xd[:,1] - self.view_models[subview].cam_matrix[1,2]) / self.view_models[subview].cam_matrix[1,1]
-
-        # Now fit the model!
-        x0 = [0] * radial_terms + [0,0] * include_tangential
-        opt_result = minimize(undistort_model_residual,x0,args=(xd,xn,radial_terms,include_tangential))
+        xd[:,0] = (xd[:,0] - view_model.cam_matrix[0,2]) / view_model.cam_matrix[0,0]
+        xd[:,1] = (xd[:,1] - view_model.cam_matrix[1,2]) / view_model.cam_matrix[1,1]
+
+        valid = np.all(np.isfinite(xn),axis=1)
+        xd = xd[valid,:]
+        xn = xn[valid,:]
+
+        # Now fit the model! Both models are linear in their coefficients, so we can
+        # solve for the least-squares coefficients directly.
+        if fisheye:
+            params = fisheye_undistort_model_fit(xd,xn,radial_terms)
+            rms_error = fisheye_undistort_model_residual(params,xd,xn,radial_terms)
+        else:
+            params = undistort_model_fit(xd,xn,radial_terms,include_tangential)
+            rms_error = undistort_model_residual(params,xd,xn,radial_terms,include_tangential)
 
         # Put the results in to a friendly dictionary
-        res = {'k1':opt_result.x[0]}
-        param_ind = 1
-
-        if radial_terms > 1:
-            res['k2'] = opt_result.x[param_ind]
-            param_ind += 1
-        else:
-            res['k2'] = 0.
-        if radial_terms > 2:
-            res['k3'] = opt_result.x[param_ind]
-            param_ind += 1
-        else:
-            res['k3'] = 0.
-        if include_tangential:
-            res['p1'] = opt_result.x[param_ind]
-            param_ind += 1
-            res['p2'] = opt_result.x[param_ind]
-        else:
-            res['p1'] = 0.
-            res['p2'] = 0.
+        res = {}
+        n_radial = 4 if fisheye else 3
+        for k in range(n_radial):
+            res['k{:d}'.format(k+1)] = params[k] if k < radial_terms else 0.
+
+        if not fisheye:
+            if include_tangential:
+                res['p1'] = params[radial_terms]
+                res['p2'] = params[radial_terms+1]
+            else:
+                res['p1'] = 0.
+                res['p2'] = 0.
 
-        res['rms_error'] = opt_result.fun * (self.view_models[subview].cam_matrix[0,0] + self.view_models[subview].cam_matrix[1,1])/2.
+        res['rms_error'] = rms_error * (view_model.cam_matrix[0,0] + view_model.cam_matrix[1,1])/2.
 
         return res
 
@@ -2171,6 +2521,9 @@ class Calibration():
         Parameters:
             coords (str)    : Either ``Display`` or ``Original`` specifying \
                               the orientation of the raysect camera.
+
+            binning (float) : Pixel binning, as used by :func:`fullframe_meshgrid`.
+
         Returns:
             raysect.optical.observer.imaging.VectorCamera : RaySect camera object.
         '''     
@@ -2183,17 +2536,21 @@ class Calibration():
 
         x,y = self.fullframe_meshgrid(coords,binning=binning)
 
-        origins = np.ndarray(x.shape,dtype=object)
-        vectors = np.ndarray(x.shape,dtype=object)
+        viewdirs = self.get_los_direction(x,y,coords=coords).reshape(x.shape + (3,))
 
-        ppos = self.get_pupilpos(x,y,coords=coords)
-        viewdirs = self.get_los_direction(x,y,coords=coords)
+        # Build the object arrays of RaySect points and vectors in one go rather than looping
+        # over pixels in Python. All pixels in the same sub-view share a pupil position, so
+        # only one Point3D is created per sub-view (the last one is for pixels not in any sub-view).
+        if coords.lower() == 'original':
+            x,y = self.geometry.original_to_display_coords(x,y)
+        subview_index = self.subview_lookup(x.copy(),y.copy())
+
+        pupil_points = np.empty(self.n_subviews + 1,dtype=object)
+        pupil_points[:] = [Point3D(*view_model.get_pupilpos()) if view_model is not None else Point3D(np.nan,np.nan,np.nan) for view_model in self.view_models] + [Point3D(np.nan,np.nan,np.nan)]
+        origins = pupil_points[subview_index]
+
+        vectors = np.frompyfunc(Vector3D,3,1)(viewdirs[:,:,0],viewdirs[:,:,1],viewdirs[:,:,2])
 
-        for ix in range(x.shape[1]):
-            for iy in range(x.shape[0]):
-                origins[iy,ix] = Point3D(*ppos[iy,ix,:])
-                vectors[iy,ix] = Vector3D(*viewdirs[iy,ix,:])   
-        
         return VectorCamera(origins.T,vectors.T)
 
 
@@ -2415,8 +2772,28 @@ class Fitter:
 
 
     # Do a fit, using the current input data and specified fit options.
-    # Output: CalibResults instance containing the fit results.
-    def do_fit(self):
+    # Results of previous fits are cached, so re-doing a fit with identical
+    # inputs and options returns the previous result immediately.
+    # Output: ViewModel instance containing the fit results.
+    def do_fit(self,use_cache=True):
+
+        obj_points,img_points = self._get_fit_points()
+        cache_key = self._get_cache_key(obj_points,img_points)
+
+        if use_cache and cache_key in _fit_cache:
+            fitted_model = copy.deepcopy(_fit_cache[cache_key])
+        else:
+            fitted_model = self._fit(obj_points,img_points)
+            _add_to_fit_cache(cache_key,fitted_model)
+
+        if not self.ignore_upside_down and fitted_model.get_cam_to_lab_rotation()[2,1] > 0:
+            raise ImageUpsideDown()
+
+        return fitted_model
+
+
+    # Get the object and image points to fit, as arrays in the format needed by OpenCV.
+    def _get_fit_points(self):
 
         # Gather up the image and object points for this field
         obj_points = []
@@ -2444,6 +2821,25 @@ class Fitter:
             obj_points = np.array(obj_points,dtype=object)
             img_points = np.array(img_points,dtype=object)
 
+        return obj_points,img_points
+
+
+    # Get a key uniquely identifying the inputs to a fit, for caching fit results.
+    def _get_cache_key(self,obj_points,img_points):
+
+        hasher = hashlib.sha1()
+        hasher.update(repr((self.model,tuple(self.image_display_shape),self.get_fitflags(),self.get_fitflags_strings())).encode('utf-8'))
+        hasher.update(np.ascontiguousarray(self.initial_matrix,dtype=np.float64).tobytes())
+        for points in list(obj_points) + list(img_points):
+            points = np.ascontiguousarray(points,dtype=np.float32)
+            hasher.update(repr(points.shape).encode('utf-8'))
+            hasher.update(points.tobytes())
+
+        return hasher.hexdigest()
+
+
+    # Actually do the fit with OpenCV.
+    def _fit(self,obj_points,img_points):
 
         # Do the fit!
         if self.model == 'rectilinear':
@@ -2454,10 +2850,7 @@ class Fitter:
 
             fitted_model = RectilinearViewModel(cv2_output = fit_output)
             fitted_model.fit_options = self.get_fitflags_strings()
-            
-            if not self.ignore_upside_down and fitted_model.get_cam_to_lab_rotation()[2,1] > 0:
-                    raise ImageUpsideDown()
-            
+
             return fitted_model
 
         elif self.model == 'fisheye':
@@ -2470,12 +2863,8 @@ class Fitter:
             fit_output = cv2.fisheye.calibrate(obj_points,img_points,self.image_display_shape,copy.copy(self.initial_matrix), np.zeros(4),rvecs,tvecs,flags = self.get_fitflags())
         
             fitted_model = FisheyeeViewModel(cv2_output = fit_output)
-            #raise UserWarning(fitted_model.rvec)
             fitted_model.fit_options = self.get_fitflags_strings()
-            
-            if not self.ignore_upside_down and fitted_model.get_cam_to_lab_rotation()[2,1] > 0:
-                    raise ImageUpsideDown()
-                    
+
             return fitted_model
 
 
@@ -2519,41 +2908,196 @@ class Fitter:
 
 
 
-def undistort_model_residual(params,xd,xn,radial_order=2,include_tangential=True):
+# Cache of previous fit results, used by Fitter.do_fit(). Keys are a hash of the fit inputs.
+_fit_cache = collections.OrderedDict()
+_fit_cache_size = 256
+
+def _add_to_fit_cache(cache_key,fitted_model):
+
+    _fit_cache[cache_key] = copy.deepcopy(fitted_model)
+    _fit_cache.move_to_end(cache_key)
+    while len(_fit_cache) > _fit_cache_size:
+        _fit_cache.popitem(last=False)
+
+
+# Run a fit without using the cache; used as the worker function for fit_batch().
+def _run_fit(fitter):
+
+    try:
+        obj_points,img_points = fitter._get_fit_points()
+        return fitter._fit(obj_points,img_points)
+    except Exception as e:
+        return e
+
+
+def fit_batch(fitters,fitflags_options=None,n_processes=None,use_cache=True):
+    '''
+    Perform several calibration fits at once, in parallel. This can be used to fit several
+    sub-views at once, and/or to try several different sets of fit options to see which
+    gives the best result. Results are shared with the cache used by Fitter.do_fit(),
+    so fits which have already been done are not repeated.
+
+    Parameters:
+
+        fitters (list of Fitter)        : Fitters to run, e.g. one per sub-view, each already set up \
+                                          with point pairs and image shape.
+        fitflags_options (list of list) : List of fit options to try with each fitter, where each set of \
+                                          fit options is a list of strings as returned by Fitter.get_fitflags_strings(). \
+                                          If not given, each fitter's current fit options are used.
+        n_processes (int)               : Number of processes to use. Default is calcam.config.n_cpus.
+        use_cache (bool)                : Whether to use and store results in the fit cache. Set to False \
+                                          if doing many one-off fits, to avoid filling up the cache.
+
+    Returns:
+
+        list : A list with one element per input fitter, each being a list of the fitted view \
+               models for that fitter sorted by increasing reprojection error. Each view model's \
+               fit_options attribute gives the options used for that fit. Fits which fail, or \
+               where the image appears upside down (if the fitter does not ignore that), are omitted.
+    '''
+    # Make a list of all the fits we need to do
+    jobs = []
+    for fitter_index,fitter in enumerate(fitters):
+        if fitflags_options is None:
+            jobs.append((fitter_index,fitter))
+        else:
+            for fitflags in fitflags_options:
+                job_fitter = copy.deepcopy(fitter)
+                job_fitter.set_fitflags_strings(fitflags)
+                jobs.append((fitter_index,job_fitter))
+
+    results = [None] * len(jobs)
+    cache_keys = []
+    to_fit = []
+    for job_index,(_,fitter) in enumerate(jobs):
+        cache_keys.append(fitter._get_cache_key(*fitter._get_fit_points()) if use_cache else None)
+        if use_cache and cache_keys[-1] in _fit_cache:
+            results[job_index] = copy.deepcopy(_fit_cache[cache_keys[-1]])
+        else:
+            to_fit.append(job_index)
+
+    # Do any fits which are not already cached.
+    if n_processes is None:
+        n_processes = config.n_cpus
+    n_processes = min(n_processes,len(to_fit))
+
+    if n_processes > 1:
+        with multiprocessing.Pool(n_processes) as cpupool:
+            fit_results = cpupool.map(_run_fit,[jobs[job_index][1] for job_index in to_fit])
+    else:
+        fit_results = [_run_fit(jobs[job_index][1]) for job_index in to_fit]
+
+    for job_index,fit_result in zip(to_fit,fit_results):
+        if isinstance(fit_result,Exception):
+            warnings.warn('Fit with options {:} failed: {:}'.format(jobs[job_index][1].get_fitflags_strings(),fit_result))
+        else:
+            if use_cache:
+                _add_to_fit_cache(cache_keys[job_index],fit_result)
+            results[job_index] = fit_result
+
+    # Sort out the results per fitter, ranked by reprojection error.
+    output = [[] for fitter in fitters]
+    for (fitter_index,fitter),fitted_model in zip(jobs,results):
+        if fitted_model is None:
+            continue
+        if not fitter.ignore_upside_down and fitted_model.get_cam_to_lab_rotation()[2,1] > 0:
+            continue
+        output[fitter_index].append(fitted_model)
+
+    for models in output:
+        models.sort(key=lambda model: model.reprojection_error)
+
+    return output
+
+
+
+def _undistort_model_matrix(xd,radial_order=2,include_tangential=True):
+    # Design matrix A and offset b for the (linear) rectilinear un-distortion model,
+    # such that the model un-distorted coordinates are A.dot(params) + b, with
+    # the x and y coordinates of all points concatenated. Since the model is linear,
+    # A is also the Jacobian of the model with respect to its parameters.
 
     if radial_order < 1 or radial_order > 3:
         raise ValueError('Order must be between 1 and 3!')
 
-    params_index = 1
-    k1 = params[0]
-    if radial_order > 1:
-        k2 = params[params_index]
-        params_index += 1
-    else:
-        k2 = 0.
+    xd = np.asarray(xd,dtype=float)
+    x = xd[:,0]
+    y = xd[:,1]
+    r2 = x**2 + y**2
 
-    if radial_order > 2:
-        k3 = params[params_index]
-        params_index += 1
-    else:
-        k3 = 0.
+    columns = []
+    for order in range(1,radial_order+1):
+        columns.append(np.concatenate((x*r2**order,y*r2**order)))
 
     if include_tangential:
-        p1 = params[params_index]
-        params_index += 1
-        p2 = params[params_index]
-    else:
-        p1 = 0.
-        p2 = 0.
+        columns.append(np.concatenate((2*x*y,r2 + 2*y**2)))
+        columns.append(np.concatenate((r2 + 2*x**2,2*x*y)))
+
+    return np.array(columns).T, np.concatenate((x,y))
+
+
+
+def undistort_model_fit(xd,xn,radial_order=2,include_tangential=True):
 
-    if params_index < params.size  - 1:
+    A,b = _undistort_model_matrix(xd,radial_order,include_tangential)
+    xn = np.asarray(xn,dtype=float)
+
+    return np.linalg.lstsq(A,np.concatenate((xn[:,0],xn[:,1])) - b,rcond=None)[0]
+
+
+
+def undistort_model_residual(params,xd,xn,radial_order=2,include_tangential=True):
+
+    params = np.asarray(params,dtype=float)
+
+    A,b = _undistort_model_matrix(xd,radial_order,include_tangential)
+
+    if params.size > A.shape[1]:
         raise ValueError('Too many parameters givem!')
 
-    delta = 0.
-    for i in range(xd.shape[0]):
-        r = np.sqrt(np.sum(xd[i,:]**2))
-        x_out = xd[i,0]*(1 + k1*r**2 + k2*r**4 + k3*r**6) + 2*p1*np.prod(xd[i,:]) + p2*(r**2 + 2*xd[i,0]**2)
-        y_out = xd[i,1]*(1 + k1*r**2 + k2*r**4 + k3*r**6) + p1*(r**2+2*xd[i,1]**2) + 2*p2*np.prod(xd[i,:])
-        delta = delta + ((x_out - xn[i,0])**2 + (y_out - xn[i,1])**2)/xd.shape[0]
+    xn = np.asarray(xn,dtype=float)
+    delta = A.dot(params[:A.shape[1]]) + b - np.concatenate((xn[:,0],xn[:,1]))
+
+    return np.sqrt(np.sum(delta**2)/xn.shape[0])
+
+
+
+def _fisheye_undistort_model_matrix(xd,radial_order=4):
+    # Design matrix A and offset b for the fisheye un-distortion model,
+    # such that the model undistorted angle theta = A.dot(params) + b.
+
+    if radial_order < 1 or radial_order > 4:
+        raise ValueError('Order must be between 1 and 4!')
+
+    theta_d = np.sqrt(np.sum(np.asarray(xd,dtype=float)**2,axis=1))
+
+    A = np.array([theta_d**(2*order + 1) for order in range(1,radial_order+1)]).T
+
+    return A, theta_d
+
+
+
+def fisheye_undistort_model_fit(xd,xn,radial_order=4):
+
+    A,theta_d = _fisheye_undistort_model_matrix(xd,radial_order)
+    theta = np.arctan(np.sqrt(np.sum(np.asarray(xn,dtype=float)**2,axis=1)))
+
+    return np.linalg.lstsq(A,theta - theta_d,rcond=None)[0]
+
+
+
+def fisheye_undistort_model_residual(params,xd,xn,radial_order=4):
+
+    xd = np.asarray(xd,dtype=float)
+    xn = np.asarray(xn,dtype=float)
+
+    A,theta_d = _fisheye_undistort_model_matrix(xd,radial_order)
+    theta = A.dot(np.asarray(params,dtype=float)) + theta_d
+
+    scale = np.ones(theta_d.shape)
+    nonzero = theta_d > 0
+    scale[nonzero] = np.tan(theta[nonzero]) / theta_d[nonzero]
+
+    delta = xd * scale[:,np.newaxis] - xn
 
-    return np.sqrt(delta)
\ No newline at end of file
+    return np.sqrt(np.sum(delta**2)/xn.shape[0])
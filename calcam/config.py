@@ -43,6 +43,9 @@ builtin_imsource_path = os.path.join(os.path.split(os.path.abspath(__file__))[0]
 # File where calcam stores the user's configuration
 user_cfg_path = os.path.expanduser('~/.calcam_config')
 
+# Directory where calcam stores cached copies of files for faster loading.
+cache_path = os.path.expanduser('~/.calcam_cache')
+
 # If the user doesn't have their own configuration, look for a default config file in the calcam install directory.
 # This can be used e.g. if installing calcam on a multi-user system where you want to provide a default config for all users.
 # But there is not one included by default with Calcam!
@@ -24,6 +24,39 @@ import numpy as np
 import copy
 
 
+# Matrices describing how each transform action acts on (x,y) pixel coordinates,
+# not including the offsets needed to keep the coordinates positive.
+_action_matrices = {
+                    'flip_up_down'          : np.array([[1,0],[0,-1]]),
+                    'flip_left_right'       : np.array([[-1,0],[0,1]]),
+                    'rotate_clockwise_90'   : np.array([[0,-1],[1,0]]),
+                    'rotate_clockwise_180'  : np.array([[-1,0],[0,-1]]),
+                    'rotate_clockwise_270'  : np.array([[0,1],[-1,0]])
+                    }
+
+# Maximum number of channels to pass to OpenCV for resizing at once.
+_max_resize_channels = 128
+
+
+def _resize(image,shape,interpolation):
+    """
+    Resize an image array to a given (width,height) using OpenCV. Unlike cv2.resize(),
+    this supports any number of extra array dimensions after the first two, e.g.
+    colour channels and/or a stack of frames.
+    """
+    if len(image.shape) < 3 or (len(image.shape) == 3 and image.shape[2] <= _max_resize_channels):
+        return cv2.resize(image,shape,interpolation=interpolation)
+
+    flat_image = image.reshape(image.shape[:2] + (-1,))
+    data_out = np.empty((shape[1],shape[0],flat_image.shape[2]),dtype=image.dtype)
+
+    for start in range(0,flat_image.shape[2],_max_resize_channels):
+        chunk = np.ascontiguousarray(flat_image[:,:,start:start + _max_resize_channels])
+        data_out[:,:,start:start + chunk.shape[2]] = cv2.resize(chunk,shape,interpolation=interpolation).reshape((shape[1],shape[0],chunk.shape[2]))
+
+    return data_out.reshape((shape[1],shape[0]) + image.shape[2:])
+
+
 class CoordTransformer:
     """
     Class to handle coordinate transformations between 'display' and 'original' image coordinates.
@@ -36,6 +69,7 @@ class CoordTransformer:
         self.y_pixels = orig_y
         self.offset = offset
         self.pixel_aspectratio = paspect
+        self._orientation_cache = (None,None)
 
 
 
@@ -116,12 +150,7 @@ class CoordTransformer:
         Returns true if the image is rotated by 90 or 270 degrees compared to the
         raw sensor image, otherwise returns false
         """
-        sideways = False
-        for action in self.transform_actions:
-            if action.lower() in ['rotate_clockwise_90', 'rotate_clockwise_270']:
-                sideways = not sideways
-
-        return sideways
+        return self._get_orientation_matrix()[0,0] == 0
 
 
     def set_offset(self,x_offset,y_offset):
@@ -205,6 +234,56 @@ class CoordTransformer:
 
 
 
+    def _get_orientation_matrix(self):
+        """
+        Get the 2x2 matrix which maps original to display (x,y) pixel coordinates
+        for the current transform actions, i.e. all the transform actions composed
+        in to a single flip / transpose operation. This is cached and only re-calculated
+        if the transform actions are changed.
+        """
+        actions = tuple([action.lower() for action in self.transform_actions])
+
+        if self._orientation_cache[0] != actions:
+            matrix = np.eye(2,dtype=int)
+            for action in actions:
+                matrix = np.matmul(_action_matrices[action],matrix)
+            self._orientation_cache = (actions,matrix)
+
+        return self._orientation_cache[1]
+
+
+
+    def _transform_image(self,image,matrix):
+        """
+        Re-orient an image array according to a given orientation matrix. The
+        result is a view of the input array.
+        """
+        # If the matrix swaps x and y, transpose the image.
+        if matrix[0,0] == 0:
+            image = np.swapaxes(image,0,1)
+
+        return image[::matrix[1,:].sum(),::matrix[0,:].sum(),...]
+
+
+
+    def _transform_coords(self,x,y,matrix,out_shape):
+        """
+        Transform pixel coordinates according to a given orientation matrix
+        and the (width,height) shape of the output coordinate system.
+        """
+        coords_in = (x,y)
+        coords_out = []
+        for row in range(2):
+            col = np.argmax(np.abs(matrix[row,:]))
+            if matrix[row,col] < 0:
+                coords_out.append((out_shape[row] - 1) - coords_in[col])
+            else:
+                coords_out.append(coords_in[col].copy())
+
+        return coords_out
+
+
+
     def original_to_display_shape(self,shape):
         """
         Based on the transform actions and pixel aspect ratio, get the display image shape for a
@@ -253,7 +332,7 @@ class CoordTransformer:
 
 
 
-    def original_to_display_image(self,image,interpolation='nearest'):
+    def original_to_display_image(self,image,interpolation='nearest',stack=False):
         """
         Transform an image from original to display orientation.
 
@@ -263,10 +342,15 @@ class CoordTransformer:
 
             interpolation (str) : Interpolation method, allowed strings are 'nearest' or 'cubic'.
 
+            stack (bool)        : If True, the input is treated as a stack of images where the first \
+                                  array dimension is the frame index, e.g. an (n_frames x h x w) array. \
+                                  All the frames are then transformed at once.
+
 
         Returns:
 
-            np.ndarray : Array containing the image in display orientation.
+            np.ndarray : Array containing the image in display orientation. If the image does not need \
+                         resizing, this is a view of the input array rather than a copy.
         """
         if interpolation.lower() == 'nearest':
             interp_method = cv2.INTER_NEAREST
@@ -275,6 +359,10 @@ class CoordTransformer:
         else:
             raise ValueError('Interpolation method must be "nearest" or "cubic".')
 
+        # Stacks of frames are handled by putting the frame index last, like colour channels.
+        if stack:
+            image = np.moveaxis(image,0,-1)
+
         expected_size = np.array(self.get_original_shape())
         im_size = np.array(image.shape[1::-1])
         ratio = expected_size / im_size
@@ -284,31 +372,21 @@ class CoordTransformer:
         else:
             raise Exception('Expected (multiple of) {:d}x{:d} pixel image, got {:d}x{:d}!'.format(expected_size[0],expected_size[1],image.shape[1],image.shape[0]))
 
-        data_out = image.copy()
-
-
-        for action in self.transform_actions:
-            if action.lower() == 'flip_up_down':
-                data_out = np.flipud(data_out)
-            elif action.lower() == 'flip_left_right':
-                data_out = np.fliplr(data_out)
-            elif action.lower() == 'rotate_clockwise_90':
-                data_out = np.rot90(data_out,k=3)
-            elif action.lower() == 'rotate_clockwise_180':
-                data_out = np.rot90(data_out,k=2)
-            elif action.lower() == 'rotate_clockwise_270':
-                data_out = np.rot90(data_out,k=1)
+        data_out = self._transform_image(image,self._get_orientation_matrix())
 
         out_shape = self.get_display_shape()
 
         if data_out.shape[0] != int(out_shape[1]/binning) or data_out.shape[1] != int(out_shape[0]/binning):
-            data_out = cv2.resize(data_out,(int(out_shape[0]/binning),int(out_shape[1]/binning)),interpolation=interp_method)
+            data_out = _resize(data_out,(int(out_shape[0]/binning),int(out_shape[1]/binning)),interp_method)
+
+        if stack:
+            data_out = np.moveaxis(data_out,-1,0)
 
         return data_out
 
 
 
-    def display_to_original_image(self,image,interpolation='nearest'):
+    def display_to_original_image(self,image,interpolation='nearest',stack=False):
         """
         Transform an image from display to original orientation.
 
@@ -318,10 +396,15 @@ class CoordTransformer:
 
             interpolation (str) : Interpolation method, allowed strings are 'nearest' or 'cubic'.
 
+            stack (bool)        : If True, the input is treated as a stack of images where the first \
+                                  array dimension is the frame index, e.g. an (n_frames x h x w) array. \
+                                  All the frames are then transformed at once.
+
 
         Returns:
 
-            np.ndarray : Array containing the image in original orientation.
+            np.ndarray : Array containing the image in original orientation. If the image does not need \
+                         resizing, this is a view of the input array rather than a copy.
         """
         if interpolation.lower() == 'nearest':
             interp_method = cv2.INTER_NEAREST
@@ -329,7 +412,10 @@ class CoordTransformer:
             interp_method = cv2.INTER_CUBIC
         else:
             raise ValueError('Interpolation method must be "nearest" or "cubic".')
-            
+
+        # Stacks of frames are handled by putting the frame index last, like colour channels.
+        if stack:
+            image = np.moveaxis(image,0,-1)
 
         expected_size = np.array(self.get_display_shape())
         im_size = np.array(image.shape[1::-1])
@@ -340,24 +426,15 @@ class CoordTransformer:
         else:
             raise Exception('Expected (multiple of) {:d}x{:d} pixel image, got {:d}x{:d}!'.format(expected_size[0],expected_size[1],image.shape[1],image.shape[0]))
 
-        data_out = image.copy()
-
-        for action in reversed(self.transform_actions):
-            if action.lower() == 'flip_up_down':
-                data_out = np.flipud(data_out)
-            elif action.lower() == 'flip_left_right':
-                data_out = np.fliplr(data_out)
-            elif action.lower() == 'rotate_clockwise_90':
-                data_out = np.rot90(data_out,k=1)
-            elif action.lower() == 'rotate_clockwise_180':
-                data_out = np.rot90(data_out,k=2)
-            elif action.lower() == 'rotate_clockwise_270':
-                data_out = np.rot90(data_out,k=3)
+        data_out = self._transform_image(image,self._get_orientation_matrix().T)
 
         out_shape = self.get_original_shape()
 
         if data_out.shape[0] != int(out_shape[1]/binning) or data_out.shape[1] != int(out_shape[0]/binning):
-            data_out = cv2.resize(data_out,(int(out_shape[0]/binning),int(out_shape[1]/binning)),interpolation=interp_method)
+            data_out = _resize(data_out,(int(out_shape[0]/binning),int(out_shape[1]/binning)),interp_method)
+
+        if stack:
+            data_out = np.moveaxis(data_out,-1,0)
 
         return data_out
 
@@ -389,30 +466,11 @@ class CoordTransformer:
 
         current_pixels = [self.x_pixels,int(self.y_pixels*self.pixel_aspectratio)]
 
-        for action in self.transform_actions:
-            if action.lower() == 'flip_up_down':
-                y_out = (current_pixels[1]-1) - y_out
-            elif action.lower() == 'flip_left_right':
-                x_out = (current_pixels[0]-1) - x_out
-            elif action.lower() == 'rotate_clockwise_90':
-                # Temporary values...
-                yt = y_out.copy()
-                y_out = x_out.copy()
-
-                x_out = (current_pixels[1]-1) - yt
-                current_pixels = list(reversed(current_pixels))
+        matrix = self._get_orientation_matrix()
+        if matrix[0,0] == 0:
+            current_pixels.reverse()
 
-            elif action.lower() == 'rotate_clockwise_180':
-
-                y_out = (current_pixels[1]-1) - y_out
-                x_out = (current_pixels[0]-1) - x_out
-            elif action.lower() == 'rotate_clockwise_270':
-                # Temporary values...
-                yt = y_out.copy()
-
-                y_out = (current_pixels[0]-1) - x_out
-                x_out = yt
-                current_pixels = list(reversed(current_pixels))
+        x_out,y_out = self._transform_coords(x_out,y_out,matrix,current_pixels)
 
         if len(x_out.shape) == 0:
             x_out = float(x_out)
@@ -446,31 +504,13 @@ class CoordTransformer:
         x_out = np.array(x)
         y_out = np.array(y)
 
-        current_pixels = self.get_display_shape()
-
-        for action in reversed(self.transform_actions):
-            if action.lower() == 'flip_up_down':
-                y_out = (current_pixels[1]-1) - y_out
-            elif action.lower() == 'flip_left_right':
-                x_out = (current_pixels[0]-1) - x_out
-            elif action.lower() == 'rotate_clockwise_90':
-                # Temporary values...
-                yt = y_out.copy()
-
-                y_out = (current_pixels[0]-1) - x_out
-                x_out = yt
-                current_pixels = list(reversed(current_pixels))
-            elif action.lower() == 'rotate_clockwise_180':
-                # Temporary values...
-                y_out = (current_pixels[1]-1) - y_out
-                x_out = (current_pixels[0]-1) - x_out
-            elif action.lower() == 'rotate_clockwise_270':
-                # Temporary values...
-                yt = y_out.copy()
-                y_out = x_out.copy()
-
-                x_out = (current_pixels[1]-1) - yt
-                current_pixels = list(reversed(current_pixels))
+        matrix = self._get_orientation_matrix().T
+
+        current_pixels = list(self.get_display_shape())
+        if matrix[0,0] == 0:
+            current_pixels.reverse()
+
+        x_out,y_out = self._transform_coords(x_out,y_out,matrix,current_pixels)
 
         y_out = y_out / self.pixel_aspectratio
 
@@ -494,9 +534,8 @@ class CoordTransformer:
 
         display_shape = [self.x_pixels,int(np.round(self.y_pixels*self.pixel_aspectratio))]
 
-        for action in self.transform_actions:
-            if action.lower() in ['rotate_clockwise_90','rotate_clockwise_270']:
-                display_shape.reverse()
+        if self._is_sideways():
+            display_shape.reverse()
 
         return tuple(display_shape)
 
@@ -31,6 +31,9 @@ import time
 import json
 import os
 import random
+import hashlib
+import struct
+import zipfile
 
 import numpy as np
 import scipy.sparse
@@ -62,6 +65,28 @@ from . import config
 from . import misc
 from .coordtransformer import CoordTransformer
 from .io import ZipSaveFile
+from .raycast import raycast_sightlines, RayData
+from . import __version__ as calcam_version
+
+# Number of frames to process at once when formatting stacks of images.
+_frame_block_size = 256
+
+# Maximum number of ray - grid segment pairs to consider at once
+# when calculating ray intersections with the grid for blocks of rays.
+_max_block_pairs = 500000
+
+# Number of sight-lines to process at once when calculating geometry matrices.
+_ray_block_size = 1000
+
+# Number of pixels to ray cast at once when calculating geometry matrices directly from a calibration.
+_raycast_tile_size = 10000
+
+# Target average number of grid segments per bin in the grid's spatial index.
+_segments_per_bin = 4
+
+# Used by geometry matrix calculation worker processes; see _init_gm_worker()
+_worker_matrix = None
+_worker_ray_endpoints = None
 
 
 class PoloidalVolumeGrid:
@@ -111,10 +136,55 @@ class PoloidalVolumeGrid:
         self._validate_grid()
         self._build_edge_list()
         self._cull_unused_verts()
+        self._build_segment_cells()
+
+        # Spatial index of the cells, built when first needed by _build_cell_index()
+        self._cell_bin_ptr = None
 
         self.gridtype = 'Polyogn Cell Grid'
 
 
+    @classmethod
+    def _from_saved_tables(cls,vertices,cells,wall_contour,history,tables):
+        '''
+        Create a grid from its vertices, cells and previously calculated derived tables
+        (as returned by _get_saved_tables()), without re-calculating the tables.
+        '''
+        grid = cls.__new__(cls)
+
+        grid.vertices = vertices
+        grid.cells = cells
+        grid.wall_contour = wall_contour
+        grid.history = history
+        grid.segments = tables['segments']
+        grid.cell_sides = tables['cell_sides']
+        grid.segment_cells = tables['segment_cells']
+        grid._bin_origin = tables['bin_origin']
+        grid._bin_size = tables['bin_size']
+        grid._bin_shape = tuple(int(n) for n in tables['bin_shape'])
+        grid._bin_segs = tables['bin_segs']
+        grid._bin_ptr = tables['bin_ptr']
+        grid._cell_bin_ptr = None
+        grid.gridtype = 'Polyogn Cell Grid'
+
+        return grid
+
+
+    def _get_saved_tables(self):
+        '''
+        Get the grid's derived tables (segment list and spatial index) for saving
+        alongside the grid, so they can be re-loaded with _from_saved_tables().
+        '''
+        return {'segments':self.segments,
+                'cell_sides':self.cell_sides,
+                'segment_cells':self.segment_cells,
+                'bin_origin':self._bin_origin,
+                'bin_size':self._bin_size,
+                'bin_shape':np.array(self._bin_shape),
+                'bin_segs':self._bin_segs,
+                'bin_ptr':self._bin_ptr}
+
+
     @property
     def n_cells(self):
         '''
@@ -183,116 +253,147 @@ class PoloidalVolumeGrid:
 
         '''
 
-        # Turn off some NumPy warnings because we will inevitably
-        # have some dividing by zero and such in here, but it's harmless.
+        ray_start = np.array(ray_start)
+        ray_end = np.array(ray_end)
+
+        ray_length = np.sqrt( np.sum( (ray_end - ray_start)**2 ) )
+
+        _,t_ray,seg_inds = self._get_block_intersections(ray_start[np.newaxis,:],ray_end[np.newaxis,:])
+
+        # This will be the output list of cell indices
+        cell_inds = []
+
+        # Check which cells the intersected line segments belong to.
+        for intersection_pos in np.unique( t_ray ):
+
+            cells = set(self.segment_cells[seg_inds[t_ray == intersection_pos],:].flatten())
+            cells.discard(-1)
+
+            cell_inds.append(list(cells))
+
+        # We only want to return the unique intersection lengths
+        t_ray = np.unique(t_ray)
+
+        # If we're asked to, plot the sight line and intersection points.
+        if plot:
+
+            # Plot the sight line
+            ray_dir = (ray_end - ray_start) / ray_length
+            l = np.linspace(0,ray_length,int(ray_length/1e-2))
+            R = np.sqrt( (ray_start[0] + l*ray_dir[0])**2 + (ray_start[1] + l*ray_dir[1])**2  )
+            Z = ray_start[2] + l*ray_dir[2]
+            plt.plot(R,Z)
+
+            # Plot the intersections
+            points3d = np.tile(ray_start[np.newaxis,:],(t_ray.size,1)) + np.tile(t_ray[:,np.newaxis],(1,3)) * np.tile(ray_dir[np.newaxis,:],(t_ray.size,1))
+            R = np.sqrt(np.sum(points3d[:,:2]**2,axis=1))
+            Z = points3d[:,2]
+            plt.plot(R,Z,'ro')
+
+        return t_ray,cell_inds
+
+
+
+    def _get_block_intersections(self,ray_start,ray_end):
+        '''
+        Vectorised calculation of the intersections of a block of rays
+        with the grid cell boundaries. Only the ray - segment pairs found
+        using the grid's spatial index are checked.
+
+        Parameters:
+
+            ray_start (numpy.ndarray) : N x 3 array of the X,Y,Z coordinates of the ray start positions.
+
+            ray_end (numpy.ndarray)   : N x 3 array of the X,Y,Z coordinates of the ray end positions.
+
+        Returns:
+
+            tuple : Intersection information, as 3 1D arrays with one element per intersection, \
+                    sorted by ray and then by length along the ray:
+
+                    * Index of the ray (row in the input arrays) the intersection belongs to.
+
+                    * Length along the ray of the intersection, rounded to 9 decimal places.
+
+                    * Index of the grid line segment intersected.
+        '''
+        ray_length = np.sqrt( np.sum( (ray_end - ray_start)**2 ,axis=1) )
         with np.errstate(divide='ignore',invalid='ignore'):
-            
-            ray_start = np.array(ray_start)
-            ray_end = np.array(ray_end)
-            
-            ray_length = np.sqrt( np.sum( (ray_end - ray_start)**2 ) )
-            
-            # Parametric coefficients for ray
-            pax,pay,paz = ray_start
-            dpx,dpy,dpz = (ray_end - ray_start) / ray_length
-            
-            # Parametric coefficients for grid segments
-            lar = self.vertices[self.segments[:,0],0]
-            laz = self.vertices[self.segments[:,0],1]
-            dlr = self.vertices[self.segments[:,1],0] - lar
-            dlz = self.vertices[self.segments[:,1],1] - laz
-    
-            a = -dlz**2*dpx**2 - dlz**2*dpy**2 + dlr**2*dpz**2
-            b = 2*dlr*dlz*dpz*lar - 2*dlr**2*dpz*laz - 2*dlz**2*dpx*pax - 2*dlz**2*dpy*pay + 2*dlr**2*dpz*paz
-            c = (dlz**2*lar**2 - 2*dlr*dlz*lar*laz + dlr**2*laz**2 - dlz**2*pax**2 - dlz**2*pay**2 + 2*dlr*dlz*lar*paz - 2*dlr**2*laz*paz + dlr**2*paz**2)
-            
-            # These will be the intersection positions
-            t_ray0 = np.zeros(self.n_segments) - 1.
-            t_seg0 = np.zeros(self.n_segments) - 1.
-            t_ray1 = np.zeros(self.n_segments) - 1.
-            t_seg1 = np.zeros(self.n_segments) - 1.
-    
-            # The magic number!
-            d = b**2 - 4*a*c
-    
-            # d > 0 means two real solutions and hence two intersections
-            indx = np.where(d > 0)
-            if len(indx) > 0:
-                q = -0.5 * (b[indx] + np.sign(b[indx]) * np.sqrt(d[indx]))
-                t_ray0[indx] = q/a[indx]
-                t_seg0[indx] = (-laz[indx] + paz + dpz * t_ray0[indx])/dlz[indx]
-                t_ray1[indx] = c[indx] / q
-                t_seg1[indx] = (-laz[indx] + paz + dpz * t_ray1[indx])/dlz[indx]
-    
-            # d == 0 means one real solution so one intersection
-            indx = np.where(d == 0)
-            if len(indx) > 0:
-                q = -0.5 * (b[indx] + np.sign(b[indx]) * np.sqrt(d[indx]))
-                t_ray0[indx] = q / a[indx]
-                t_seg0[indx] = (-laz[indx] + paz + dpz * t_ray0[indx])/dlz[indx]
-            
-            # Special case for exactly horizontal rays.
-            indx = np.where(np.abs(dlz) <1e-14)
-            if len(indx) > 0:
-                t_ray0[indx] = (-paz + laz[indx])/dpz
-                hitr = np.sqrt((pax+t_ray0[indx]*dpx)**2+(pay+t_ray0[indx]*dpy)**2)
+            ray_dir = (ray_end - ray_start) / ray_length[:,np.newaxis]
+
+        # Find which ray - segment pairs need checking
+        ray_inds,seg_inds = self._get_candidate_segments(ray_start,ray_end)
+
+        # Find the intersections for a limited number of ray - segment pairs at a time.
+        t_ray = []
+        valid_ray_inds = []
+        valid_seg_inds = []
+        for start in range(0,ray_inds.size,_max_block_pairs):
+
+            pair_ray_inds = ray_inds[start:start + _max_block_pairs]
+            pair_seg_inds = seg_inds[start:start + _max_block_pairs]
+
+            # Turn off some NumPy warnings because we will inevitably
+            # have some dividing by zero and such in here, but it's harmless.
+            with np.errstate(divide='ignore',invalid='ignore'):
+
+                # Parametric coefficients for rays
+                pax = ray_start[pair_ray_inds,0]
+                pay = ray_start[pair_ray_inds,1]
+                paz = ray_start[pair_ray_inds,2]
+                dpx = ray_dir[pair_ray_inds,0]
+                dpy = ray_dir[pair_ray_inds,1]
+                dpz = ray_dir[pair_ray_inds,2]
+
+                # Parametric coefficients for grid segments
+                lar = self.vertices[self.segments[pair_seg_inds,0],0]
+                laz = self.vertices[self.segments[pair_seg_inds,0],1]
+                dlr = self.vertices[self.segments[pair_seg_inds,1],0] - lar
+                dlz = self.vertices[self.segments[pair_seg_inds,1],1] - laz
+
+                a = -dlz**2*dpx**2 - dlz**2*dpy**2 + dlr**2*dpz**2
+                b = 2*dlr*dlz*dpz*lar - 2*dlr**2*dpz*laz - 2*dlz**2*dpx*pax - 2*dlz**2*dpy*pay + 2*dlr**2*dpz*paz
+                c = (dlz**2*lar**2 - 2*dlr*dlz*lar*laz + dlr**2*laz**2 - dlz**2*pax**2 - dlz**2*pay**2 + 2*dlr*dlz*lar*paz - 2*dlr**2*laz*paz + dlr**2*paz**2)
+
+                # The magic number!
+                d = b**2 - 4*a*c
+
+                # d > 0 means two real solutions and hence two intersections,
+                # d == 0 means one real solution so one intersection.
+                # Where d < 0 the intersection positions are set to -1.
+                q = -0.5 * (b + np.sign(b) * np.sqrt(d))
+                t_ray0 = np.where(d >= 0,q / a,-1.)
+                t_seg0 = np.where(d >= 0,(-laz + paz + dpz * t_ray0)/dlz,-1.)
+                t_ray1 = np.where(d > 0,c / q,-1.)
+                t_seg1 = np.where(d > 0,(-laz + paz + dpz * t_ray1)/dlz,-1.)
+
+                # Special case for exactly horizontal rays.
+                indx = np.where(np.abs(dlz) <1e-14)
+                t_ray0[indx] = (-paz[indx] + laz[indx])/dpz[indx]
+                hitr = np.sqrt((pax[indx]+t_ray0[indx]*dpx[indx])**2+(pay[indx]+t_ray0[indx]*dpy[indx])**2)
                 t_seg0[indx] = (-lar[indx] + hitr)/dlr[indx]
-                
-            
-            # Valid intersections are ones within the line segment length and 
-            # within the ray length
-            valid_inds0 = (t_seg0 >= 0.) & (t_seg0 <= 1.) & (t_ray0 >= 0.) & (t_ray0 <= ray_length)
-            valid_inds1 = (t_seg1 >= 0.) & (t_seg1 <= 1.) & (t_ray1 >= 0.) & (t_ray1 <= ray_length)
-            
 
-            # Full list of intersection distance and segment index
-            t_ray = np.concatenate( (t_ray0[valid_inds0],t_ray1[valid_inds1]) )     
-            seg_inds = np.arange(self.n_segments,dtype=np.uint32)
-            seg_inds = np.concatenate( (seg_inds[valid_inds0],seg_inds[valid_inds1]) )
-    
-            
-            # Sort the intersections by length along the sight-line.
-            # Also round t_ray to 9 figures because we'll want to find unique values
-            # of it shortly, so round to something slightly larger than the expected precision.
-            sort_order = np.argsort(t_ray)
-            t_ray = t_ray[sort_order].round(decimals=9)
-            seg_inds = seg_inds[sort_order]
-            
-            # This will be the output list of cell indices
-            cell_inds = []
-            
-            # Check which cells the intersected line segments belong to.
-            for intersection_pos in np.unique( t_ray ):
-                
-                segs = seg_inds[t_ray == intersection_pos]
-                
-                cells = set()
-                for seg in seg_inds[ t_ray == intersection_pos]:
-                    cells.update( np.where(self.cell_sides == seg)[0] )
-                
-                cell_inds.append(list(cells))
-            
-            # We only want to return the unique intersection lengths
-            t_ray = np.unique(t_ray)
+                # Valid intersections are ones within the line segment length and
+                # within the ray length
+                valid_inds0 = (t_seg0 >= 0.) & (t_seg0 <= 1.) & (t_ray0 >= 0.) & (t_ray0 <= ray_length[pair_ray_inds])
+                valid_inds1 = (t_seg1 >= 0.) & (t_seg1 <= 1.) & (t_ray1 >= 0.) & (t_ray1 <= ray_length[pair_ray_inds])
 
-            # If we're asked to, plot the sight line and intersection points.
-            if plot:
-                
-                # Plot the sight line
-                ray_dir = (ray_end - ray_start) / ray_length
-                l = np.linspace(0,ray_length,int(ray_length/1e-2))
-                R = np.sqrt( (ray_start[0] + l*ray_dir[0])**2 + (ray_start[1] + l*ray_dir[1])**2  )
-                Z = ray_start[2] + l*ray_dir[2]
-                plt.plot(R,Z)
-                
-                # Plot the intersections
-                points3d = np.tile(ray_start[np.newaxis,:],(t_ray.size,1)) + np.tile(t_ray[:,np.newaxis],(1,3)) * np.tile(ray_dir[np.newaxis,:],(t_ray.size,1))
-                R = np.sqrt(np.sum(points3d[:,:2]**2,axis=1))
-                Z = points3d[:,2]
-                plt.plot(R,Z,'ro')
+            # Full list of intersection distance, ray index and segment index
+            t_ray = t_ray + [t_ray0[valid_inds0],t_ray1[valid_inds1]]
+            valid_ray_inds = valid_ray_inds + [pair_ray_inds[valid_inds0],pair_ray_inds[valid_inds1]]
+            valid_seg_inds = valid_seg_inds + [pair_seg_inds[valid_inds0],pair_seg_inds[valid_inds1]]
 
+        t_ray = np.concatenate([np.zeros(0)] + t_ray)
+        ray_inds = np.concatenate([np.zeros(0,dtype=int)] + valid_ray_inds)
+        seg_inds = np.concatenate([np.zeros(0,dtype=int)] + valid_seg_inds)
 
-        return t_ray,cell_inds
+        # Round t_ray to 9 figures because we'll want to find unique values
+        # of it, so round to something slightly larger than the expected precision.
+        # Then sort the intersections by ray and length along the ray.
+        t_ray = t_ray.round(decimals=9)
+        sort_order = np.lexsort((t_ray,ray_inds))
+
+        return ray_inds[sort_order],t_ray[sort_order],seg_inds[sort_order]
 
 
 
@@ -436,8 +537,8 @@ class PoloidalVolumeGrid:
         interpolation where the value returned at new each point is 
         the value of the grid cell that point lies within.
 
-        Note: this is not particularly optimised for speed, but at least 
-        provides the functionality for now.
+        The cell containing each point is found using a spatial index of the
+        grid cells, which is built the first time this is called.
 
         Parameters:
 
@@ -472,36 +573,135 @@ class PoloidalVolumeGrid:
         r_new = r_new.reshape(r_new.size)
         z_new = z_new.reshape(z_new.size)
 
-        cell_inds = []
+        if getattr(self,'_cell_bin_ptr',None) is None:
+            self._build_cell_index()
 
-        data_out = []
+        data_out = np.full(r_new.size,fill_value,dtype=float)
 
-        for i in range(r_new.size):
+        # Do the points in blocks to limit the number of candidate point - cell pairs at once.
+        block_size = max(1,_max_block_pairs // max(1,np.diff(self._cell_bin_ptr).max()))
 
-            delta = self.vertices.copy()
-            delta[:,0] = delta[:,0] - r_new[i]
-            delta[:,1] = delta[:,1] - z_new[i]
-            theta = np.arctan2(delta[:,1],delta[:,0])
+        for block_start in range(0,r_new.size,block_size):
+
+            point_ind,cell_ind = self._get_candidate_cells(r_new[block_start:block_start+block_size],z_new[block_start:block_start+block_size])
+            point_ind = point_ind + block_start
+
+            # A point is inside a cell if the angles between it and the cell 
+            # vertices add up to 2*pi going round the cell.
+            delta = self.vertices[self.cells[cell_ind],:]
+            delta[:,:,0] = delta[:,:,0] - r_new[point_ind,np.newaxis]
+            delta[:,:,1] = delta[:,:,1] - z_new[point_ind,np.newaxis]
+            theta = np.arctan2(delta[:,:,1],delta[:,:,0])
             theta[theta < 0] = theta[theta < 0] + 2.*3.14159
 
-            theta_delta = np.abs( theta[self.cells] - theta[np.roll(self.cells,shift=-1,axis=1)] )
+            theta_delta = np.abs( theta - np.roll(theta,shift=-1,axis=1) )
             theta_delta[theta_delta > 3.141592] = 2*3.141592 - theta_delta[theta_delta > 3.141592]
 
             theta_tot = theta_delta.sum(axis=1)
 
-            cell_inds = np.where(theta_tot > 2*3.1415)[0]
+            inside = theta_tot > 2*3.1415
+            point_ind = point_ind[inside]
+            cell_ind = cell_ind[inside]
 
-            if cell_inds.size > 0:
-                data_out.append(data[cell_inds].mean())
-            else:
-                data_out.append(fill_value)
+            # Average the data from all cells containing each point (normally just one).
+            sort_order = np.lexsort((cell_ind,point_ind))
+            point_ind = point_ind[sort_order]
+            cell_ind = cell_ind[sort_order]
+            new_point = np.ones(point_ind.size,dtype=bool)
+            new_point[1:] = point_ind[1:] != point_ind[:-1]
+            point_start = np.flatnonzero(new_point)
+            if point_start.size > 0:
+                data_out[point_ind[point_start]] = np.add.reduceat(data[cell_ind],point_start) / np.diff(np.append(point_start,point_ind.size))
 
-        data_out = np.reshape(np.array(data_out),orig_shape)
+        data_out = np.reshape(data_out,orig_shape)
 
         return data_out
 
 
 
+    def _build_cell_index(self):
+        '''
+        Build a spatial index of the grid cells, used to quickly find which cells
+        contain given R,Z points. This works the same way as the segment index built
+        by _build_segment_index(): the cells whose bounding boxes overlap each bin
+        are stored in CSR style arrays _cell_bin_cells and _cell_bin_ptr.
+        '''
+        rmin,rmax,zmin,zmax = self.extent
+
+        cell_verts = self.vertices[self.cells,:]
+        cell_lo = cell_verts.min(axis=1)
+        cell_hi = cell_verts.max(axis=1)
+
+        # Cell bounding boxes are expanded slightly so that points on or extremely
+        # close to the cell edges are still checked against the cell.
+        pad = 1e-3 * (cell_hi - cell_lo).max(axis=1)[:,np.newaxis] + 1e-6 * max(rmax - rmin,zmax - zmin,1e-6)
+        cell_lo = cell_lo - pad
+        cell_hi = cell_hi + pad
+
+        rmin,zmin = cell_lo.min(axis=0)
+        rmax,zmax = cell_hi.max(axis=0)
+        width = rmax - rmin
+        height = zmax - zmin
+
+        n_r = max(1,int(np.round(np.sqrt(self.n_cells * width / height))))
+        n_z = max(1,int(np.round(self.n_cells / n_r)))
+
+        self._cell_bin_origin = np.array([rmin,zmin])
+        self._cell_bin_size = np.array([width / n_r,height / n_z])
+        self._cell_bin_shape = (n_r,n_z)
+
+        # Range of bins overlapped by each cell's bounding box
+        lo = np.floor((cell_lo - self._cell_bin_origin) / self._cell_bin_size).astype(int)
+        hi = np.floor((cell_hi - self._cell_bin_origin) / self._cell_bin_size).astype(int)
+        lo = np.maximum(lo,0)
+        hi = np.minimum(hi,np.array(self._cell_bin_shape) - 1)
+
+        cell_ind,r_bin = _expand_ranges(lo[:,0],hi[:,0] - lo[:,0] + 1)
+        pair_ind,z_bin = _expand_ranges(lo[cell_ind,1],hi[cell_ind,1] - lo[cell_ind,1] + 1)
+        bin_ind = z_bin * n_r + r_bin[pair_ind]
+        cell_ind = cell_ind[pair_ind]
+
+        sort_order = np.argsort(bin_ind,kind='stable')
+        self._cell_bin_cells = cell_ind[sort_order]
+        self._cell_bin_ptr = np.zeros(n_r * n_z + 1,dtype=int)
+        self._cell_bin_ptr[1:] = np.cumsum(np.bincount(bin_ind,minlength=n_r * n_z))
+
+
+
+    def _get_candidate_cells(self,r,z):
+        '''
+        Use the grid's cell index to find which grid cells could contain each of a set of R,Z points.
+
+        Parameters:
+
+            r (numpy.ndarray) : 1D array of R coordinates of the points.
+
+            z (numpy.ndarray) : 1D array of Z coordinates of the points.
+
+        Returns:
+
+            tuple : 2 1D arrays containing the point indices and grid cell indices \
+                    of each candidate point - cell pair.
+        '''
+        n_r,n_z = self._cell_bin_shape
+
+        with np.errstate(invalid='ignore'):
+            r_bin = np.floor((r - self._cell_bin_origin[0]) / self._cell_bin_size[0])
+            z_bin = np.floor((z - self._cell_bin_origin[1]) / self._cell_bin_size[1])
+
+            # Points on the upper edges of the grid extent belong in the last bins.
+            r_bin[r_bin == n_r] = n_r - 1
+            z_bin[z_bin == n_z] = n_z - 1
+
+            point_ind = np.flatnonzero((r_bin >= 0) & (r_bin < n_r) & (z_bin >= 0) & (z_bin < n_z))
+
+        bin_ind = z_bin[point_ind].astype(int) * n_r + r_bin[point_ind].astype(int)
+        pair_ind,cell_ind = _expand_ranges(self._cell_bin_ptr[bin_ind],np.diff(self._cell_bin_ptr)[bin_ind])
+
+        return point_ind[pair_ind],self._cell_bin_cells[cell_ind]
+
+
+
     def remove_cells(self,cell_inds):
         '''
         Remove grid cells with the given indices from the grid.
@@ -517,6 +717,8 @@ class PoloidalVolumeGrid:
         self.cell_sides = np.delete(self.cell_sides,cell_inds,axis=0)
 
         self._cull_unused_verts()
+        self._build_segment_cells()
+        self._cell_bin_ptr = None
 
 
     def _validate_grid(self):
@@ -529,9 +731,9 @@ class PoloidalVolumeGrid:
         '''
         Remove any un-used vertices from the mesh definition.
         '''
-        used_vert_inds = set(self.cells.flatten())
-        all_vert_inds = set(range(self.vertices.shape[0]))
-        used_verts = np.array( sorted( list(all_vert_inds & used_vert_inds) ),dtype=np.uint32)
+        vert_used = np.zeros(self.vertices.shape[0],dtype=bool)
+        vert_used[self.cells] = True
+        used_verts = np.flatnonzero(vert_used).astype(np.uint32)
 
         # Remove the unused vertices and keep track of vertex indexing
         ind_translation = np.zeros(self.vertices.shape[0],dtype=np.uint32)
@@ -547,31 +749,173 @@ class PoloidalVolumeGrid:
         Build the list of line segments in the grid
         and which line segments border which grid cells.
         '''
-        self.segments = np.zeros((np.prod(self.cells.shape),2),dtype=np.uint32)
-        self.cell_sides = np.zeros(self.cells.shape,dtype=np.uint32)
+        # Vertex indices at the ends of each side of each cell, with the lower index first.
+        seg_verts = np.stack( (self.cells, np.roll(self.cells,-1,axis=1)), axis=-1).reshape(-1,2).astype(np.int64)
+        seg_verts.sort(axis=1)
 
-        segment_index = 0
-        verts_per_cell = self.cells.shape[1]
+        # Find the unique segments. These are numbered in the order they are first 
+        # encountered when going through the cells and their sides in order.
+        seg_keys = seg_verts[:,0] * (seg_verts[:,1].max() + 1) + seg_verts[:,1]
+        _,first_inds,seg_inds = np.unique(seg_keys,return_index=True,return_inverse=True)
+
+        seg_order = np.argsort(first_inds)
+        seg_numbers = np.empty(seg_order.size,dtype=np.uint32)
+        seg_numbers[seg_order] = np.arange(seg_order.size)
+
+        self.segments = seg_verts[first_inds[seg_order],:].astype(np.uint32)
+        self.cell_sides = seg_numbers[seg_inds.reshape(-1)].reshape(self.cells.shape)
+
+
+
+    def _build_segment_cells(self):
+        '''
+        Build the look-up table of which grid cells each line segment borders.
+        The table has one row per segment; unused elements are set to -1.
+        '''
+        seg_inds = self.cell_sides.flatten()
+        cell_inds = np.repeat(np.arange(self.n_cells),self.cell_sides.shape[1])
+
+        sort_order = np.argsort(seg_inds,kind='stable')
+        seg_inds = seg_inds[sort_order]
+        cell_inds = cell_inds[sort_order]
+
+        # Position of each cell within its segment's list of cells
+        group_start = np.ones(seg_inds.size,dtype=bool)
+        group_start[1:] = seg_inds[1:] != seg_inds[:-1]
+        start_inds = np.flatnonzero(group_start)
+        rank = np.arange(seg_inds.size) - np.repeat(start_inds,np.diff(np.append(start_inds,seg_inds.size)))
+
+        self.segment_cells = np.zeros((self.n_segments,max(2,rank.max() + 1 if rank.size > 0 else 0)),dtype=np.int64) - 1
+        self.segment_cells[seg_inds,rank] = cell_inds
+
+        self._build_segment_index()
+
+
+
+    def _build_segment_index(self):
+        '''
+        Build a spatial index of the grid line segments, used to quickly find which
+        segments a ray might intersect. The R,Z extent of the grid is split in to a
+        uniform grid of bins, and the segments overlapping each bin are stored
+        in CSR style arrays: the segments in bin i are
+        _bin_segs[_bin_ptr[i]:_bin_ptr[i+1]], where bins are numbered along R first.
+        '''
+        # Only segments which belong to at least one grid cell are of interest.
+        active_segs = np.flatnonzero(self.segment_cells[:,0] >= 0)
 
-        # For each grid cell
-        for cell_index in range(self.n_cells):
+        rmin,rmax,zmin,zmax = self.extent
+        width = max(rmax - rmin,1e-6)
+        height = max(zmax - zmin,1e-6)
+
+        # Bins are expanded slightly to be sure of catching segments
+        # exactly on bin edges despite rounding errors.
+        pad = 1e-6 * max(width,height)
+
+        n_bins = max(1,active_segs.size // _segments_per_bin)
+        n_r = max(1,int(np.round(np.sqrt(n_bins * width / height))))
+        n_z = max(1,int(np.round(n_bins / n_r)))
 
-            # For each side of the cell
-            for seg_index in range(verts_per_cell):
+        self._bin_origin = np.array([rmin - pad,zmin - pad])
+        self._bin_size = np.array([(width + 2*pad) / n_r,(height + 2*pad) / n_z])
+        self._bin_shape = (n_r,n_z)
 
-                seg = sorted( [self.cells[cell_index][seg_index],self.cells[cell_index][(seg_index + 1) % verts_per_cell]] )
+        # Range of bins overlapped by each segment's bounding box
+        seg_verts = self.vertices[self.segments[active_segs,:],:]
+        lo = np.floor((seg_verts.min(axis=1) - pad - self._bin_origin) / self._bin_size).astype(int)
+        hi = np.floor((seg_verts.max(axis=1) + pad - self._bin_origin) / self._bin_size).astype(int)
+        lo = np.maximum(lo,0)
+        hi = np.minimum(hi,np.array(self._bin_shape) - 1)
 
-                # Store the index if this line segment is already in the segment list,
-                # otherwise add it to the segment list and then store its index.
-                try:
-                    self.cell_sides[cell_index][seg_index] = np.where( (self.segments[:,0] == seg[0]) & (self.segments[:,1] == seg[1]) )[0][0]
-                except IndexError:
-                    self.segments[segment_index,:] = seg
-                    self.cell_sides[cell_index][seg_index] = segment_index
-                    segment_index += 1
+        # List every bin / segment combination, first as (segment, R bin) then adding the Z bins.
+        seg_ind,r_bin = _expand_ranges(lo[:,0],hi[:,0] - lo[:,0] + 1)
+        pair_ind,z_bin = _expand_ranges(lo[seg_ind,1],hi[seg_ind,1] - lo[seg_ind,1] + 1)
+        bin_ind = z_bin * n_r + r_bin[pair_ind]
+        seg_ind = active_segs[seg_ind[pair_ind]]
 
+        sort_order = np.argsort(bin_ind,kind='stable')
+        self._bin_segs = seg_ind[sort_order]
+        self._bin_ptr = np.zeros(n_r * n_z + 1,dtype=int)
+        self._bin_ptr[1:] = np.cumsum(np.bincount(bin_ind,minlength=n_r * n_z))
 
-        self.segments = self.segments[:segment_index,:]
+
+
+    def _get_candidate_segments(self,ray_start,ray_end):
+        '''
+        Use the grid's spatial index to find which grid segments each of a block
+        of rays could intersect. For each row of bins (in Z), the part of the ray
+        within that row is found from the ray's Z range, and the range of R covered
+        by that part of the ray is found, including the minimum R at the point of
+        closest approach to the Z axis. The segments in all the bins within these R
+        ranges are the candidates for intersection.
+
+        Parameters:
+
+            ray_start (numpy.ndarray) : N x 3 array of the X,Y,Z coordinates of the ray start positions.
+
+            ray_end (numpy.ndarray)   : N x 3 array of the X,Y,Z coordinates of the ray end positions.
+
+        Returns:
+
+            tuple : 2 1D arrays containing the ray indices and grid segment indices \
+                    of each candidate ray - segment pair.
+        '''
+        n_r,n_z = self._bin_shape
+        ray_dir = ray_end - ray_start
+        z_edges = self._bin_origin[1] + self._bin_size[1] * np.arange(n_z + 1)
+
+        with np.errstate(divide='ignore',invalid='ignore'):
+
+            # Range of position along each ray, as a fraction of the ray length,
+            # within each row of bins.
+            t_edges = (z_edges[np.newaxis,:] - ray_start[:,2:3]) / ray_dir[:,2:3]
+            t_lo = np.minimum(t_edges[:,:-1],t_edges[:,1:])
+            t_hi = np.maximum(t_edges[:,:-1],t_edges[:,1:])
+
+            # Horizontal rays are in a single row for their whole length
+            horizontal = ray_dir[:,2] == 0
+            in_row = (ray_start[horizontal,2:3] >= z_edges[np.newaxis,:-1]) & (ray_start[horizontal,2:3] <= z_edges[np.newaxis,1:])
+            t_lo[horizontal,:] = np.where(in_row,0.,np.inf)
+            t_hi[horizontal,:] = np.where(in_row,1.,-np.inf)
+
+            t_lo = np.maximum(t_lo,0.)
+            t_hi = np.minimum(t_hi,1.)
+            ray_ind,z_bin = np.nonzero(t_lo <= t_hi)
+            t_lo = t_lo[ray_ind,z_bin]
+            t_hi = t_hi[ray_ind,z_bin]
+
+            # R range of the ray within each row. R is largest at one end of the range and smallest
+            # either at one end or at the point of closest approach to the Z axis.
+            x0 = ray_start[ray_ind,0]
+            y0 = ray_start[ray_ind,1]
+            dx = ray_dir[ray_ind,0]
+            dy = ray_dir[ray_ind,1]
+            r_lo = np.sqrt((x0 + t_lo*dx)**2 + (y0 + t_lo*dy)**2)
+            r_hi = np.sqrt((x0 + t_hi*dx)**2 + (y0 + t_hi*dy)**2)
+            t_tangent = -(x0*dx + y0*dy) / (dx**2 + dy**2)
+            r_tangent = np.sqrt((x0 + t_tangent*dx)**2 + (y0 + t_tangent*dy)**2)
+            r_max = np.maximum(r_lo,r_hi)
+            r_min = np.where((t_tangent > t_lo) & (t_tangent < t_hi),r_tangent,np.minimum(r_lo,r_hi))
+
+        # Range of bins in R covered by the ray in each row.
+        r_bin_lo = np.floor((r_min - self._bin_origin[0]) / self._bin_size[0])
+        r_bin_hi = np.floor((r_max - self._bin_origin[0]) / self._bin_size[0])
+        in_grid = (r_bin_hi >= 0) & (r_bin_lo < n_r)
+        r_bin_lo = np.maximum(r_bin_lo[in_grid],0).astype(int)
+        r_bin_hi = np.minimum(r_bin_hi[in_grid],n_r - 1).astype(int)
+        ray_ind = ray_ind[in_grid]
+        z_bin = z_bin[in_grid]
+
+        # Expand to the list of segments in every bin for every ray.
+        row_ind,r_bin = _expand_ranges(r_bin_lo,r_bin_hi - r_bin_lo + 1)
+        bin_ind = z_bin[row_ind] * n_r + r_bin
+        pair_ind,seg_ind = _expand_ranges(self._bin_ptr[bin_ind],np.diff(self._bin_ptr)[bin_ind])
+        ray_ind = ray_ind[row_ind[pair_ind]]
+        seg_ind = self._bin_segs[seg_ind]
+
+        # Each segment only needs to be checked once per ray.
+        pair_key = np.unique(ray_ind.astype(np.int64) * self.n_segments + seg_ind)
+
+        return pair_key // self.n_segments,pair_key % self.n_segments
 
 
 
@@ -610,8 +954,36 @@ class GeometryMatrix:
                                                the progress of the calculation. By default, status updates are printed \
                                                to stdout.  If set to None, no status updates are issued.
 
+        pixel_range (tuple)                  : If given, only calculate the matrix rows for a range of pixels, specified as \
+                                               (start, stop) indices in to the flattened image (using the given pixel order). \
+                                               This can be used to split the calculation in to several separate jobs, \
+                                               whose results can then be combined with :func:`merge()`. Rows outside the range \
+                                               are left empty and trim_rows and trim_columns are ignored, since trimming is done \
+                                               when merging. Ranges extending past the last pixel are clipped to the image, \
+                                               so a range entirely past the last pixel gives an empty partial matrix.
+
+        checkpoint_file (str)                : If given, completed parts of the calculation are periodically saved to this file. \
+                                               If the file already exists when starting the calculation, e.g. after a crash, \
+                                               the calculation is resumed from where it left off. The file is deleted when \
+                                               the calculation is complete.
+
+        checkpoint_interval (float)          : Minimum time, in seconds, between saves of the checkpoint file.
+
+        data_dtype (str or numpy.dtype)      : Data type to use for the matrix values. The default 'float64' \
+                                               stores them in double precision; 'float32' halves the memory needed \
+                                               for the matrix values, both during the calculation and for the \
+                                               finished matrix. In single precision, matrix elements have a relative \
+                                               rounding error of up to 6e-8, i.e. well under a micron for sight-line \
+                                               lengths of several metres, which is negligible compared to the \
+                                               uncertainties in the calibration and grid geometry. Row and column \
+                                               indices are stored as 32-bit integers whenever the matrix size allows.
+
     '''
-    def __init__(self,grid,raydata,pixel_order='C',trim_rows=True,trim_columns=True,calc_status_callback = misc.LoopProgPrinter().update):
+    def __init__(self,grid,raydata,pixel_order='C',trim_rows=True,trim_columns=True,calc_status_callback = misc.LoopProgPrinter().update,pixel_range=None,checkpoint_file=None,checkpoint_interval=300.,data_dtype='float64'):
+
+        # Mask of pixels excluded using set_included_pixels(), as opposed to
+        # pixels removed because they do not see any grid cells.
+        self._excluded_pixels = None
 
         if grid is not None and raydata is not None:
 
@@ -642,65 +1014,556 @@ class GeometryMatrix:
             self.image_geometry = raydata.transform
 
             self.history = {'los':raydata.history,'grid':grid.history,'matrix':'Created by {:s} on {:s} at {:s}'.format(misc.username,misc.hostname,misc.get_formatted_time())}
-            
-            # Number of grid cells and sight lines
-            n_cells = grid.n_cells
-            n_los = raydata.transform.x_pixels * raydata.transform.y_pixels
-    
+
             # Flatten out the ray start and end coords
             ray_start_coords = raydata.get_ray_start().reshape(-1,3,order=self.pixel_order)
             ray_end_coords = raydata.get_ray_end().reshape(-1,3,order=self.pixel_order)
 
+            # Number of grid cells and sight lines
+            n_cells = grid.n_cells
+            n_los = ray_start_coords.shape[0]
+
+            if pixel_range is None:
+                los_inds = np.arange(n_los,dtype=np.uint32)
+            else:
+                if pixel_range[1] <= pixel_range[0]:
+                    raise ValueError('Invalid pixel range ({:d}, {:d}): the end of the range must be after the start.'.format(int(pixel_range[0]),int(pixel_range[1])))
+                # A range beyond the end of the image, e.g. when splitting the calculation in to fixed size
+                # jobs, gives an empty partial matrix which can still be merged with the others.
+                first_pixel = min(n_los,max(0,int(pixel_range[0])))
+                last_pixel = max(first_pixel,min(n_los,int(pixel_range[1])))
+                los_inds = np.arange(first_pixel,last_pixel,dtype=np.uint32)
+                if los_inds.size > 0:
+                    self.history['matrix'] = self.history['matrix'] + ' (pixels {:d} to {:d} of {:d})'.format(first_pixel,last_pixel - 1,n_los)
+                else:
+                    self.history['matrix'] = self.history['matrix'] + ' (no pixels: range {:d} to {:d} is outside the {:d} pixels)'.format(int(pixel_range[0]),int(pixel_range[1]) - 1,n_los)
+
+            # The matrix elements are converted to the output data type and index type as they arrive,
+            # so the whole matrix is never stored at higher precision than needed.
+            index_dtype = _get_index_dtype(n_los,n_cells)
+
             # Multi-threadedly loop over each sight-line in raydata and calculate its matrix row.
             # Store the results as coords + data then build the matrix after, because that is much faster.
             if calc_status_callback is not None:
                 calc_status_callback('Calculating geometry matrix elements using {:d} CPUs...'.format(config.n_cpus))
             
             last_status_update = 0.
-            
-            # We will do the calculation in a random order,
-            # purely to get better time remaining estimation.
-            inds = list(range(n_los))
-            random.shuffle(inds)
-
-            colinds = []
-            rowinds = []
-            data = []
-
-            with multiprocessing.Pool( config.n_cpus ) as cpupool:
-                calc_status_callback(0.)
-                for i , row_data in enumerate( cpupool.imap( self._calc_row_volume, np.hstack((ray_start_coords[inds,:],ray_end_coords[inds,:])) , 10 ) ):          
-                    rowinds.append(np.zeros(row_data[0].shape,dtype=np.uint32) + inds[i])                    
-                    colinds.append(row_data[0])
-                    data.append(row_data[1])
-                    
+
+            colinds = [np.zeros(0,dtype=index_dtype)]
+            rowinds = [np.zeros(0,dtype=index_dtype)]
+            data = [np.zeros(0,dtype=data_dtype)]
+            done_blocks = []
+
+            if checkpoint_file is not None:
+                fingerprint = _get_gm_fingerprint(grid,ray_start_coords,ray_end_coords,los_inds)
+
+            if checkpoint_file is not None and os.path.isfile(checkpoint_file):
+
+                # Resume from where we left off
+                inds,block_size,done_blocks,rowinds,colinds,data = self._load_checkpoint(checkpoint_file,fingerprint)
+                if calc_status_callback is not None:
+                    calc_status_callback('Resuming from checkpoint file {:s}'.format(checkpoint_file))
+
+            else:
+
+                # We will do the calculation in a random order,
+                # purely to get better time remaining estimation.
+                inds = list(los_inds)
+                random.shuffle(inds)
+                inds = np.array(inds,dtype=np.uint32)
+
+                # The sight-lines are processed in contiguous blocks of the shuffled sight-line list.
+                # Blocks are small enough to give each CPU several blocks, for good load balancing
+                # and status updates, but no bigger than needed to keep the overhead per block small.
+                block_size = int(min(_ray_block_size,max(1,np.ceil(inds.size / (4 * config.n_cpus)))))
+
+            blocks = [(start,min(start + block_size,inds.size)) for start in range(0,inds.size,block_size) if start not in done_blocks]
+            last_checkpoint = time.time()
+
+            # The grid and sight-line coordinates are sent to each worker process once
+            # when it starts; the workers return the matrix elements for each block in COO format.
+            with multiprocessing.Pool( config.n_cpus, initializer=_init_gm_worker, initargs=(grid,np.hstack((ray_start_coords[inds,:],ray_end_coords[inds,:]))) ) as cpupool:
+                if calc_status_callback is not None:
+                    calc_status_callback(0.)
+                n_done = len(done_blocks) * block_size
+                for block, (block_rows, block_cols, block_data) in cpupool.imap_unordered( _calc_rows_worker, blocks ):
+                    rowinds.append(inds[block_rows].astype(index_dtype))
+                    colinds.append(block_cols.astype(index_dtype,copy=False))
+                    data.append(block_data.astype(data_dtype,copy=False))
+                    done_blocks.append(block[0])
+
+                    n_done = n_done + block_size
                     if time.time() - last_status_update > 1. and calc_status_callback is not None:
-                        calc_status_callback(float(i) / n_los)
+                        calc_status_callback(min(1.,float(n_done) / inds.size))
                         last_status_update = time.time()
 
+                    if checkpoint_file is not None and time.time() - last_checkpoint > checkpoint_interval:
+                        rowinds,colinds,data = [ [np.concatenate(arrs)] for arrs in (rowinds,colinds,data)]
+                        self._save_checkpoint(checkpoint_file,fingerprint,inds,block_size,done_blocks,rowinds[0],colinds[0],data[0])
+                        last_checkpoint = time.time()
+
             # Build the matrix!
-            self.data = scipy.sparse.csr_matrix((np.concatenate(data),(np.concatenate(rowinds),np.concatenate(colinds))),shape=(n_los,n_cells))            
+            self.data = scipy.sparse.csr_matrix((np.concatenate(data),(np.concatenate(rowinds),np.concatenate(colinds))),shape=(n_los,n_cells),dtype=data_dtype)
             '''
             scipy.sparse.csr_matrix : The geometry matrix data itself.
             '''
 
             if calc_status_callback is not None:
                 calc_status_callback(1.)
-            
-            if trim_columns:
-                # Remove any grid cells + matrix columns which have no sight-line coverage.
-                unused_cells = np.where(np.abs(self.data.sum(axis=0)) == 0)[1]
-                self.grid.remove_cells(unused_cells)
 
-                used_cols = np.where(self.data.sum(axis=0) > 0)[1]
-                self.data = self.data[:,used_cols]
+            if checkpoint_file is not None and os.path.isfile(checkpoint_file):
+                os.remove(checkpoint_file)
+
+            if pixel_range is None:
+                self._trim(trim_rows,trim_columns)
+
+
+
+    def _trim(self,trim_rows,trim_columns):
+        '''
+        Remove all-zero rows and / or columns from the matrix, updating the
+        pixel mask and grid accordingly.
+
+        Parameters:
+
+            trim_rows (bool)    : Whether to remove all-zero rows.
+
+            trim_columns (bool) : Whether to remove all-zero columns.
+        '''
+        if trim_columns:
+            # Remove any grid cells + matrix columns which have no sight-line coverage.
+            unused_cells = np.where(np.abs(self.data.sum(axis=0)) == 0)[1]
+            self.grid.remove_cells(unused_cells)
+
+            used_cols = np.where(self.data.sum(axis=0) > 0)[1]
+            self.data = self.data[:,used_cols]
+
+        if trim_rows:
+            # Set the pixel mask to exclude pixels which do not contribute to any grid cells and remove corresponding rows.
+            if self.pixel_mask is not None:
+                used_pixels = np.squeeze(np.array(np.abs(self.data.sum(axis=1))) > 1e-14,axis=1)
+                pixel_mask = self.pixel_mask.flatten(order=self.pixel_order)
+                pixel_mask[pixel_mask] = used_pixels
+                self.pixel_mask = pixel_mask.reshape(self.pixel_mask.shape,order=self.pixel_order)
+                self.data = self.data[used_pixels,:]
+
+
+
+    def _save_checkpoint(self,filename,fingerprint,inds,block_size,done_blocks,rowinds,colinds,data):
+        '''
+        Save the state of a geometry matrix calculation to a checkpoint file.
+        The file is written to a temporary file first and then moved in to place,
+        so an interruption while saving does not lose the previous checkpoint.
+        '''
+        with open(filename + '.tmp','wb') as tmp_file:
+            np.savez(tmp_file,fingerprint=fingerprint,inds=inds,block_size=block_size,done_blocks=np.array(done_blocks,dtype=int),rowinds=rowinds,colinds=colinds,data=data)
+
+        os.replace(filename + '.tmp',filename)
+
+
+
+    def _load_checkpoint(self,filename,fingerprint):
+        '''
+        Load the state of a geometry matrix calculation from a checkpoint file.
+        '''
+        with np.load(filename) as f:
+
+            if str(f['fingerprint']) != fingerprint:
+                raise ValueError('Checkpoint file {:s} is from a different geometry matrix calculation (different grid, sight-lines or pixel range). Delete it or use a different checkpoint file name.'.format(filename))
+
+            return f['inds'],int(f['block_size']),list(f['done_blocks']),[f['rowinds']],[f['colinds']],[f['data']]
+
+
+
+    @classmethod
+    def merge(cls,matrices,trim_rows=True,trim_columns=True):
+        '''
+        Merge geometry matrices which were calculated for different ranges of
+        pixels using the pixel_range argument, in to a single geometry matrix.
+
+        Parameters:
+
+            matrices (list of calcam.gm.GeometryMatrix) : Matrices to merge. These must have been calculated \
+                                                          with the same grid, sight-line data and settings.
+
+            trim_rows (bool)                            : Whether to remove all-zero matrix rows from the merged matrix, \
+                                                          as for creating a new GeometryMatrix.
+
+            trim_columns (bool)                         : Whether to remove all-zero matrix columns from the merged matrix, \
+                                                          as for creating a new GeometryMatrix.
+
+        Returns:
+
+            calcam.gm.GeometryMatrix : Merged matrix.
+        '''
+        for matrix in matrices[1:]:
+            if matrix.data.shape != matrices[0].data.shape or matrix.pixel_order != matrices[0].pixel_order or matrix.history['los'] != matrices[0].history['los'] \
+                    or matrix.grid.cells.shape != matrices[0].grid.cells.shape or np.any(matrix.grid.cells != matrices[0].grid.cells) or np.any(matrix.grid.vertices != matrices[0].grid.vertices):
+                raise ValueError('Cannot merge geometry matrices with different grids, sight-line data or shapes!')
+
+        merged = cls(None,None)
+        merged.grid = copy.copy(matrices[0].grid)
+        merged.image_geometry = matrices[0].image_geometry
+        merged.image_coords = matrices[0].image_coords
+        merged.binning = matrices[0].binning
+        merged.pixel_order = matrices[0].pixel_order
+        if matrices[0].pixel_mask is not None:
+            merged.pixel_mask = np.ones(matrices[0].pixel_mask.shape,dtype=bool)
+        else:
+            merged.pixel_mask = None
+
+        merged.history = copy.copy(matrices[0].history)
+        merged.history['matrix'] = 'Merged from {:d} partial matrices by {:s} on {:s} at {:s}'.format(len(matrices),misc.username,misc.hostname,misc.get_formatted_time())
+
+        merged.data = matrices[0].data.copy()
+        for matrix in matrices[1:]:
+            merged.data = merged.data + matrix.data
+
+        merged._trim(trim_rows,trim_columns)
+
+        return merged
+
+
+
+    @classmethod
+    def from_raycast(cls,grid,calibration,cadmodel,binning=1,coords='Display',pixel_order='C',trim_rows=True,trim_columns=True,exclusion_radius=0.,supersampling=1,stratified=False,raydata_file=None,calc_status_callback=misc.LoopProgPrinter().update,data_dtype='float64'):
+        '''
+        Calculate a geometry matrix directly from a camera calibration and CAD model, without first
+        creating a full RayData object. The camera sight-lines are ray cast in tiles of pixels, and each 
+        tile is converted to geometry matrix rows (in separate processes) while the next tile is being
+        ray cast, so the memory needed for the sight-line data is set by the tile size rather than the
+        image size. This gives the same result as creating a GeometryMatrix from the output of 
+        :func:`calcam.raycast_sightlines` for the whole image.
+
+        Parameters:
+
+            grid (calcam.gm.PoloidalVolumeGrid)  : Reconstruction grid to use
+
+            calibration (calcam.Calibration)     : Calibration for the camera
+
+            cadmodel (calcam.CADModel)           : CAD model to ray cast the sight-lines against
+
+            binning (int)                        : Pixel binning for the ray casting, as for :func:`calcam.raycast_sightlines`.
+
+            coords (str)                         : Either ``Display`` or ``Original``, the image orientation to use \
+                                                   for the geometry matrix.
+
+            pixel_order (str)                    : What pixel order to use when flattening the 2D image array in to the 1D data vector, \
+                                                   as for creating a new GeometryMatrix.
+
+            trim_rows (bool)                     : Whether to automatically remove all-zero matrix rows.
+
+            trim_columns (bool)                  : Whether to automatically remove all-zero matrix columns.
+
+            exclusion_radius (float)             : Distance from camera pupil (in meters) over which to ignore ray \
+                                                   intersections with CAD surfaces, as for :func:`calcam.raycast_sightlines`.
+
+            supersampling (int)                  : If greater than 1, each (binned) pixel is represented by an \
+                                                   N x N pattern of sub-pixel sight-lines rather than a single sight-line \
+                                                   through the pixel centre, and the matrix row for the pixel is the \
+                                                   average of the rows for these sight-lines. This accounts for the finite \
+                                                   pixel size, which is important when grid cells are smaller than the \
+                                                   pixel footprint. Note the calculation time increases with N^2.
+
+            stratified (bool)                    : If supersampling, whether to place each sub-pixel sight-line at a \
+                                                   random position within its part of the pixel (stratified sampling) \
+                                                   instead of at the centre of that part of the pixel. This avoids \
+                                                   aliasing with regular grid structures, but means the result is not \
+                                                   exactly repeatable.
+
+            raydata_file (str)                   : If given, the ray casting results for the whole image are also saved \
+                                                   to this file as RayData. Note this requires holding the sight-line \
+                                                   coordinates for the whole image in memory. Cannot be used with supersampling.
+
+            calc_status_callback (callable)      : Callable which takes a single argument, which will be called with \
+                                                   status updates about the calculation, as for creating a new GeometryMatrix.
+
+            data_dtype (str or numpy.dtype)      : Data type to use for the matrix values, as for creating a new GeometryMatrix.
+
+        Returns:
+
+            calcam.gm.GeometryMatrix : The geometry matrix.
+        '''
+        if supersampling > 1 and raydata_file is not None:
+            raise ValueError('Cannot save RayData when using supersampling!')
+
+        x,y = calibration.fullframe_meshgrid(coords,binning=binning)
+        imdims = x.shape
+        x = x.reshape(-1,order=pixel_order)
+        y = y.reshape(-1,order=pixel_order)
+        n_los = x.size
+        index_dtype = _get_index_dtype(n_los,grid.n_cells)
+
+        # Sub-pixel positions of the sight-lines for each pixel, in units of binned pixels
+        # relative to the pixel centre. For supersampling = 1 this is just the pixel centre.
+        sub_x,sub_y = np.meshgrid(np.arange(supersampling) + 0.5,np.arange(supersampling) + 0.5)
+        sub_x = sub_x.flatten()
+        sub_y = sub_y.flatten()
+        rays_per_pixel = sub_x.size
+        tile_size = max(1,_raycast_tile_size // rays_per_pixel)
+
+        matrix = cls(None,None)
+        matrix.grid = copy.copy(grid)
+        matrix.image_coords = coords
+        matrix.binning = binning
+        matrix.pixel_order = pixel_order
+        matrix.pixel_mask = np.ones(imdims,dtype=bool)
+        matrix.image_geometry = calibration.geometry
+
+        if raydata_file is not None:
+            ray_start_coords = np.empty((n_los,3))
+            ray_end_coords = np.empty((n_los,3))
+
+        if calc_status_callback is not None:
+            calc_status_callback('Ray casting and calculating geometry matrix elements using {:d} CPUs...'.format(config.n_cpus))
+            calc_status_callback(0.)
+
+        last_status_update = 0.
+        colinds = []
+        rowinds = []
+        data = []
+
+        def collect_result(result):
+            block_rows, block_cols, block_data = result.get()
+            rowinds.append(block_rows.astype(index_dtype,copy=False))
+            colinds.append(block_cols.astype(index_dtype,copy=False))
+            data.append(block_data.astype(data_dtype,copy=False))
+
+        # The main process does the ray casting, since the CAD model can't be sent to other processes,
+        # while worker processes calculate the matrix rows for already ray cast tiles.
+        # The number of tiles waiting to be processed is limited to keep memory use down.
+        pending = []
+        with multiprocessing.Pool( config.n_cpus, initializer=_init_gm_worker, initargs=(grid,None) ) as cpupool:
+
+            for start in range(0,n_los,tile_size):
+
+                stop = min(start + tile_size,n_los)
+
+                if rays_per_pixel > 1:
+                    if stratified:
+                        offset_x = (sub_x[np.newaxis,:] + np.random.uniform(-0.5,0.5,(stop-start,rays_per_pixel))) / supersampling - 0.5
+                        offset_y = (sub_y[np.newaxis,:] + np.random.uniform(-0.5,0.5,(stop-start,rays_per_pixel))) / supersampling - 0.5
+                    else:
+                        offset_x = sub_x[np.newaxis,:] / supersampling - 0.5
+                        offset_y = sub_y[np.newaxis,:] / supersampling - 0.5
+                    tile_x = (x[start:stop,np.newaxis] + offset_x * binning).flatten()
+                    tile_y = (y[start:stop,np.newaxis] + offset_y * binning).flatten()
+                else:
+                    tile_x = x[start:stop]
+                    tile_y = y[start:stop]
+
+                rays = raycast_sightlines(calibration,cadmodel,tile_x,tile_y,exclusion_radius=exclusion_radius,coords=coords,verbose=False)
+                if start == 0:
+                    matrix.history = {'los':rays.history,'grid':grid.history,'matrix':'Created by {:s} on {:s} at {:s}'.format(misc.username,misc.hostname,misc.get_formatted_time())}
+
+                if raydata_file is not None:
+                    ray_start_coords[start:stop,:] = rays.ray_start_coords
+                    ray_end_coords[start:stop,:] = rays.ray_end_coords
+
+                pending.append(cpupool.apply_async(_calc_tile_worker,(start,np.hstack((rays.ray_start_coords,rays.ray_end_coords)),rays_per_pixel)))
+                while len(pending) > config.n_cpus:
+                    collect_result(pending.pop(0))
+
+                if time.time() - last_status_update > 1. and calc_status_callback is not None:
+                    calc_status_callback(float(stop) / n_los)
+                    last_status_update = time.time()
+
+            for result in pending:
+                collect_result(result)
+
+        matrix.data = scipy.sparse.csr_matrix((np.concatenate(data),(np.concatenate(rowinds),np.concatenate(colinds))),shape=(n_los,grid.n_cells),dtype=data_dtype)
+
+        if calc_status_callback is not None:
+            calc_status_callback(1.)
+
+        if raydata_file is not None:
+            raydata = RayData()
+            raydata.fullchip = coords
+            raydata.binning = binning
+            raydata.transform = calibration.geometry
+            raydata.history = matrix.history['los']
+            raydata.x = x.reshape(imdims,order=pixel_order)
+            raydata.y = y.reshape(imdims,order=pixel_order)
+            raydata.ray_start_coords = ray_start_coords.reshape(imdims + (3,),order=pixel_order)
+            raydata.ray_end_coords = ray_end_coords.reshape(imdims + (3,),order=pixel_order)
+            raydata.save(raydata_file)
+
+        matrix._trim(trim_rows,trim_columns)
+
+        return matrix
 
-            if trim_rows:
-                # Set the pixel mask to exclude pixels which do not contribute to any grid cells and remove corresponding rows.
-                if self.pixel_mask is not None:
-                    used_pixels = np.squeeze(np.array(np.abs(self.data.sum(axis=1))) > 1e-14)
-                    self.pixel_mask = used_pixels.reshape(imdims,order=self.pixel_order)
-                    self.data = self.data[used_pixels,:]
+
+
+    @classmethod
+    def combine(cls,matrices):
+        '''
+        Combine geometry matrices for several cameras, calculated with the same
+        reconstruction grid, in to a single geometry matrix for multi-camera tomography.
+        The individual matrices may have had different grid cells removed (e.g. by
+        the trim_columns option); the combined matrix has a column for every grid
+        cell present in any of the input matrices.
+
+        Parameters:
+
+            matrices (list of calcam.gm.GeometryMatrix) : Geometry matrices to combine, \
+                                                          in the order their rows should be stacked.
+
+        Returns:
+
+            calcam.gm.CombinedGeometryMatrix : The combined matrix.
+        '''
+        return CombinedGeometryMatrix(matrices)
+
+
+
+    def update_grid(self,grid,raydata=None,trim_rows=True,trim_columns=True,calc_status_callback=misc.LoopProgPrinter().update):
+        '''
+        Update the geometry matrix for a modified version of its reconstruction grid,
+        e.g. after locally refining the grid or removing cells, without re-calculating
+        the whole matrix. Cells in the new grid with exactly the same vertex coordinates
+        as a cell in the current grid are treated as unchanged; only the matrix rows for
+        sight-lines which could cross any new or changed cells are re-calculated,
+        and the rest of the matrix is kept. If cells have only been removed from
+        the grid, no re-calculation is needed at all.
+
+        Pixels which were previously removed from the matrix because their sight-lines
+        did not see any grid cells are added back if they see any of the new cells, so the
+        result is the same as calculating a new geometry matrix for the new grid. Pixels
+        excluded using :func:`set_included_pixels` are not added back. Note that which pixels
+        were excluded this way is only known for matrices created in the current session or
+        saved in Calcam's native .gmat format; for matrices loaded from other file formats,
+        excluded pixels whose sight-lines see new grid cells are also added back.
+
+        Parameters:
+
+            grid (calcam.gm.PoloidalVolumeGrid) : The new reconstruction grid.
+
+            raydata (calcam.RayData)            : The ray data for the whole image which the geometry matrix was \
+                                                  calculated from. Only needed if the new grid contains new or changed cells. \
+                                                  Note that matrices calculated with supersampling, or re-binned \
+                                                  using :func:`set_binning`, cannot be updated this way since their \
+                                                  rows do not correspond to single sight-lines.
+
+            trim_rows (bool)                    : Whether to remove matrix rows which are all zero after the update.
+
+            trim_columns (bool)                 : Whether to remove matrix columns, and the corresponding cells \
+                                                  from the new grid, which are all zero after the update.
+
+            calc_status_callback (callable)     : Callable which takes a single argument, which will be called with \
+                                                  status updates about the calculation, as for creating a new GeometryMatrix.
+        '''
+        old_grid = self.grid
+        n_rows = self.data.shape[0]
+
+        # Match up unchanged cells between the old and new grids by their vertex coordinates.
+        old_coords = old_grid.vertices[old_grid.cells,:].reshape(old_grid.n_cells,-1)
+        new_coords = grid.vertices[grid.cells,:].reshape(grid.n_cells,-1)
+        old_inds = np.full(grid.n_cells,-1,dtype=np.int64)
+        if old_coords.shape[1] == new_coords.shape[1]:
+            _,cell_ids = np.unique(np.concatenate((old_coords,new_coords)) + 0.,axis=0,return_inverse=True)
+            cell_ids = cell_ids.reshape(-1)
+            old_cell_lookup = np.full(cell_ids.max() + 1,-1,dtype=np.int64)
+            old_cell_lookup[cell_ids[:old_grid.n_cells]] = np.arange(old_grid.n_cells)
+            old_inds = old_cell_lookup[cell_ids[old_grid.n_cells:]]
+
+        new_inds = np.full(old_grid.n_cells,-1,dtype=np.int64)
+        new_inds[old_inds[old_inds >= 0]] = np.flatnonzero(old_inds >= 0)
+        added_cells = np.flatnonzero(old_inds < 0)
+
+        data = self.data.tocsr()
+
+        # Work in terms of all the image pixels, not just those with rows in the current matrix,
+        # so that pixels which were trimmed because they did not see any cells can be added back.
+        if self.pixel_mask is not None:
+            pixel_mask = self.pixel_mask.flatten(order=self.pixel_order)
+            n_pixels = pixel_mask.size
+            pixel_inds = np.flatnonzero(pixel_mask)
+        else:
+            n_pixels = n_rows
+            pixel_inds = np.arange(n_rows)
+
+        row_inds = pixel_inds[np.repeat(np.arange(n_rows),np.diff(data.indptr))]
+
+        # Each matrix element only depends on the geometry of its own cell, so the elements
+        # for unchanged cells stay the same and those for cells no longer in the grid are just
+        # dropped. Only the rows for sight-lines crossing new cells need re-calculating.
+        recalc_pixels = np.zeros(n_pixels,dtype=bool)
+
+        if added_cells.size > 0:
+
+            if raydata is None:
+                raise ValueError('The new grid contains {:d} new or changed cells; ray data must be given to calculate their matrix elements.'.format(added_cells.size))
+
+            ray_start_coords = raydata.get_ray_start().reshape(-1,3,order=self.pixel_order)
+            ray_end_coords = raydata.get_ray_end().reshape(-1,3,order=self.pixel_order)
+
+            if self.pixel_mask is not None:
+                if raydata.fullchip != self.image_coords or raydata.binning != self.binning or ray_start_coords.shape[0] != n_pixels:
+                    raise ValueError('The given ray data does not match the image geometry of the geometry matrix!')
+            elif ray_start_coords.shape[0] != n_rows:
+                raise ValueError('The given ray data does not match the geometry matrix size!')
+
+            # Pixels excluded by the user are left out.
+            if self._excluded_pixels is not None:
+                candidate_pixels = np.flatnonzero(~self._excluded_pixels.flatten(order=self.pixel_order))
+            else:
+                candidate_pixels = np.arange(n_pixels)
+
+            # Use the spatial index of a grid containing only the new cells to find which sight-lines could cross them.
+            added_grid = PoloidalVolumeGrid(grid.vertices,grid.cells[added_cells,:],grid.wall_contour,src=grid.history)
+            for start in range(0,candidate_pixels.size,_ray_block_size):
+                block_pixels = candidate_pixels[start:start+_ray_block_size]
+                ray_inds,_ = added_grid._get_candidate_segments(ray_start_coords[block_pixels,:],ray_end_coords[block_pixels,:])
+                recalc_pixels[block_pixels[ray_inds]] = True
+
+        recalc_inds = np.flatnonzero(recalc_pixels)
+
+        if calc_status_callback is not None:
+            calc_status_callback('Updating geometry matrix for {:d} new or changed grid cells: re-calculating {:d} of {:d} sight-lines using {:d} CPUs...'.format(added_cells.size,recalc_inds.size,n_pixels,config.n_cpus))
+
+        # Keep the existing elements of all the other rows, re-numbering their columns to match the new grid.
+        index_dtype = _get_index_dtype(n_pixels,grid.n_cells)
+        keep = ~recalc_pixels[row_inds] & (new_inds[data.indices] >= 0)
+        rowinds = [row_inds[keep].astype(index_dtype)]
+        colinds = [new_inds[data.indices[keep]].astype(index_dtype)]
+        values = [data.data[keep]]
+
+        if recalc_inds.size > 0:
+
+            block_size = int(min(_ray_block_size,max(1,np.ceil(recalc_inds.size / (4 * config.n_cpus)))))
+            blocks = [(start,min(start + block_size,recalc_inds.size)) for start in range(0,recalc_inds.size,block_size)]
+            last_status_update = 0.
+            n_done = 0
+
+            with multiprocessing.Pool( config.n_cpus, initializer=_init_gm_worker, initargs=(grid,np.hstack((ray_start_coords[recalc_inds,:],ray_end_coords[recalc_inds,:]))) ) as cpupool:
+                if calc_status_callback is not None:
+                    calc_status_callback(0.)
+                for block, (block_rows, block_cols, block_data) in cpupool.imap_unordered( _calc_rows_worker, blocks ):
+                    rowinds.append(recalc_inds[block_rows].astype(index_dtype))
+                    colinds.append(block_cols.astype(index_dtype,copy=False))
+                    values.append(block_data.astype(data.dtype,copy=False))
+
+                    n_done = n_done + block[1] - block[0]
+                    if time.time() - last_status_update > 1. and calc_status_callback is not None:
+                        calc_status_callback(float(n_done) / recalc_inds.size)
+                        last_status_update = time.time()
+
+            if calc_status_callback is not None:
+                calc_status_callback(1.)
+
+        self.data = scipy.sparse.csr_matrix((np.concatenate(values),(np.concatenate(rowinds),np.concatenate(colinds))),shape=(n_pixels,grid.n_cells),dtype=data.dtype)
+
+        if self.pixel_mask is not None:
+            # Add back any previously trimmed pixels which now see grid cells.
+            pixel_mask = pixel_mask | (recalc_pixels & (np.diff(self.data.indptr) > 0))
+            self.data = self.data[pixel_mask,:]
+            self.pixel_mask = pixel_mask.reshape(self.pixel_mask.shape,order=self.pixel_order)
+
+        self.grid = copy.copy(grid)
+        self.history['grid'] = grid.history
+        self.history['matrix'] = self.history['matrix'] + '; updated for grid changes by {:s} on {:s} at {:s}'.format(misc.username,misc.hostname,misc.get_formatted_time())
+
+        self._trim(trim_rows,trim_columns)
 
 
 
@@ -738,41 +1601,22 @@ class GeometryMatrix:
             return
         else:
             
-            if self.image_coords is not None:
-                if self.image_coords.lower() == 'display':
-                    image_dims = self.image_geometry.get_display_shape()
-                elif self.image_coords.lower() == 'original':
-                    image_dims = self.image_geometry.get_original_shape()
-            else:
+            if self.image_coords is None:
                 raise Exception('Nope, no worky.')
                 
             bin_factor = int(binning / self.binning)
 
-            init_shape = (np.array(image_dims) / self.binning).astype(np.uint32)
-            row_inds = np.arange(np.prod(init_shape),dtype=np.uint32)
-            row_inds = np.reshape(row_inds,init_shape,order=self.pixel_order)
-
-            px_mask = self.pixel_mask.reshape(self.pixel_mask.size,order=self.pixel_order)
-            index_map = np.zeros(np.prod(image_dims)//int(self.binning**2),dtype=np.uint32)
-            index_map[px_mask == True] = np.arange(np.count_nonzero(px_mask),dtype=np.uint32)
-
-            self.pixel_mask = _bin_image(self.pixel_mask,bin_factor,bin_func=np.min).astype(bool)
+            # A binned pixel is only included if all the pixels it is made of are included.
+            binned_shape = (self.pixel_mask.shape[0] // bin_factor,self.pixel_mask.shape[1] // bin_factor)
+            new_pixel_mask = _bin_image(self.pixel_mask[:binned_shape[0]*bin_factor,:binned_shape[1]*bin_factor],bin_factor,bin_func=np.min).astype(bool)
 
-            px_mask = self.pixel_mask.reshape(self.pixel_mask.size,order=self.pixel_order)
+            binning_operator = _get_binning_operator(self.pixel_mask.shape,bin_factor,self.pixel_order,in_mask=self.pixel_mask,out_mask=new_pixel_mask)
 
-            ind_arrays = []
-            for colshift in range(bin_factor):
-                for rowshift in range(bin_factor):
-                    ind_arrays.append(row_inds[colshift::bin_factor,rowshift::bin_factor].reshape(int(np.prod(init_shape)/bin_factor**2),order=self.pixel_order))
-                    ind_arrays[-1] = index_map[ind_arrays[-1]][px_mask == True]
+            self.data = (binning_operator.astype(self.data.dtype) @ self.data).tocsr()
+            self.pixel_mask = new_pixel_mask
 
-            new_data = self.data[ind_arrays[0],:]
-            for indarr in ind_arrays[1:]:
-                new_data = new_data + self.data[indarr,:]
-                
-            norm_factor = scipy.sparse.diags(np.ones(self.grid.n_cells)/bin_factor**2,format='csr')
-            
-            self.data = new_data * norm_factor
+            if self._excluded_pixels is not None:
+                self._excluded_pixels = _bin_image(self._excluded_pixels[:binned_shape[0]*bin_factor,:binned_shape[1]*bin_factor],bin_factor,bin_func=np.max).astype(bool)
             
             self.binning = binning
         
@@ -847,6 +1691,10 @@ class GeometryMatrix:
 
         self.data = self.data[mask_delta == 0,:]
 
+        if self._excluded_pixels is None:
+            self._excluded_pixels = np.zeros(self.pixel_mask.shape,dtype=bool)
+        self._excluded_pixels = self._excluded_pixels | (self.pixel_mask & ~pixel_mask.astype(bool))
+
         self.pixel_mask = pixel_mask.astype(bool)
 
 
@@ -866,38 +1714,49 @@ class GeometryMatrix:
 
 
 
-    def save(self,filename):
+    def save(self,filename,compress=False,data_dtype=None):
         '''
         Save the geometry matrix to a file.
 
          .. note::
-            .npz is the recommended file format; .mat is provided if compatibility
-            with MATLAB is required but produces larger file sizes, and .zip is provided
-            to make maximally compatible data files but is extremely slow to save and load.
+            .gmat is the recommended file format for large matrices since it is the fastest
+            to save and load and can be memory-mapped; .npz gives smaller files and is 
+            easy to read with NumPy; .mat is provided if compatibility with MATLAB is required but 
+            produces larger file sizes, and .zip is provided to make maximally compatible data files 
+            but is extremely slow to save and load.
 
         Parameters:
             
-            filename (str) : File name to save to, including file extension. \
-                             The file extension determines the format to be saved: \
-                             '.npz' for compressed NumPy binary format, \
-                             '.mat' for MATLAB format or 
-                             '.zip' for Zipped collection of ASCII files.
+            filename (str)     : File name to save to, including file extension. \
+                                 The file extension determines the format to be saved: \
+                                 '.gmat' for Calcam's native geometry matrix format, \
+                                 '.npz' for compressed NumPy binary format, \
+                                 '.mat' for MATLAB format or 
+                                 '.zip' for Zipped collection of ASCII files.
+
+            compress (bool)    : For .gmat files, whether to compress the file. Compressed files are \
+                                 smaller but slower to load, and cannot be memory-mapped when loading.
 
+            data_dtype (str)   : For .gmat files, data type to store the matrix values as, e.g. 'float32' \
+                                 to halve the size of the matrix data at the cost of reduced precision \
+                                 (around 7 significant figures). By default the matrix's current data type is used.
 
         '''
         try:
             fmt = filename.split('.')[1:][-1]
         except IndexError:
-            raise ValueError('Given file name does not include file extension; extension .npz, .mat or .zip must be included to determine file type!')
+            raise ValueError('Given file name does not include file extension; extension .gmat, .npz, .mat or .zip must be included to determine file type!')
 
-        if fmt == 'npz':
+        if fmt == 'gmat':
+            self._save_native(filename,compress=compress,data_dtype=data_dtype)
+        elif fmt == 'npz':
             self._save_npz(filename)
         elif fmt == 'mat':
             self._save_matlab(filename)
         elif fmt == 'zip':
             self._save_txt(filename)
         else:
-            raise ValueError('File extension "{:s}" not understood; options are "npz", "mat" or "zip".'.format(fmt))
+            raise ValueError('File extension "{:s}" not understood; options are "gmat", "npz", "mat" or "zip".'.format(fmt))
 
 
 
@@ -906,11 +1765,14 @@ class GeometryMatrix:
         Format a given 2D camera image in to a 1D data vector 
         (i.e. :math:`b` in :math:`Ax = b`) appropriate for use with this 
         geometry matrix. This will bin the image, remove any excluded 
-        pixels and reshape it to a 1D vector.
+        pixels and reshape it to a 1D vector. A stack of several images can
+        also be formatted at once, e.g. for all the frames of a camera movie.
 
         Parameters: 
 
-            image (numpy.ndarray) : Input image.
+            image (numpy.ndarray) : Input image. Can be a single 2D image or a 3D \
+                                    (n_frames x h x w) stack of images, which may be a \
+                                    memory-mapped array.
 
             coords (str)          : Either 'Display' or 'Original', \
                                     specifies what orientation the input \
@@ -919,55 +1781,98 @@ class GeometryMatrix:
 
         Returns:
 
-            scipy.sparse.csr_matrix : 1xN_pixels image data vector. Note that this is \
-                                      returned as a sparse matrix object despite its \
-                                      density being 100%; this is for consistency with the \
-                                      matrix itself.
+            scipy.sparse.csr_matrix or numpy.ndarray : For a single image, a 1xN_pixels image data vector. Note that this is \
+                                                       returned as a sparse matrix object despite its \
+                                                       density being 100%; this is for consistency with the \
+                                                       matrix itself. For a stack of images, a dense \
+                                                       N_frames x N_pixels array with one image data vector per row.
 
         '''
+        if len(image.shape) not in [2,3]:
+            raise ValueError('Provided image array has {:d} dimensions; expected a 2D image or 3D stack of images. Colour images are not supported.'.format(len(image.shape)))
+
+        stack = len(image.shape) == 3
+        image_shape = image.shape[-2:]
+
+        if coords is None:
+
+            # If there are no transform actions, we have no problem.
+            if len(self.image_geometry.transform_actions) == 0 and self.image_geometry.pixel_aspectratio == 1:
+                coords = self.image_coords
+
+            elif self.image_geometry.get_display_shape() != self.image_geometry.get_original_shape():
+
+                if image_shape == self.image_geometry.get_display_shape()[::-1]:
+                    coords = 'Display'
+                elif image_shape == self.image_geometry.get_original_shape()[::-1]:
+                    coords = 'Original'
+                else:
+                    raise ValueError('Input image has an unexpected shape! Got {:d}x{:d}; expected {:d}x{:d} or {:d}x{:d}'.format(image_shape[1],image_shape[0],self.image_geometry.get_display_shape()[0],self.image_geometry.get_display_shape()[1],self.image_geometry.get_original_shape()[0],self.image_geometry.get_original_shape()[1]))
+            else:
+                raise Exception('Cannot determine image orientation automatically; please provide the "coords" input argument.')
+
+        if self.binning < 1:
+            raise Exception('This matrix has binning < 1 which is not really meaningful. Set binning =>1 before trying to use this matrix.')
+
+        if self.binning > 1:
+            # Binning and selection of the included pixels is done by the same sparse
+            # operator used to bin the matrix itself in set_binning().
+            binning_operator = None
+        else:
+            pixel_inds = self._get_pixel_inds()
+
+        if not stack:
+            im_out = self._format_frames(image,coords,stack=False)
+            if self.binning > 1:
+                binning_operator = _get_binning_operator(im_out.shape,int(self.binning),self.pixel_order,out_mask=self.pixel_mask)
+                return scipy.sparse.csr_matrix(binning_operator.dot(im_out.reshape(im_out.size,order=self.pixel_order)))
+            else:
+                return scipy.sparse.csr_matrix(im_out[pixel_inds])
+
+        # Stacks of images are processed in blocks of frames to limit the memory
+        # needed for intermediate results, e.g. when working from memory-mapped arrays.
+        data_out = None
+        for start in range(0,image.shape[0],_frame_block_size):
+            im_out = self._format_frames(image[start:start + _frame_block_size],coords,stack=True)
+            if self.binning > 1:
+                if binning_operator is None:
+                    binning_operator = _get_binning_operator(im_out.shape[1:],int(self.binning),self.pixel_order,out_mask=self.pixel_mask)
+                if self.pixel_order.upper() == 'F':
+                    im_out = np.swapaxes(im_out,1,2)
+                im_out = binning_operator.dot(im_out.reshape(im_out.shape[0],-1).T).T
+            else:
+                im_out = im_out[(slice(None),) + pixel_inds]
+            if data_out is None:
+                data_out = np.empty((image.shape[0],im_out.shape[1]),dtype=im_out.dtype)
+            data_out[start:start + im_out.shape[0],:] = im_out
 
-        if len(image.shape) > 2:
-            raise ValueError('Provided image array has 3 dimensions i.e. includes colour channels. This only supports single channel images.')
+        return data_out
 
-        if coords is None:
 
-            # If there are no transform actions, we have no problem.
-            if len(self.image_geometry.transform_actions) == 0 and self.image_geometry.pixel_aspectratio == 1:
-                coords = self.image_coords
+    def _get_pixel_inds(self):
+        '''
+        Get the image array indices of the pixels included in the matrix, in matrix row order.
+        '''
+        return np.unravel_index(np.flatnonzero(self.pixel_mask.reshape(self.pixel_mask.size,order=self.pixel_order)),self.pixel_mask.shape,order=self.pixel_order)
 
-            elif self.image_geometry.get_display_shape() != self.image_geometry.get_original_shape():
 
-                if image.shape == self.image_geometry.get_display_shape()[::-1]:
-                    coords = 'Display'
-                elif image.shape == self.image_geometry.get_original_shape()[::-1]:
-                    coords = 'Original'
-                else:
-                    raise ValueError('Input image has an unexpected shape! Got {:d}x{:d}; expected {:d}x{:d} or {:d}x{:d}'.format(image.shape[1],image.shape[0],self.image_geometry.get_display_shape[1],self.image_geometry.get_display_shape[0],self.image_geometry.get_original_shape[1],self.image_geometry.get_original_shape[0]))
-            else:
-                raise Exception('Cannot determine image orientation automatically; please provide the "coords" input argument.')
-        
+    def _format_frames(self,image,coords,stack):
+        '''
+        Transform an image or stack of images to the geometry matrix orientation.
+        '''
         if coords.lower() == 'display' and self.image_coords.lower() == 'original':
 
-            im_out = self.image_geometry.display_to_original_image(image)
+            im_out = self.image_geometry.display_to_original_image(image,stack=stack)
 
         elif coords.lower() == 'original' and self.image_coords.lower() == 'display':
 
-            im_out = self.image_geometry.original_to_display_image(image)
+            im_out = self.image_geometry.original_to_display_image(image,stack=stack)
 
         else:
 
-            im_out = image.copy()
+            im_out = image
 
-
-        if self.binning > 1:
-            im_out = _bin_image(im_out,self.binning,bin_func=np.mean)
-
-        elif self.binning < 1:
-            raise Exception('This matrix has binning < 1 which is not really meaningful. Set binning =>1 before trying to use this matrix.')
-
-        im_out = im_out.reshape(im_out.size,order=self.pixel_order)
-
-        return scipy.sparse.csr_matrix(im_out[ self.pixel_mask.reshape(self.pixel_mask.size,order=self.pixel_order)])
+        return im_out
 
 
     def unformat_image(self,im_vector,coords='Native',fill_value=np.nan):
@@ -1006,7 +1911,7 @@ class GeometryMatrix:
 
         im_out = np.zeros(self.pixel_mask.shape) + fill_value
 
-        im_out[self.pixel_mask] = im_vector
+        im_out[self._get_pixel_inds()] = im_vector
 
         if coords.lower() == 'display' and self.image_coords.lower() == 'original':
             im_out = self.image_geometry.original_to_display_image(im_out)
@@ -1016,6 +1921,168 @@ class GeometryMatrix:
         return im_out
 
 
+    def _calc_rows_volume(self,ray_endpoints,rays_per_row=1):
+        '''
+        Calculate the matrix rows for a block of sight-lines, for volume type grids
+        (i.e. quantities constant within grid cell volume). This gives identical
+        results to _calc_row_volume() for each sight-line, but walks through the grid
+        for all the sight-lines at once. Any sight-lines with awkward intersections,
+        e.g. passing exactly through grid vertices, are passed to _calc_row_volume().
+
+        Parameters:
+
+            ray_endpoints (numpy.ndarray) : N x 6 array containing the \
+                                            ray start and end coordinates: \
+                                            (Xstart, Ystart, Zstart, Xend, Yend, Zend)
+
+            rays_per_row (int)            : Number of consecutive sight-lines in ray_endpoints \
+                                            to average together in to each matrix row, e.g. \
+                                            for supersampling pixels with several sub-rays.
+
+        Returns:
+
+            tuple : Calculated matrix elements in COO format: \
+
+                    * numpy.ndarray containing the index of the sight-line \
+                      (row of ray_endpoints, divided by rays_per_row) for each element.
+
+                    * numpy.ndarray containing the grid cell indices of the elements.
+
+                    * numpy.ndarray containing the values of the matrix elements.
+        '''
+        ray_endpoints = np.array(ray_endpoints)
+        ray_start_coords = ray_endpoints[:,:3]
+        ray_end_coords = ray_endpoints[:,3:]
+        n_rays = ray_endpoints.shape[0]
+
+        ray_length = np.sqrt( np.sum( (ray_end_coords - ray_start_coords)**2 ,axis=1) )
+
+        ray_inds,positions,seg_inds = self.grid._get_block_intersections(ray_start_coords,ray_end_coords)
+
+        # Sight-lines which need to be done individually.
+        difficult_rays = np.zeros(n_rays,dtype=bool)
+
+        # Group intersections at the same position along the same ray.
+        new_pos = np.ones(positions.size,dtype=bool)
+        new_pos[1:] = (ray_inds[1:] != ray_inds[:-1]) | (positions[1:] != positions[:-1])
+        pos_start = np.flatnonzero(new_pos)
+        n_segs = np.diff(np.append(pos_start,positions.size))
+
+        # Intersections with more than 1 segment at once (i.e. at grid vertices)
+        # or with segments bordering more than 2 cells are awkward.
+        difficult_rays[ray_inds[pos_start[n_segs > 1]]] = True
+        if self.grid.segment_cells.shape[1] > 2:
+            difficult_rays[ray_inds[self.grid.segment_cells[seg_inds,2:].max(axis=1) >= 0]] = True
+
+        ray_inds = ray_inds[pos_start]
+        positions = positions[pos_start]
+        cell_a = self.grid.segment_cells[seg_inds[pos_start],0]
+        cell_b = self.grid.segment_cells[seg_inds[pos_start],1]
+
+        # Each intersection is either with a grid boundary (1 cell) or between 2 cells.
+        boundary = cell_b < 0
+
+        # Index of the first intersection of each ray
+        first_ind = np.zeros(n_rays + 1,dtype=int)
+        first_ind[1:] = np.cumsum(np.bincount(ray_inds,minlength=n_rays))
+
+        # The first intersection of each sight-line is where it enters the grid. After that,
+        # boundary crossings alternately leave and enter the grid, so after each intersection
+        # we are inside the grid if we have entered or left an odd number of times.
+        first = np.zeros(positions.size,dtype=bool)
+        first[first_ind[:-1][np.diff(first_ind) > 0]] = True
+        n_boundaries = np.cumsum(boundary | first)
+        n_boundaries = n_boundaries - np.append(0,n_boundaries)[first_ind[ray_inds]]
+        inside = n_boundaries % 2 == 1
+
+        # Entering the grid between 2 cells is awkward, unless it is where the sight-line starts.
+        difficult_rays[ray_inds[~boundary & ~inside]] = True
+
+        # Between each pair of consecutive intersections inside the grid,
+        # the sight-line is in the cell shared by both intersections.
+        same_ray = ray_inds[1:] == ray_inds[:-1]
+        segment_inside = same_ray & inside[:-1]
+        match_aa = cell_a[:-1] == cell_a[1:]
+        match_ab = (cell_a[:-1] == cell_b[1:])
+        match_ba = (cell_b[:-1] == cell_a[1:]) & ~boundary[:-1]
+        match_bb = (cell_b[:-1] == cell_b[1:]) & ~boundary[:-1] & ~boundary[1:]
+        n_shared = match_aa.astype(int) + match_ab + match_ba + match_bb
+        difficult_rays[ray_inds[:-1][segment_inside & (n_shared != 1)]] = True
+        shared_cell = np.where(match_aa | match_ab,cell_a[:-1],cell_b[:-1])
+
+        # When crossing between 2 cells, the cell after must be different to the cell before.
+        crossing = segment_inside[1:] & segment_inside[:-1]
+        difficult_rays[ray_inds[1:-1][crossing & (shared_cell[1:] == shared_cell[:-1])]] = True
+
+        # Sight-lines which end inside a cell: find the cell they end in. If the only
+        # intersection was between 2 cells, we cannot tell which one that is.
+        last_inds = first_ind[1:][np.diff(first_ind) > 0] - 1
+        last_inds = last_inds[inside[last_inds]]
+        difficult_rays[ray_inds[last_inds[first[last_inds] & ~boundary[last_inds]]]] = True
+        last_inds = last_inds[~first[last_inds] | boundary[last_inds]]
+        end_cell = cell_a[last_inds].copy()
+        prev_inds = last_inds[~boundary[last_inds]] - 1
+        end_cell[~boundary[last_inds]] = np.where(cell_a[last_inds[~boundary[last_inds]]] == shared_cell[prev_inds],cell_b[last_inds[~boundary[last_inds]]],cell_a[last_inds[~boundary[last_inds]]])
+
+        # Lengths of sight-line inside each cell, in order along each sight-line.
+        out_rays = np.concatenate((ray_inds[:-1][segment_inside],ray_inds[last_inds]))
+        out_cells = np.concatenate((shared_cell[segment_inside],end_cell))
+        out_data = np.concatenate(((positions[1:] - positions[:-1])[segment_inside],ray_length[ray_inds[last_inds]] - positions[last_inds]))
+        out_order = np.concatenate((np.flatnonzero(segment_inside),last_inds))
+
+        keep = ~difficult_rays[out_rays]
+        out_rays = out_rays[keep]
+        out_cells = out_cells[keep]
+        out_data = out_data[keep]
+        out_order = out_order[keep]
+
+        # Add up the lengths for any cells passed through more than once by the same sight-line.
+        sort_order = np.lexsort((out_order,out_cells,out_rays))
+        out_rays = out_rays[sort_order]
+        out_cells = out_cells[sort_order]
+        out_data = out_data[sort_order]
+        new_element = np.ones(out_rays.size,dtype=bool)
+        new_element[1:] = (out_rays[1:] != out_rays[:-1]) | (out_cells[1:] != out_cells[:-1])
+        element_start = np.flatnonzero(new_element)
+        if element_start.size > 0:
+            out_data = np.add.reduceat(out_data,element_start)
+        out_rays = out_rays[element_start]
+        out_cells = out_cells[element_start]
+
+        rowinds = [out_rays[out_data > 0]]
+        colinds = [out_cells[out_data > 0].astype(np.uint32)]
+        data = [out_data[out_data > 0]]
+
+        # Do the awkward sight-lines one at a time.
+        for ray_ind in np.flatnonzero(difficult_rays):
+            row_data = self._calc_row_volume(ray_endpoints[ray_ind,:])
+            rowinds.append(np.zeros(row_data[0].shape,dtype=int) + ray_ind)
+            colinds.append(row_data[0])
+            data.append(row_data[1])
+
+        rowinds = np.concatenate(rowinds)
+        colinds = np.concatenate(colinds)
+        data = np.concatenate(data)
+
+        if rays_per_row > 1:
+            # Average the sub-rays belonging to each row.
+            rowinds = rowinds // rays_per_row
+            sort_order = np.lexsort((colinds,rowinds))
+            rowinds = rowinds[sort_order]
+            colinds = colinds[sort_order]
+            data = data[sort_order] / rays_per_row
+            new_element = np.ones(rowinds.size,dtype=bool)
+            new_element[1:] = (rowinds[1:] != rowinds[:-1]) | (colinds[1:] != colinds[:-1])
+            element_start = np.flatnonzero(new_element)
+            if element_start.size > 0:
+                data = np.add.reduceat(data,element_start)
+            rowinds = rowinds[element_start]
+            colinds = colinds[element_start]
+
+        return rowinds,colinds,data
+
+
+
     def _calc_row_volume(self,ray_endpoints):
         '''
         Calculate a matrix row given the sight-line start and end in 3D,
@@ -1124,6 +2191,85 @@ class GeometryMatrix:
 
 
 
+    def _save_native(self,filename,compress=False,data_dtype=None):
+        '''
+        Save the geometry matrix in Calcam's native format. This is a NumPy .npz format file,
+        uncompressed by default, containing the CSR matrix arrays as they are stored in memory
+        and the grid's derived tables, so that it can be loaded without any conversion.
+        '''
+        data = self.data.tocsr()
+
+        # 32-bit indices are used where possible since this is what SciPy uses.
+        if max(data.nnz,data.shape[1]) < 2**31:
+            index_dtype = np.int32
+        else:
+            index_dtype = np.int64
+
+        if data_dtype is None:
+            data_dtype = data.dtype
+
+        metadata = {'binning':float(self.binning) if self.binning is not None else None,
+                    'pixel_order':self.pixel_order,
+                    'history':self.history,
+                    'im_coords':self.image_coords,
+                    'im_transforms':list(self.image_geometry.transform_actions),
+                    'im_px_aspect':float(self.image_geometry.pixel_aspectratio),
+                    'im_shape':[int(n) for n in self.image_geometry.get_original_shape()],
+                    'grid_type':self.grid.__class__.__name__,
+                    'calcam_version':calcam_version}
+
+        arrays = {'mat_indptr':data.indptr.astype(index_dtype,copy=False),
+                  'mat_indices':data.indices.astype(index_dtype,copy=False),
+                  'mat_data':data.data.astype(data_dtype,copy=False),
+                  'mat_shape':np.array(data.shape),
+                  'grid_verts':self.grid.vertices,
+                  'grid_cells':self.grid.cells,
+                  'grid_wall':self.grid.wall_contour,
+                  'metadata':np.array(json.dumps(metadata))}
+
+        if self.pixel_mask is not None:
+            arrays['pixel_mask'] = self.pixel_mask
+
+        if self._excluded_pixels is not None:
+            arrays['excluded_pixels'] = self._excluded_pixels
+
+        for name,table in self.grid._get_saved_tables().items():
+            arrays['grid_' + name] = table
+
+        with open(filename,'wb') as f:
+            if compress:
+                np.savez_compressed(f,**arrays)
+            else:
+                np.savez(f,**arrays)
+
+
+
+    def _load_native(self,filename,mmap=True):
+        '''
+        Load a geometry matrix saved in Calcam's native format.
+        '''
+        f = _load_npz_arrays(filename,mmap=mmap)
+
+        metadata = json.loads(str(f['metadata']))
+
+        self.binning = metadata['binning']
+        self.pixel_order = metadata['pixel_order']
+        self.history = metadata['history']
+        self.image_coords = metadata['im_coords']
+        self.pixel_mask = np.array(f['pixel_mask']) if 'pixel_mask' in f else None
+        self._excluded_pixels = np.array(f['excluded_pixels']) if 'excluded_pixels' in f else None
+        self.image_geometry = CoordTransformer()
+        self.image_geometry.set_transform_actions(metadata['im_transforms'])
+        self.image_geometry.set_pixel_aspect(metadata['im_px_aspect'],relative_to='Original')
+        self.image_geometry.set_image_shape(*metadata['im_shape'],coords='Original')
+
+        tables = {name[5:]:f[name] for name in f.keys() if name.startswith('grid_') and name not in ['grid_verts','grid_cells','grid_wall']}
+        self.grid = PoloidalVolumeGrid._from_saved_tables(np.array(f['grid_verts']),np.array(f['grid_cells']),np.array(f['grid_wall']),self.history['grid'],tables)
+
+        self.data = scipy.sparse.csr_matrix((f['mat_data'],f['mat_indices'],f['mat_indptr']),shape=tuple(f['mat_shape']),copy=False)
+
+
+
     def _save_npz(self,filename):
         '''
         Save the geometry matrix in compressed NumPy binary format.
@@ -1175,7 +2321,7 @@ class GeometryMatrix:
         Save the geometry matrix in MATLAB format.
         '''
         scipy.io.savemat( filename,
-                         { 'geom_mat': self.data,
+                         { 'geom_mat': self.data.astype(np.float64,copy=False),
                            'grid_verts':self.grid.vertices,
                            'grid_cells':self.grid.cells,
                            'grid_wall':self.grid.wall_contour,
@@ -1382,14 +2528,19 @@ class GeometryMatrix:
 
 
     @classmethod
-    def fromfile(cls,filename):
+    def fromfile(cls,filename,mmap=True):
         '''
         Load a saved geometry matrix from disk.
         
         Parameters:
             
-            filename (str)  : File name to load from. Can be a NumPy (.npz), MATLAB (.mat) or \
-                              zipped ASCII (.zip) file.
+            filename (str)  : File name to load from. Can be a Calcam native format (.gmat), NumPy (.npz), \
+                              MATLAB (.mat) or zipped ASCII (.zip) file.
+
+            mmap (bool)     : For uncompressed .gmat files, whether to memory-map the matrix data from \
+                              the file rather than reading it in to memory. This makes loading almost \
+                              instant, and the matrix data are then read from disk as needed. Memory-mapped \
+                              matrix data are read-only.
                              
         Returns:
             
@@ -1403,18 +2554,173 @@ class GeometryMatrix:
         except IndexError:
             raise ValueError('Given file name does not include file extension; extension must be specified to determine file type!')
 
-        if fmt == 'npz':
+        if fmt == 'gmat':
+            geommat._load_native(filename,mmap=mmap)
+        elif fmt == 'npz':
             geommat._load_npz(filename)
         elif fmt == 'mat':
             geommat._load_matlab(filename)
         elif fmt == 'zip':
             geommat._load_txt(filename)
         else:
-            raise ValueError('File extension "{:s}" not understood; should be an "npz", "mat" or "zip" file.'.format(fmt))
+            raise ValueError('File extension "{:s}" not understood; should be a "gmat", "npz", "mat" or "zip" file.'.format(fmt))
 
         return geommat
         
 
+class CombinedGeometryMatrix:
+    '''
+    Class to represent a geometry matrix for several cameras viewing the same reconstruction
+    grid, made by stacking the geometry matrices for the individual cameras. Objects of this
+    class are created by :func:`GeometryMatrix.combine()`.
+
+    The combined matrix is stored as a sparse matrix using the scipy.sparse.csr_matrix class
+    in the `data` attribute, with the rows for each camera in turn.
+    '''
+    def __init__(self,matrices):
+
+        if len(matrices) == 0:
+            raise ValueError('No geometry matrices given to combine!')
+
+        # Identify each grid cell by its vertex coordinates, so the cells of grids which have
+        # had different cells removed can be matched up. The combined grid contains all the cells
+        # used by any of the matrices, numbered in the order they first appear in the input matrices.
+        cell_coords = [matrix.grid.vertices[matrix.grid.cells,:].reshape(matrix.grid.n_cells,-1) for matrix in matrices]
+        if len(set([coords.shape[1] for coords in cell_coords])) > 1:
+            raise ValueError('Cannot combine geometry matrices with different types of grid cells!')
+
+        _,first_inds,cell_inds = np.unique(np.concatenate(cell_coords) + 0.,axis=0,return_index=True,return_inverse=True)
+        cell_order = np.argsort(first_inds)
+        cell_numbers = np.empty(cell_order.size,dtype=np.uint32)
+        cell_numbers[cell_order] = np.arange(cell_order.size)
+        cell_inds = cell_numbers[cell_inds.reshape(-1)]
+
+        all_verts = np.concatenate(cell_coords)[first_inds[cell_order],:].reshape(-1,2)
+        vertices,vert_inds = np.unique(all_verts,axis=0,return_inverse=True)
+        cells = vert_inds.reshape(cell_order.size,-1)
+
+        self.grid = PoloidalVolumeGrid(vertices,cells,matrices[0].grid.wall_contour,src=matrices[0].history['grid'])
+        '''
+        calcam.gm.PoloidalVolumeGrid : The inversion grid associated with the combined geometry matrix.
+        '''
+
+        # Stack the matrices, with their column indices changed to the combined grid cell numbering.
+        blocks = []
+        self.row_ranges = []
+        '''
+        list of tuples : The (start, stop) row indices of the rows for each camera in the combined matrix.
+        '''
+        first_cell = 0
+        first_row = 0
+        for matrix in matrices:
+            col_map = cell_inds[first_cell:first_cell + matrix.grid.n_cells]
+            data = matrix.data.tocsr()
+            blocks.append(scipy.sparse.csr_matrix((data.data,col_map[data.indices],data.indptr),shape=(data.shape[0],self.grid.n_cells)))
+            self.row_ranges.append((first_row,first_row + data.shape[0]))
+            first_cell = first_cell + matrix.grid.n_cells
+            first_row = first_row + data.shape[0]
+
+        self.data = scipy.sparse.vstack(blocks,format='csr')
+        '''
+        scipy.sparse.csr_matrix : The combined geometry matrix data.
+        '''
+
+        # Keep copies of the individual matrices for formatting and un-formatting images.
+        # These are shallow copies, so do not use any extra memory for the matrix data.
+        self.matrices = [copy.copy(matrix) for matrix in matrices]
+
+        self.history = {'los':[matrix.history['los'] for matrix in matrices],'grid':self.grid.history,'matrix':'Combined from {:d} geometry matrices by {:s} on {:s} at {:s}'.format(len(matrices),misc.username,misc.hostname,misc.get_formatted_time())}
+
+
+    @property
+    def pixel_masks(self):
+        '''
+        List of the pixel masks for each camera. See :func:`GeometryMatrix.get_included_pixels`.
+        '''
+        return [matrix.pixel_mask for matrix in self.matrices]
+
+
+    def get_los_coverage(self):
+        '''
+        Get the number of lines of sight, from all cameras, viewing each grid element.
+        
+        Returns:
+            
+            numpy.ndarray : Vector with as many elements as there grid cells, \
+                            with values being how many sight-lines interact with \
+                            that grid element.
+        '''
+        return np.diff(self.data.tocsc().indptr)
+
+
+    def format_image(self,images,coords=None):
+        '''
+        Format a set of camera images, one from each camera, in to a 1D data
+        vector for use with the combined geometry matrix. Each camera's image is
+        formatted as by :func:`GeometryMatrix.format_image`.
+
+        Parameters:
+
+            images (list of numpy.ndarray) : Images from each camera, in the same order as the matrices \
+                                             were combined. These can be single 2D images or \
+                                             3D (n_frames x h x w) stacks of images, with the same \
+                                             number of frames for each camera.
+
+            coords (str or list)           : Either 'Display' or 'Original', or a list with one of these \
+                                             for each camera, specifying the orientation of the input \
+                                             images. If not given, it will be auto-detected if possible.
+
+        Returns:
+
+            scipy.sparse.csr_matrix or numpy.ndarray : For single images, a 1xN_pixels image data vector. For stacks of \
+                                                       images, a dense N_frames x N_pixels array with one image data \
+                                                       vector per row.
+        '''
+        if len(images) != len(self.matrices):
+            raise ValueError('Got {:d} images but this geometry matrix is for {:d} cameras!'.format(len(images),len(self.matrices)))
+
+        if coords is None or isinstance(coords,str):
+            coords = [coords] * len(self.matrices)
+
+        data = [matrix.format_image(image,coords=im_coords) for matrix,image,im_coords in zip(self.matrices,images,coords)]
+
+        if scipy.sparse.issparse(data[0]):
+            return scipy.sparse.hstack(data,format='csr')
+        else:
+            return np.hstack(data)
+
+
+    def unformat_image(self,im_vector,coords='Native',fill_value=np.nan):
+        '''
+        Formats a 1D data vector of image pixel values for the combined matrix
+        back in to the 2D images for each camera.
+
+        Parameters:
+
+            im_vector (numpy.ndarray or sparse matrix) : 1D vector of image data, must have length equal to the number of rows in the geometry matrix.
+
+            coords (str)                               : What image orientation to return the images: 'Original', 'Display' or 'Native' (whichever was used when creating each geometry matrix).
+
+            fill_value (float)                         : Value to return in any image pixels which are not included in the geometry matrix.
+
+        Returns:
+
+            list of numpy.ndarray : 2D arrays containing the image from each camera.
+        '''
+        try:
+            im_vector = im_vector.toarray()
+        except AttributeError:
+            im_vector = np.array(im_vector)
+
+        im_vector = np.squeeze(im_vector)
+
+        if im_vector.size != self.data.shape[0]:
+            raise ValueError('Provided image data vector is not the correct size - expected {:d} values, got {:d}'.format(self.data.shape[0],im_vector.size))
+
+        return [matrix.unformat_image(im_vector[start:stop],coords=coords,fill_value=fill_value) for matrix,(start,stop) in zip(self.matrices,self.row_ranges)]
+
+
+
 def squaregrid(wall_contour,cell_size,rmin=None,rmax=None,zmin=None,zmax=None):
     '''
     Create a reconstruction grid with square grid cells.
@@ -1479,38 +2785,26 @@ def squaregrid(wall_contour,cell_size,rmin=None,rmax=None,zmin=None,zmax=None):
 
     wall_path = mplpath.Path(np.vstack((wall_contour,wall_contour[-1,:])),closed=True)
 
-    vertices = np.zeros((nr * nz,2))
-    cells = np.zeros( ( (nr-1)*(nz-1) , 4 ),dtype=np.uint32 )
-
-    cell_ind = 0
-    vert_ind = 0
-
-    _verts = np.zeros((4,2))
+    # Which grid lattice points are inside the wall
+    Rgrid,Zgrid = np.meshgrid(Rpts,Zpts)
+    inside = wall_path.contains_points(np.vstack((Rgrid.flatten(),Zgrid.flatten())).T).reshape(nz,nr)
 
-    for iz in range(Zpts.size-1):
-        for ir in range(Rpts.size-1):
+    # Lattice point indices of the 4 corners of each square grid cell,
+    # for the cells which are not completely outside the wall.
+    iz,ir = np.meshgrid(np.arange(nz-1),np.arange(nr-1),indexing='ij')
+    corners = np.stack( (iz*nr + ir, iz*nr + ir + 1, (iz+1)*nr + ir + 1, (iz+1)*nr + ir), axis=-1).reshape(-1,4)
+    corners = corners[inside.flatten()[corners].any(axis=1),:]
 
-            # 4 corners of the square grid cell
-            _verts[0,:] = [Rpts[ir],Zpts[iz]]
-            _verts[1,:] = [Rpts[ir+1],Zpts[iz]]
-            _verts[2,:] = [Rpts[ir+1],Zpts[iz+1]]
-            _verts[3,:] = [Rpts[ir],Zpts[iz+1]]
+    # Number the vertices in the order they are first used by the cells.
+    lattice_inds,first_inds,vert_inds = np.unique(corners,return_index=True,return_inverse=True)
+    vert_order = np.argsort(first_inds)
+    vert_numbers = np.empty(vert_order.size,dtype=np.uint32)
+    vert_numbers[vert_order] = np.arange(vert_order.size)
 
-            # If the cell is completely outside the wall, don't bother.
-            if not np.any(wall_path.contains_points(_verts)):
-                continue
+    cells = vert_numbers[vert_inds.reshape(-1)].reshape(corners.shape)
+    vertices = np.vstack( (Rgrid.flatten()[lattice_inds[vert_order]], Zgrid.flatten()[lattice_inds[vert_order]]) ).T
 
-            for vert in range(4):
-                try:
-                    cells[cell_ind][vert] = np.where( (vertices[:,0] == _verts[vert,0]) & (vertices[:,1] == _verts[vert,1]) )[0][0]
-                except IndexError:
-                    vertices[vert_ind,:] = _verts[vert,:]
-                    cells[cell_ind][vert] = vert_ind
-                    vert_ind += 1
-            cell_ind += 1
-
-    
-    return PoloidalVolumeGrid(vertices[:vert_ind,:],cells[:cell_ind,:],wall_contour,src='Square grid with {:.1f}cm cells generated using squaregrid()'.format(cell_size*1e2))
+    return PoloidalVolumeGrid(vertices,cells,wall_contour,src='Square grid with {:.1f}cm cells generated using squaregrid()'.format(cell_size*1e2))
 
 
 
@@ -1667,54 +2961,41 @@ def solps_grid(solps_file,wall_contour,rmin=None,rmax=None,zmin=None,zmax=None,c
     if np.abs(wall_contour[0,:] - wall_contour[-1,:]).max() < 1e-15:
         wall_contour = wall_contour[:-1]
 
-    vertices = []
-    cells = []
-    centres = []
-    pol_inds = []
-    rad_inds = []
-
     with open(solps_file,'r') as f:
 
         npol,nrad = [int(n)+2 for n in f.readline().split()]
 
         ncells = npol*nrad
 
-        for index in range(ncells):
-
-            row = np.array([float(d) for d in f.readline().split()])
-
-            pol,rad = np.array(row[0:2])  # Poloidal and radial index on SOLPS grid
-            R,Z = row[4:12:2], row[5:13:2]
-            cell_centre = row[2:4]
-
-            if not pol in pol_inds and not rad in rad_inds:
-                if rmin and cell_centre[0] < rmin:
-                    continue
-                if rmax and cell_centre[0] > rmax:
-                    continue
-                if zmin and cell_centre[1] < zmin:
-                    continue
-                if zmax and cell_centre[1] > zmax:
-                    continue
-
-            pol_inds.append(pol)
-            rad_inds.append(rad)
-
-            verts = list(zip(R,Z))
-            indices = []
-            for vert in verts:
-                if vert in vertices:
-                    indices.append(vertices.index(vert))
-                else:
-                    vertices.append(vert)
-                    indices.append(vertices.index(vert))
-            cells.append(indices)
-            centres.append(cell_centre)
-
-    vertices = np.array(vertices)
-    cell_info = np.column_stack((pol_inds,rad_inds, centres, cells))
-    cell_info = cell_info[cell_info[:,0].argsort()]
-    cell_info = cell_info[cell_info[:,1].argsort(kind='mergesort')]
+        # Each row contains: poloidal and radial index on SOLPS grid, R,Z of cell centre, R,Z of the 4 cell vertices.
+        rows = np.loadtxt(f,max_rows=ncells,ndmin=2)
+
+    # Apply any R,Z limits based on the cell centres
+    keep = np.ones(rows.shape[0],dtype=bool)
+    if rmin is not None:
+        keep = keep & (rows[:,2] >= rmin)
+    if rmax is not None:
+        keep = keep & (rows[:,2] <= rmax)
+    if zmin is not None:
+        keep = keep & (rows[:,3] >= zmin)
+    if zmax is not None:
+        keep = keep & (rows[:,3] <= zmax)
+    rows = rows[keep,:]
+
+    # Find the unique vertices, numbered in the order they first appear in the file.
+    # Adding 0 makes sure any -0.0 values are treated the same as 0.0.
+    cell_verts = np.stack((rows[:,4:12:2],rows[:,5:13:2]),axis=-1).reshape(-1,2) + 0.
+    unique_verts,first_inds,vert_inds = np.unique(cell_verts,axis=0,return_index=True,return_inverse=True)
+    vert_order = np.argsort(first_inds)
+    vert_numbers = np.empty(vert_order.size,dtype=int)
+    vert_numbers[vert_order] = np.arange(vert_order.size)
+
+    vertices = unique_verts[vert_order,:]
+    cells = vert_numbers[vert_inds.reshape(-1)].reshape(-1,4)
+
+    # Sort the cells by radial then poloidal index
+    cell_info = np.column_stack((rows[:,:4], cells))
+    cell_info = cell_info[np.lexsort((cell_info[:,0],cell_info[:,1]))]
 
     cell_info[:, [-2,-1]] = cell_info[:,[-1,-2]]  # Swap coords order to match Calcam convention
 
@@ -1756,6 +3037,85 @@ def _get_ccm_wall(model_name):
 
 
 
+def _get_gm_fingerprint(grid,ray_start_coords,ray_end_coords,los_inds):
+    '''
+    Get a string identifying a geometry matrix calculation, for checking that a
+    checkpoint file belongs to the calculation being done.
+    '''
+    hasher = hashlib.sha1()
+    for arr in [grid.vertices,grid.cells,ray_start_coords,ray_end_coords,los_inds]:
+        hasher.update(np.ascontiguousarray(arr).tobytes())
+
+    return hasher.hexdigest()
+
+
+
+def _init_gm_worker(grid,ray_endpoints):
+    '''
+    Initialiser for geometry matrix calculation worker processes.
+    Stores the grid and sight-line coordinates in the worker, so
+    they only need to be sent to each worker once.
+
+    Parameters:
+
+        grid (calcam.gm.PoloidalVolumeGrid) : Reconstruction grid
+
+        ray_endpoints (numpy.ndarray)       : N x 6 array containing the start and end coordinates \
+                                              of all the sight-lines: (Xstart, Ystart, Zstart, Xend, Yend, Zend), \
+                                              or None if sight-lines will be sent with each task.
+    '''
+    global _worker_matrix, _worker_ray_endpoints
+
+    _worker_matrix = GeometryMatrix(None,None)
+    _worker_matrix.grid = grid
+    _worker_ray_endpoints = ray_endpoints
+
+
+
+def _calc_rows_worker(block):
+    '''
+    Calculate the geometry matrix elements for a block of sight-lines, in a worker
+    process set up by _init_gm_worker().
+
+    Parameters:
+
+        block (tuple) : Start and end indices of the sight-lines to calculate.
+
+    Returns:
+
+        tuple : The input block, and a tuple of the sight-line indices, grid cell indices \
+                and values of the matrix elements.
+    '''
+    rows,cols,data = _worker_matrix._calc_rows_volume(_worker_ray_endpoints[block[0]:block[1],:])
+
+    return block,(rows + block[0],cols,data)
+
+
+
+def _calc_tile_worker(start,ray_endpoints,rays_per_row=1):
+    '''
+    Calculate the geometry matrix elements for a tile of sight-lines sent
+    to a worker process set up by _init_gm_worker().
+
+    Parameters:
+
+        start (int)                   : Index of the first matrix row in the tile.
+
+        ray_endpoints (numpy.ndarray) : N x 6 array containing the start and end coordinates \
+                                        of the sight-lines in the tile.
+
+        rays_per_row (int)            : Number of consecutive sight-lines to average in to each matrix row.
+
+    Returns:
+
+        tuple : Matrix row indices, grid cell indices and values of the matrix elements.
+    '''
+    rows,cols,data = _worker_matrix._calc_rows_volume(ray_endpoints,rays_per_row)
+
+    return rows + start,cols,data
+
+
+
 def _run_triangle_python(geometry,queue,**kwargs):
     '''
     Run triangular mesh generation with the triangle library via MeshPy module.
@@ -1799,8 +3159,149 @@ def _run_triangle_python(geometry,queue,**kwargs):
 
 
 
+def _load_npz_arrays(filename,mmap=False):
+    '''
+    Load the arrays from a NumPy .npz format file. Unlike numpy.load(), this 
+    can memory-map arrays which are stored in the file without compression.
+
+    Parameters:
+
+        filename (str) : Name of the file to load.
+
+        mmap (bool)    : Whether to memory-map uncompressed arrays (read-only) \
+                         instead of reading them in to memory.
+
+    Returns:
+
+        dict : The loaded arrays, keyed by array name.
+    '''
+    arrays = {}
+
+    with zipfile.ZipFile(filename,'r') as zfile, open(filename,'rb') as f:
+
+        for info in zfile.infolist():
+
+            name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+
+            if mmap and info.compress_type == zipfile.ZIP_STORED:
+
+                # The array data starts after the zip member's local header and the .npy header.
+                f.seek(info.header_offset)
+                local_header = f.read(30)
+                name_length,extra_length = struct.unpack('<HH',local_header[26:30])
+                f.seek(info.header_offset + 30 + name_length + extra_length)
+
+                version = np.lib.format.read_magic(f)
+                if version == (1,0):
+                    shape,fortran_order,dtype = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape,fortran_order,dtype = np.lib.format.read_array_header_2_0(f)
+
+                if len(shape) > 0 and np.prod(shape) > 0 and not dtype.hasobject:
+                    arrays[name] = np.memmap(filename,dtype=dtype,mode='r',offset=f.tell(),shape=shape,order='F' if fortran_order else 'C')
+                    continue
+
+            with zfile.open(info) as member:
+                arrays[name] = np.lib.format.read_array(member)
+
+    return arrays
+
+
+
+def _expand_ranges(starts,counts):
+    '''
+    Expand a set of integer ranges, given by their start values and lengths,
+    in to a single array listing all the values in all the ranges.
+
+    Returns:
+
+        tuple : Array of the index of the range each value came from, and \
+                array of the values.
+    '''
+    range_inds = np.repeat(np.arange(len(counts)),counts)
+    offsets = np.arange(range_inds.size) - np.repeat(np.cumsum(counts) - counts,counts)
+
+    return range_inds,np.repeat(starts,counts) + offsets
+
+
+
+def _get_index_dtype(*dims):
+    '''
+    Get the integer type to use for sparse matrix row and column indices,
+    which is 32-bit whenever the matrix dimensions allow, as in SciPy.
+
+    Parameters:
+
+        dims (int) : Matrix dimensions.
+
+    Returns:
+
+        numpy.dtype : Index data type.
+    '''
+    if max(dims) < 2**31:
+        return np.dtype(np.int32)
+    else:
+        return np.dtype(np.int64)
+
+
+
+def _get_binning_operator(shape,bin_factor,pixel_order,in_mask=None,out_mask=None):
+    '''
+    Get a sparse matrix which bins a flattened image, or geometry matrix rows, by averaging
+    blocks of bin_factor x bin_factor pixels. Any pixels left over at the right or bottom
+    edges of the image, when the image size is not a multiple of bin_factor, are dropped.
+
+    Parameters:
+
+        shape (tuple)            : Shape (h x w) of the image before binning.
+
+        bin_factor (int)         : Binning factor.
+
+        pixel_order (str)        : Pixel order used to flatten the images, 'C' or 'F'.
+
+        in_mask (numpy.ndarray)  : Boolean mask of which input pixels are present in the input vector. \
+                                   If not given, all input pixels are assumed present.
+
+        out_mask (numpy.ndarray) : Boolean mask of which binned pixels to include in the output. \
+                                   If not given, all binned pixels are included.
+
+    Returns:
+
+        scipy.sparse.csr_matrix : N_binned_pixels x N_input_pixels binning operator.
+    '''
+    out_shape = (shape[0] // bin_factor,shape[1] // bin_factor)
+
+    # Index of each pixel in the flattened input and output images
+    in_inds = np.arange(shape[0]*shape[1]).reshape(shape,order=pixel_order)[:out_shape[0]*bin_factor,:out_shape[1]*bin_factor]
+    out_inds = np.arange(out_shape[0]*out_shape[1]).reshape(out_shape,order=pixel_order)
+    out_inds = np.repeat(np.repeat(out_inds,bin_factor,axis=0),bin_factor,axis=1)
+
+    in_inds = in_inds.flatten()
+    out_inds = out_inds.flatten()
+    n_in = shape[0]*shape[1]
+    n_out = out_shape[0]*out_shape[1]
+
+    # Convert to indices in to the vectors with the masked pixels removed
+    if in_mask is not None:
+        in_mask = in_mask.reshape(in_mask.size,order=pixel_order)
+        keep = in_mask[in_inds]
+        in_inds = (np.cumsum(in_mask) - 1)[in_inds[keep]]
+        out_inds = out_inds[keep]
+        n_in = np.count_nonzero(in_mask)
+
+    if out_mask is not None:
+        out_mask = out_mask.reshape(out_mask.size,order=pixel_order)
+        keep = out_mask[out_inds]
+        out_inds = (np.cumsum(out_mask) - 1)[out_inds[keep]]
+        in_inds = in_inds[keep]
+        n_out = np.count_nonzero(out_mask)
+
+    return scipy.sparse.csr_matrix((np.full(in_inds.size,1./bin_factor**2),(out_inds,in_inds)),shape=(n_out,n_in))
+
+
+
 def _bin_image(image,bin_factor,bin_func=np.mean):
 
-    newshape = ( image.shape[0] // bin_factor, bin_factor, image.shape[1] // bin_factor, bin_factor )
-    newshape = np.array(newshape,dtype=int)
-    return bin_func( bin_func( image.reshape(newshape),axis=3 ) ,axis=1 )
+    # Binning is done over the last 2 dimensions, so this also works for stacks of images.
+    newshape = image.shape[:-2] + ( image.shape[-2] // bin_factor, bin_factor, image.shape[-1] // bin_factor, bin_factor )
+    return bin_func( bin_func( image.reshape(newshape),axis=-1 ) ,axis=-2 )
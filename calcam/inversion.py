@@ -0,0 +1,256 @@
+'''
+* Copyright 2015-2024 European Atomic Energy Community (EURATOM)
+*
+* Licensed under the EUPL, Version 1.1 or - as soon they
+will be approved by the European Commission - subsequent
+versions of the EUPL (the "Licence");
+* You may not use this work except in compliance with the
+Licence.
+* You may obtain a copy of the Licence at:
+*
+* https://joinup.ec.europa.eu/software/page/eupl
+*
+* Unless required by applicable law or agreed to in
+writing, software distributed under the Licence is
+distributed on an "AS IS" basis,
+* WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+express or implied.
+* See the Licence for the specific language governing
+permissions and limitations under the Licence.
+'''
+
+
+"""
+Module for tomographic inversion of camera images using geometry matrices.
+The solvers do as much of the work as possible once when they are created,
+so that many frames can then be inverted quickly with the same geometry matrix.
+"""
+import concurrent.futures
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+
+from . import config
+
+
+def laplacian(grid):
+    '''
+    Get a discrete Laplacian operator for a reconstruction grid, based on which
+    grid cells share sides with each other. This is the graph Laplacian of the grid
+    cells, i.e. for each cell the result is the sum of the differences between the
+    value in that cell and the values in the neighbouring cells.
+
+    Parameters:
+
+        grid (calcam.gm.PoloidalVolumeGrid) : Reconstruction grid.
+
+    Returns:
+
+        scipy.sparse.csr_matrix : N_cells x N_cells Laplacian operator.
+    '''
+    # Pairs of cells sharing each grid segment
+    cell_a = []
+    cell_b = []
+    for col_a in range(grid.segment_cells.shape[1]):
+        for col_b in range(col_a + 1,grid.segment_cells.shape[1]):
+            shared = (grid.segment_cells[:,col_a] >= 0) & (grid.segment_cells[:,col_b] >= 0)
+            cell_a.append(grid.segment_cells[shared,col_a])
+            cell_b.append(grid.segment_cells[shared,col_b])
+    cell_a = np.concatenate(cell_a)
+    cell_b = np.concatenate(cell_b)
+
+    adjacency = scipy.sparse.csr_matrix((np.ones(2*cell_a.size),(np.concatenate((cell_a,cell_b)),np.concatenate((cell_b,cell_a)))),shape=(grid.n_cells,grid.n_cells))
+
+    # Cells sharing more than one side are still only counted as neighbours once.
+    adjacency.data[:] = 1.
+
+    n_neighbours = np.array(adjacency.sum(axis=1)).flatten()
+
+    return (scipy.sparse.diags(n_neighbours) - adjacency).tocsr()
+
+
+
+class _Inversion:
+    '''
+    Base class for inversion solvers, which takes care of formatting the
+    input images and splitting the frames between threads.
+    '''
+    def __init__(self,geom_mat):
+
+        self.geom_mat = geom_mat
+        self._matrix = geom_mat.data.tocsr()
+
+
+    def invert(self,image,coords=None,n_threads=None):
+        '''
+        Invert a camera image or a stack of camera images.
+
+        Parameters:
+
+            image (numpy.ndarray) : Either a single 2D image or a 3D (n_frames x h x w) stack of images \
+                                    to invert, as accepted by :func:`calcam.gm.GeometryMatrix.format_image`. \
+                                    For a combined multi-camera geometry matrix, a list of these for each camera.
+
+            coords (str)          : Either 'Display' or 'Original', the orientation of the input \
+                                    image(s). If not given, it will be auto-detected if possible.
+
+            n_threads (int)       : Number of threads to use for inverting stacks of images; the frames \
+                                    are split between the threads. Default is calcam.config.n_cpus.
+
+        Returns:
+
+            numpy.ndarray : For a single image, a 1D array of the inversion result in each grid cell, which can be \
+                            plotted with :func:`calcam.gm.PoloidalVolumeGrid.plot`. For a stack of images, \
+                            an N_frames x N_cells array containing the result for each frame.
+        '''
+        # Combined geometry matrices for multiple cameras take a list of images.
+        if isinstance(image,(list,tuple)):
+            stack = len(image[0].shape) == 3
+        else:
+            stack = len(image.shape) == 3
+
+        image_data = self.geom_mat.format_image(image,coords=coords)
+        if stack:
+            image_data = image_data.T
+        else:
+            image_data = image_data.toarray().T
+
+        if n_threads is None:
+            n_threads = config.n_cpus
+
+        n_threads = max(1,min(n_threads,image_data.shape[1]))
+
+        if n_threads == 1:
+            result = self._solve(image_data)
+        else:
+            chunks = np.array_split(np.arange(image_data.shape[1]),n_threads)
+            with concurrent.futures.ThreadPoolExecutor(n_threads) as pool:
+                result = np.hstack(list(pool.map(lambda chunk: self._solve(image_data[:,chunk]),chunks)))
+
+        if stack:
+            return result.T
+        else:
+            return result[:,0]
+
+
+    def _solve(self,image_data):
+        '''
+        Solve for the grid cell values given an N_pixels x N_frames array of image data.
+        '''
+        raise NotImplementedError()
+
+
+
+class TikhonovInversion(_Inversion):
+    '''
+    Tomographic inversion by Tikhonov regularised least squares, i.e. finding
+    the emissivity :math:`x` which minimises :math:`||Ax - b||^2 + \\alpha||Lx||^2`,
+    where :math:`A` is the geometry matrix, :math:`b` is the image data and
+    :math:`L` is the regularisation operator.
+
+    The regularised normal equations matrix :math:`A^TA + \\alpha L^TL` is calculated
+    and factorised once when the object is created, after which each frame only needs
+    a pair of sparse triangular solves. All the frames given to :func:`invert` are solved
+    together as one problem with multiple right-hand sides.
+
+    Parameters:
+
+        geom_mat (calcam.gm.GeometryMatrix) : Geometry matrix to use. Can also be a combined \
+                                              multi-camera calcam.gm.CombinedGeometryMatrix.
+
+        alpha (float)                       : Regularisation parameter.
+
+        regularisation (str)                : Regularisation operator to use: 'laplacian' to penalise \
+                                              the Laplacian of the emissivity (see :func:`laplacian`), \
+                                              giving smooth results, or 'identity' to penalise the \
+                                              emissivity itself.
+    '''
+    def __init__(self,geom_mat,alpha,regularisation='laplacian'):
+
+        super().__init__(geom_mat)
+
+        self.alpha = alpha
+
+        if regularisation.lower() == 'laplacian':
+            reg_operator = laplacian(geom_mat.grid)
+        elif regularisation.lower() == 'identity':
+            reg_operator = scipy.sparse.identity(geom_mat.grid.n_cells,format='csr')
+        else:
+            raise ValueError('Unknown regularisation "{:s}"; options are "laplacian" or "identity".'.format(regularisation))
+
+        # The normal equations are always formed in double precision, since accumulating
+        # the products of single precision geometry matrix elements loses accuracy.
+        matrix = self._matrix.astype(np.float64,copy=False)
+        normal_matrix = (matrix.T @ matrix + alpha * (reg_operator.T @ reg_operator)).tocsc()
+
+        self._factorisation = scipy.sparse.linalg.splu(normal_matrix,permc_spec='MMD_AT_PLUS_A')
+
+
+    def _solve(self,image_data):
+
+        return self._factorisation.solve(np.asarray(self._matrix.T @ image_data,dtype=self._factorisation.U.dtype))
+
+
+
+class SARTInversion(_Inversion):
+    '''
+    Tomographic inversion using the Simultaneous Algebraic Reconstruction Technique (SART).
+
+    Starting from zero, the result is updated each iteration by back-projecting the
+    difference between the measured image data and the forward projection of the
+    current result, normalised by the matrix row and column sums. With n_subsets = 1,
+    all the matrix rows are used together in each update (SIRT); otherwise the rows
+    are split in to interleaved subsets which are used for successive updates (ordered
+    subsets SART), which usually converges in fewer iterations.
+
+    All the frames given to :func:`invert` are iterated together as one problem with
+    multiple right-hand sides.
+
+    Parameters:
+
+        geom_mat (calcam.gm.GeometryMatrix) : Geometry matrix to use. Can also be a combined \
+                                              multi-camera calcam.gm.CombinedGeometryMatrix.
+
+        n_iterations (int)                  : Number of iterations to do, each one using all the subsets once.
+
+        relaxation (float)                  : Relaxation factor for the updates, between 0 and 2.
+
+        n_subsets (int)                     : Number of subsets to split the matrix rows in to.
+
+        nonnegative (bool)                  : Whether to constrain the result to be non-negative.
+    '''
+    def __init__(self,geom_mat,n_iterations=50,relaxation=1.,n_subsets=1,nonnegative=True):
+
+        super().__init__(geom_mat)
+
+        self.n_iterations = n_iterations
+        self.relaxation = relaxation
+        self.nonnegative = nonnegative
+
+        # Pre-calculate the matrix for each subset and the row and column sum normalisations.
+        self._subsets = []
+        for subset in range(n_subsets):
+            rows = np.arange(subset,self._matrix.shape[0],n_subsets)
+            sub_matrix = self._matrix[rows,:]
+            row_sums = np.array(sub_matrix.sum(axis=1)).flatten()
+            col_sums = np.array(sub_matrix.sum(axis=0)).flatten()
+            row_weights = np.divide(1.,row_sums,out=np.zeros(row_sums.shape),where=row_sums > 0)
+            col_weights = np.divide(1.,col_sums,out=np.zeros(col_sums.shape),where=col_sums > 0)
+            self._subsets.append((rows,sub_matrix,sub_matrix.T.tocsr(),row_weights[:,np.newaxis],col_weights[:,np.newaxis]))
+
+
+    def _solve(self,image_data):
+
+        result = np.zeros((self._matrix.shape[1],image_data.shape[1]))
+
+        for iteration in range(self.n_iterations):
+            for rows,sub_matrix,sub_matrix_t,row_weights,col_weights in self._subsets:
+
+                residual = (image_data[rows,:] - sub_matrix @ result) * row_weights
+                result = result + self.relaxation * col_weights * (sub_matrix_t @ residual)
+
+                if self.nonnegative:
+                    result = np.maximum(result,0.)
+
+        return result
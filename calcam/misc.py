@@ -97,6 +97,41 @@ def rotate_3d(vect,axis,angle):
 
 
 
+def rodrigues_to_matrix(rvecs):
+    '''
+    Convert rotation vectors, as used by OpenCV, to rotation matrices.
+    Equivalent to cv2.Rodrigues but for any number of rotation vectors at once.
+
+    Parameters:
+
+        rvecs (np.ndarray) : Array of rotation vectors with shape (..., 3).
+
+    Returns:
+
+        np.ndarray : Array of rotation matrices with shape (..., 3, 3)
+    '''
+    rvecs = np.asarray(rvecs,dtype=np.float64)
+
+    theta = np.sqrt(np.sum(rvecs**2,axis=-1))
+    with np.errstate(divide='ignore',invalid='ignore'):
+        axis = rvecs / theta[...,np.newaxis]
+    axis[theta == 0,:] = 0.
+
+    cos = np.cos(theta)[...,np.newaxis,np.newaxis]
+    sin = np.sin(theta)[...,np.newaxis,np.newaxis]
+
+    cross = np.zeros(rvecs.shape + (3,))
+    cross[...,0,1] = -axis[...,2]
+    cross[...,0,2] = axis[...,1]
+    cross[...,1,0] = axis[...,2]
+    cross[...,1,2] = -axis[...,0]
+    cross[...,2,0] = -axis[...,1]
+    cross[...,2,1] = axis[...,0]
+
+    return cos * np.eye(3) + sin * cross + (1 - cos) * axis[...,:,np.newaxis] * axis[...,np.newaxis,:]
+
+
+
 class ColourCycle():
     '''
     A class to represent a colour cycle,
@@ -279,7 +314,7 @@ class LoopProgPrinter:
             self.end_printed = True
 
 
-def bin_image(arr, factor,binfunc=np.mean):
+def bin_image(arr, factor,binfunc=np.mean,stack=False):
     """
     Bin an image by the given factor.
 
@@ -288,6 +323,8 @@ def bin_image(arr, factor,binfunc=np.mean):
         arr     (array)    :  Input image / array for binning
         factor  (int)      :  Factor by which to bin, e.g. factor=2 would be 2x2 binning.
         binfunc (callable) :  Function to bin with, Numpy ufunc-style. Default is mean.
+        stack   (bool)     :  If True, the input is treated as a stack of images where the first \
+                              array dimension is the frame index, e.g. an (n_frames x h x w) array.
 
     Returns:
 
@@ -296,19 +333,21 @@ def bin_image(arr, factor,binfunc=np.mean):
     """
     factor = int(factor)
 
-    if arr.shape[0] % factor or arr.shape[1] % factor:
-        raise ValueError('The binning factor {:d} is not an integer factor of the array dimensions {:d}x{:d}!'.format(factor,arr.shape[1],arr.shape[0]))
+    # Index of the image y axis in the array
+    yax = 1 if stack else 0
+
+    if arr.shape[yax] % factor or arr.shape[yax+1] % factor:
+        raise ValueError('The binning factor {:d} is not an integer factor of the array dimensions {:d}x{:d}!'.format(factor,arr.shape[yax+1],arr.shape[yax]))
+
+    shape = arr.shape[:yax] + (arr.shape[yax]//factor, factor, arr.shape[yax+1]//factor, factor) + arr.shape[yax+2:]
+
+    out = binfunc(binfunc(arr.reshape(shape), axis=yax+3), axis=yax+1)
 
-    shape = (arr.shape[0]//factor, factor,
-             arr.shape[1]//factor, factor)
+    # Images with colour channels keep their data type.
+    if len(arr.shape) - yax == 3:
+        out = out.astype(arr.dtype)
 
-    if len(arr.shape) == 2:
-        return binfunc(binfunc(arr.reshape(shape), axis=-1), axis=1)
-    elif len(arr.shape) == 3:
-        out = np.zeros((arr.shape[0] // factor, arr.shape[1] // factor) + arr.shape[2:], dtype=arr.dtype)
-        for channel in range(arr.shape[2]):
-            out[:,:,channel] = bin_image(arr[:,:,channel],factor,binfunc)
-        return out
+    return out
 
 
 def import_source(source_path):
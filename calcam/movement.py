@@ -27,6 +27,7 @@ in a collaboration between UKAEA and University College London.
 """
 import copy
 import json
+import os
 
 import numpy as np
 import cv2
@@ -34,6 +35,7 @@ import cv2
 from .pointpairs import PointPairs
 from .calibration import Calibration, Fitter
 from . import misc
+from .io import ZipSaveFile
 from .image_enhancement import enhance_image, scale_to_8bit
 
 
@@ -313,6 +315,41 @@ def phase_correlation_movement(ref,moved):
     return mov_correction
 
 
+def _move_pointpairs(calibration, mov_correction, coords='Display'):
+    """
+    Get a copy of a calibration's point pairs with the image points moved according to a movement correction.
+    Points which move off the image are removed.
+    """
+    old_pp = calibration.pointpairs
+    new_pp = PointPairs()
+
+    pos_lim = np.array(calibration.geometry.get_display_shape()) - 0.5
+    for i in range(old_pp.get_n_pointpairs()):
+        pp = []
+        for subview in range(calibration.n_subviews):
+            if old_pp.image_points[i][subview] is not None:
+                if coords.lower() == 'display':
+                    new_coords = mov_correction.ref_to_moved_coords(*old_pp.image_points[i][subview])
+                elif coords.lower() == 'original':
+                    orig_coords = calibration.geometry.display_to_original_coords(*old_pp.image_points[i][subview])
+                    new_coords = mov_correction.ref_to_moved_coords(*orig_coords)
+                    new_coords = calibration.geometry.original_to_display_coords(*new_coords)
+
+                if np.all( np.array(new_coords) >= 0) and np.all(np.array(new_coords) < pos_lim):
+                    pp.append(new_coords)
+                else:
+                    pp.append(None)
+            else:
+                pp.append(None)
+
+        if all(p is None for p in pp):
+            continue
+        else:
+            new_pp.add_pointpair(old_pp.object_points[i], pp)
+
+    return new_pp
+
+
 def update_calibration(calibration, moved_image, mov_correction, image_src=None, coords='Display'):
     """
     Update a given calibration to account for image movement. This currently only supports
@@ -364,32 +401,7 @@ def update_calibration(calibration, moved_image, mov_correction, image_src=None,
     new_calib.set_image(moved_image, image_src, coords='Display', transform_actions=calibration.geometry.get_transform_actions(), subview_mask=subview_mask, pixel_aspect=calibration.geometry.pixel_aspectratio, subview_names=subview_names, pixel_size=calibration.pixel_size, offset=calibration.geometry.offset)
 
     # Update point pairs
-    old_pp = calibration.pointpairs
-    new_pp = PointPairs()
-
-    pos_lim = np.array(calibration.geometry.get_display_shape()) - 0.5
-    for i in range(old_pp.get_n_pointpairs()):
-        pp = []
-        for subview in range(calibration.n_subviews):
-            if old_pp.image_points[i][subview] is not None:
-                if coords.lower() == 'display':
-                    new_coords = mov_correction.ref_to_moved_coords(*old_pp.image_points[i][subview])
-                elif coords.lower() == 'original':
-                    orig_coords = calibration.geometry.display_to_original_coords(*old_pp.image_points[i][subview])
-                    new_coords = mov_correction.ref_to_moved_coords(*orig_coords)
-                    new_coords = calibration.geometry.original_to_display_coords(*new_coords)
-
-                if np.all( np.array(new_coords) >= 0) and np.all(np.array(new_coords) < pos_lim):
-                    pp.append(new_coords)
-                else:
-                    pp.append(None)
-            else:
-                pp.append(None)
-
-        if all(p is None for p in pp):
-            continue
-        else:
-            new_pp.add_pointpair(old_pp.object_points[i], pp)
+    new_pp = _move_pointpairs(calibration, mov_correction, coords)
 
     new_calib.set_pointpairs(new_pp, history=[calibration.history['pointpairs'][0], 'Updated based on movement correction by {:s} on {:s} at {:s}'.format(misc.username,misc.hostname,misc.get_formatted_time())])
 
@@ -667,6 +679,353 @@ class MovementCorrection:
         return cls(np.matrix(loaded_dict['transform_matrix']),loaded_dict['im_array_shape'],np.array(loaded_dict['ref_points']),np.array(loaded_dict['moved_points']),loaded_dict['history'])
 
 
+class CalibrationSeries:
+    '''
+    Class to represent the calibration of a camera over a series of frames, e.g. during a
+    shot where the camera moves. All frames share the camera intrinsics, sub-view mask and image
+    geometry of a single reference calibration; only the camera extrinsics (position and
+    orientation) are stored for each frame. This is much more compact than keeping a full
+    :class:`calcam.Calibration` per frame, and allows sight-line directions and point projections
+    to be calculated for many frames at once.
+
+    Parameters:
+
+        calibration (calcam.Calibration) : Reference calibration providing the intrinsics, sub-view mask \
+                                           and image geometry for all frames.
+        rvecs (np.ndarray)               : Optional array of shape (n_frames, n_subviews, 3) containing the \
+                                           rotation vectors (OpenCV convention) for each frame and sub-view.
+        tvecs (np.ndarray)               : Optional array of shape (n_frames, n_subviews, 3) containing the \
+                                           translation vectors (OpenCV convention) for each frame and sub-view.
+        history (list of str)            : Optional human-readable description of where each frame's extrinsics came from.
+    '''
+
+    def __init__(self,calibration,rvecs=None,tvecs=None,history=None):
+
+        self.calibration = calibration
+
+        if rvecs is None or tvecs is None:
+            self.rvecs = np.zeros((0,calibration.n_subviews,3))
+            self.tvecs = np.zeros((0,calibration.n_subviews,3))
+        else:
+            self.rvecs = np.array(rvecs,dtype=np.float64)
+            self.tvecs = np.array(tvecs,dtype=np.float64)
+            if self.rvecs.shape != self.tvecs.shape or self.rvecs.shape[1:] != (calibration.n_subviews,3):
+                raise ValueError('rvecs and tvecs must both have shape (n_frames, {:d}, 3) for this calibration!'.format(calibration.n_subviews))
+
+        if history is None:
+            self.history = [None] * self.n_frames
+        else:
+            self.history = list(history)
+
+
+    @property
+    def n_frames(self):
+        '''
+        Number of frames in the series.
+        '''
+        return self.rvecs.shape[0]
+
+
+    def add_frame(self,mov_correction=None,coords='Display',src=None):
+        '''
+        Add a frame to the series. The camera extrinsics for the new frame are found by
+        moving the reference calibration's point pairs according to the given movement correction
+        and re-fitting only the extrinsics, keeping the reference intrinsics fixed.
+        This only supports point fitting calibrations.
+
+        Parameters:
+
+            mov_correction (MovementCorrection) : Movement correction between the reference calibration image and \
+                                                  the image for this frame. If not given, the frame has the same \
+                                                  extrinsics as the reference calibration.
+            coords (string)                     : 'Display' or 'Original', whether the movement correction is \
+                                                  in the calibration's display or original image orientation.
+            src (string)                        : Human-readable description of the frame, for data provenance tracking.
+
+        Returns:
+
+            int : Index of the added frame.
+        '''
+        rvecs = np.zeros((1,self.calibration.n_subviews,3)) + np.nan
+        tvecs = np.zeros((1,self.calibration.n_subviews,3)) + np.nan
+
+        if mov_correction is not None:
+            if self.calibration._type != 'fit':
+                raise ValueError('Adding frames with movement correction only supports point fitting calibrations at the moment!')
+            pointpairs = _move_pointpairs(self.calibration,mov_correction,coords)
+
+        for subview,view_model in enumerate(self.calibration.view_models):
+
+            if view_model is None:
+                continue
+
+            if mov_correction is None:
+                rvecs[0,subview,:] = np.ravel(view_model.rvec)
+                tvecs[0,subview,:] = np.ravel(view_model.tvec)
+                continue
+
+            obj_points,im_points = pointpairs.get_pointpairs(subview)
+            if len(obj_points) < 4:
+                raise ValueError('Not enough point pairs remaining in sub-view {:d} after movement correction to fit the camera position.'.format(subview))
+
+            obj_points = np.array(obj_points,dtype=np.float64)
+            im_points = np.array(im_points,dtype=np.float64)
+
+            if view_model.model == 'fisheye':
+                im_points = cv2.fisheye.undistortPoints(im_points[:,np.newaxis,:],view_model.cam_matrix,view_model.kc)[:,0,:]
+                cam_matrix = np.eye(3)
+                kc = np.zeros(4)
+            else:
+                cam_matrix = view_model.cam_matrix
+                kc = view_model.kc
+
+            success,rvec,tvec = cv2.solvePnP(obj_points,im_points,cam_matrix,kc,np.array(view_model.rvec,dtype=np.float64).reshape(3,1),np.array(view_model.tvec,dtype=np.float64).reshape(3,1),useExtrinsicGuess=True,flags=cv2.SOLVEPNP_ITERATIVE)
+
+            if not success:
+                raise DetectionFailedError('Could not fit the camera position for sub-view {:d}.'.format(subview))
+
+            rvecs[0,subview,:] = np.ravel(rvec)
+            tvecs[0,subview,:] = np.ravel(tvec)
+
+        self.rvecs = np.concatenate((self.rvecs,rvecs),axis=0)
+        self.tvecs = np.concatenate((self.tvecs,tvecs),axis=0)
+
+        if src is None:
+            src = 'Added by {:s} on {:s} at {:s}'.format(misc.username,misc.hostname,misc.get_formatted_time())
+        self.history.append(src)
+
+        return self.n_frames - 1
+
+
+    def get_calibration(self,frame):
+        '''
+        Get a stand-alone calibration object for a single frame of the series.
+
+        Parameters:
+
+            frame (int) : Frame index
+
+        Returns:
+
+            calcam.Calibration : Calibration for the given frame.
+        '''
+        calib = copy.deepcopy(self.calibration)
+
+        for subview,view_model in enumerate(calib.view_models):
+            if view_model is not None:
+                view_model.rvec = self.rvecs[frame,subview,:].reshape(3,1).copy()
+                view_model.tvec = self.tvecs[frame,subview,:].reshape(3,1).copy()
+
+        return calib
+
+
+    def _get_frames(self,frames):
+
+        if frames is None:
+            return np.arange(self.n_frames)
+        else:
+            return np.atleast_1d(np.array(frames,dtype=int))
+
+
+    def _get_display_coords(self,x,y,coords):
+
+        if x is None and y is None:
+            shape = self.calibration.geometry.get_image_shape(coords)
+            x,y = np.meshgrid(np.arange(shape[0]),np.arange(shape[1]))
+        elif x is None or y is None:
+            raise ValueError("X pixels and Y pixels must both be specified!")
+        else:
+            x = np.array(x,dtype=np.float64)
+            y = np.array(y,dtype=np.float64)
+            if x.shape != y.shape:
+                raise ValueError("X pixels array and Y pixels array must be the same size!")
+
+        if coords.lower() == 'original':
+            x,y = self.calibration.geometry.original_to_display_coords(x,y)
+
+        return np.array(x,dtype=np.float64),np.array(y,dtype=np.float64)
+
+
+    def get_pupilpos(self,frames=None,subview=None):
+        '''
+        Get the camera pupil position in 3D space for each frame.
+
+        Parameters:
+
+            frames (int or sequence) : Frame index or indices to get the pupil position for. If not given, all frames are used.
+            subview (int)            : Which sub-view to get the pupil position for. Only required for calibrations \
+                                       with more than 1 sub-view.
+
+        Returns:
+
+            np.ndarray : (n_frames x 3) array of pupil [X,Y,Z] positions in metres.
+        '''
+        if subview is None:
+            if self.calibration.n_subviews == 1:
+                subview = 0
+            else:
+                raise ValueError('This calibration contains multiple sub-views; the subview number must be specified!')
+
+        frames = self._get_frames(frames)
+
+        rotations = misc.rodrigues_to_matrix(self.rvecs[frames,subview,:])
+
+        return -np.einsum('fji,fj->fi',rotations,self.tvecs[frames,subview,:])
+
+
+    def get_los_direction(self,x=None,y=None,frames=None,coords='Display',subview=None):
+        '''
+        Get unit vectors representing the directions of the camera's sight-lines in 3D space,
+        for many frames at once.
+
+        Parameters:
+
+            x,y (np.ndarray)         : Image pixel coordinates at which to get the sight-line directions. \
+                                       If not specified, the direction at the centre of every detector pixel is returned.
+            frames (int or sequence) : Frame index or indices to get the directions for. If not given, all frames are used.
+            coords (str)             : Either ``Display`` or ``Original``, specifies which image orientation the provided x and y \
+                                       inputs and/or shape of the returned array correspond to.
+            subview (int)            : If specified, forces the use of the camera model from the specified sub-view index. \
+                                       If not given, the correct sub-view(s) will be chosen automatically.
+
+        Returns:
+
+            np.ndarray : Array of sight-line vectors with shape (n_frames,) + x.shape + (3,), or (n_frames x h x w x 3) \
+                         if x and y are not given.
+        '''
+        frames = self._get_frames(frames)
+        x,y = self._get_display_coords(x,y,coords)
+
+        if subview is None:
+            subview_index = self.calibration.subview_lookup(x.copy(),y.copy())
+        else:
+            subview_index = np.zeros(x.shape,dtype=int) + subview
+
+        output = np.zeros((frames.size,) + x.shape + (3,)) + np.nan
+
+        for nview in np.unique(subview_index):
+
+            if nview < 0 or self.calibration.view_models[nview] is None:
+                continue
+
+            inds = subview_index == nview
+
+            # Sight-line unit vectors in the camera frame only depend on the intrinsics,
+            # so are calculated once for all frames.
+            x_norm,y_norm = self.calibration.view_models[nview].normalise(x[inds],y[inds])
+            cam_vectors = np.stack((x_norm,y_norm,np.ones(x_norm.shape)),axis=-1)
+            cam_vectors = cam_vectors / np.sqrt(np.sum(cam_vectors**2,axis=-1))[:,np.newaxis]
+
+            # Rotate them in to the lab frame for every frame
+            rotations = misc.rodrigues_to_matrix(self.rvecs[frames,nview,:])
+            output[:,inds,:] = np.einsum('fji,nj->fni',rotations,cam_vectors)
+
+        return output
+
+
+    def project_points(self,points_3d,frames=None,coords='Display',fill_value=np.nan):
+        '''
+        Get the image coordinates corresponding to given real-world 3D coordinates,
+        for many frames at once. Unlike :func:`calcam.Calibration.project_points`, this
+        does not support checking for occlusion by a CAD model.
+
+        Parameters:
+
+            points_3d (np.ndarray)   : Nx3 array of 3D point coordinates in metres.
+            frames (int or sequence) : Frame index or indices to project the points for. If not given, all frames are used.
+            coords (str)             : Either ``Display`` or ``Original``, specifies which image orientation the returned \
+                                       image coordinates should correspond to.
+            fill_value (float)       : For 3D points not visible to the camera (outside their sub-view or behind the camera), \
+                                       the returned image coordinates will be set to this value. If ``None``, image coordinates \
+                                       are returned for every point.
+
+        Returns:
+
+            list of np.ndarray : A list with one element per sub-view, each an array of shape (n_frames x N x 2) \
+                                 containing the [X,Y] image coordinates of the N input points in each frame.
+        '''
+        frames = self._get_frames(frames)
+        points_3d = np.array(points_3d,dtype=np.float64).reshape(-1,3)
+
+        points_2d = []
+
+        for nview,view_model in enumerate(self.calibration.view_models):
+
+            p2d = np.zeros((frames.size,points_3d.shape[0],2)) + (np.nan if fill_value is None else fill_value)
+
+            if view_model is not None:
+
+                # Transform to camera coordinates for all frames at once
+                rotations = misc.rodrigues_to_matrix(self.rvecs[frames,nview,:])
+                cam_points = np.einsum('fij,nj->fni',rotations,points_3d) + self.tvecs[frames,nview,np.newaxis,:]
+
+                with np.errstate(divide='ignore',invalid='ignore'):
+                    x_norm = cam_points[:,:,0] / cam_points[:,:,2]
+                    y_norm = cam_points[:,:,1] / cam_points[:,:,2]
+
+                x_dist,y_dist = view_model.distort_normalised(x_norm,y_norm)
+
+                p2d[:,:,0] = view_model.cam_matrix[0,0] * x_dist + view_model.cam_matrix[0,1] * y_dist + view_model.cam_matrix[0,2]
+                p2d[:,:,1] = view_model.cam_matrix[1,1] * y_dist + view_model.cam_matrix[1,2]
+
+                if fill_value is not None:
+                    invisible = (self.calibration.subview_lookup(p2d[:,:,0].copy(),p2d[:,:,1].copy()) != nview) | (cam_points[:,:,2] <= 0)
+                    p2d[invisible,:] = fill_value
+
+            if coords.lower() == 'original':
+                p2d[:,:,0],p2d[:,:,1] = self.calibration.geometry.display_to_original_coords(p2d[:,:,0],p2d[:,:,1])
+
+            points_2d.append(p2d)
+
+        return points_2d
+
+
+    def save(self,filename):
+        '''
+        Save the calibration series to a single file.
+
+        Parameters:
+
+            filename (string) : Filename to save to. The file extension is .ccs; \
+                                if this is not included in the given filename it is added.
+        '''
+        if not filename.endswith('.ccs'):
+            filename = filename + '.ccs'
+
+        with ZipSaveFile(filename,'w') as save_file:
+
+            self.calibration.save(os.path.join(save_file.get_temp_path(),'calibration.ccc'))
+
+            np.savez(os.path.join(save_file.get_temp_path(),'extrinsics.npz'),rvecs=self.rvecs,tvecs=self.tvecs)
+
+            with save_file.open_file('history.json','w') as f:
+                json.dump(self.history,f,indent=4)
+
+
+    @classmethod
+    def load(cls,filename):
+        '''
+        Load a calibration series from a .ccs file on disk.
+
+        Parameters:
+
+            filename (string) : File name to load from.
+        '''
+        with ZipSaveFile(filename,'r') as save_file:
+
+            calibration = Calibration(os.path.join(save_file.get_temp_path(),'calibration.ccc'))
+            calibration.filename = None
+
+            with np.load(os.path.join(save_file.get_temp_path(),'extrinsics.npz')) as extrinsics:
+                rvecs = extrinsics['rvecs']
+                tvecs = extrinsics['tvecs']
+
+            with save_file.open_file('history.json','r') as f:
+                history = json.load(f)
+
+        return cls(calibration,rvecs,tvecs,history)
+
+
 class DetectionFailedError(Exception):
     """
     Exception raised if the automatic image movement detection fails to determine the image movement with sufficient confidence or quality.
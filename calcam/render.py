@@ -21,7 +21,7 @@
 
 import vtk
 import cv2
-from vtk.util.numpy_support import vtk_to_numpy
+from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
 import numpy as np
 import time
 from .raycast import raycast_sightlines, RayData
@@ -712,26 +712,10 @@ def get_wall_coverage_actor(cal,cadmodel=None,image=None,imagecoords='Original',
     # Shift the end coords in the direction of the surface normal by clearance amount
     ray_end = ray_end + normals * clearance
 
-    # VTK objects with coordinates of each pixel corner.
-    # Which index in the VTK array corresponds to which pixel is tracked in pointinds
+    # VTK points with coordinates of each pixel corner, numbered along the image rows.
     verts = vtk.vtkPoints()
-    pointinds = np.zeros((ray_end.shape[0],ray_end.shape[1]),dtype=int)
-    ci = 0
-    for i in range(ray_end.shape[0]):
-        for j in range(ray_end.shape[1]):
-            verts.InsertNextPoint(*ray_end[i,j,:])
-            pointinds[i,j] = ci
-            ci += 1
-
-
-    # Create VTK polygon array
-    polys  = vtk.vtkCellArray()
-
-    # If we're mapping an image, create the array of colours for each polygon
-    if image is not None:
-        colours = vtk.vtkUnsignedCharArray()
-        colours.SetNumberOfComponents(3)
-        im_inds = []
+    verts.SetData(numpy_to_vtk(ray_end.reshape(-1,3),deep=True,array_type=vtk.VTK_FLOAT))
+    pointinds = np.arange(ray_end.shape[0]*ray_end.shape[1]).reshape(ray_end.shape[:2])
 
     # If we have an image, map of where the NaNs are
     if image is not None:
@@ -743,79 +727,62 @@ def get_wall_coverage_actor(cal,cadmodel=None,image=None,imagecoords='Original',
     if verbose:
         lp = LoopProgPrinter()
         lp.update('Constructing 3D mesh...')
-        i = -1
-        tot_px = (ray_end.shape[1]-1) * (ray_end.shape[0] - 1)
 
     subview_lookup = cal.subview_lookup(rd.x,rd.y)
 
-    # Go through the image
-    for xi in range(ray_end.shape[1]-1):
-        for yi in range(ray_end.shape[0] - 1):
-
-            if verbose:
-                i += 1
-                lp.update(i/tot_px)
-
-            # Don't map any pixels which are NaN
-            if image is not None:
-                if isnan[yi,xi]:
-                    continue
-
-            if subview is not None:
-                if np.any(subview_lookup[yi:yi+2,xi:xi+2] != subview):
-                    continue
-            elif np.unique(subview_lookup[yi:yi+2,xi:xi+2]).size > 1:
-                # Also don't do any cells which are split across subviews.
-                continue
-
-            # Coordinates and indices of corners for this pixel.
-            # Any coordinates == NaN indicates sight lines which did not hit the model so we skip those polys.
-            polycoords = ray_end[yi:yi+2,xi:xi+2,:]
-            if np.any(np.isnan(polycoords)):
-                continue
-
-            losdirs = ray_dir[yi:yi+2,xi:xi+2,:]
-            pixel_dir = np.array( [losdirs[:,:,0].mean(),losdirs[:,:,1].mean(),losdirs[:,:,2].mean()])
-            pixel_dir = pixel_dir / np.sqrt(np.sum(pixel_dir**2))
-
-            inds = pointinds[yi:yi+2,xi:xi+2]
-
-
-            # Check if a pixel is "torn" in real space by checking if any of its sides
-            # are very close to parallel with the camera sight lines. If so, skip it.
-            sides = np.zeros((6,3))
-            sides[0,:] = polycoords[0,1,:] - polycoords[0,0,:]
-            sides[1,:] = polycoords[1,1,:] - polycoords[0,1,:]
-            sides[2,:] = polycoords[1,0,:] - polycoords[1,1,:]
-            sides[3,:] = polycoords[0,0,:] - polycoords[1,0,:]
-            sides[4,:] = polycoords[0, 0,:] - polycoords[1, 1,:]
-            sides[5,:] = polycoords[0, 1,:] - polycoords[1, 0,:]
-
-            side_lengths = np.sqrt(np.sum(sides**2,axis=1))
-            sides = sides / np.tile(side_lengths[:,np.newaxis],(1,3))
-
-            dot_prods = [ np.dot(pixel_dir,sides[i,:]) for i in range(4) ]
-
-            if max(dot_prods) > 0.999 or side_lengths.max() > 8*side_lengths.min():
-                continue
-
-            # Create a quad representing the pixel
-            poly = vtk.vtkPolygon()
-            poly.GetPointIds().SetNumberOfIds(4)
-            poly.GetPointIds().SetId(0,inds[0,0])
-            poly.GetPointIds().SetId(1, inds[1, 0])
-            poly.GetPointIds().SetId(2, inds[1, 1])
-            poly.GetPointIds().SetId(3, inds[0, 1])
-            polys.InsertNextCell(poly)
-
-            # If we're mapping an image, colour the quad according to the image data
-            if image is not None:
-                im_inds.append((yi,xi))
-                if len(image.shape) < 3:
-                    rgb = (np.array(cmap(fr[yi,xi]))[:-1] * 255).astype(np.uint8)
-                    colours.InsertNextTypedTuple(rgb)
-                else:
-                    colours.InsertNextTypedTuple(fr[yi,xi,:])
+    # Work out which pixels to include in the mesh, for all pixels at once.
+    # Arrays of values at the 4 corners of each pixel are indexed [y corner, x corner, y pixel, x pixel].
+    corner_subviews = np.array([[subview_lookup[:-1,:-1],subview_lookup[:-1,1:]],[subview_lookup[1:,:-1],subview_lookup[1:,1:]]])
+    corner_coords = np.array([[ray_end[:-1,:-1,:],ray_end[:-1,1:,:]],[ray_end[1:,:-1,:],ray_end[1:,1:,:]]])
+    corner_dirs = np.array([[ray_dir[:-1,:-1,:],ray_dir[:-1,1:,:]],[ray_dir[1:,:-1,:],ray_dir[1:,1:,:]]])
+
+    # Don't map any pixels which are NaN in the image
+    if image is not None:
+        include = ~isnan[:ray_end.shape[0]-1,:ray_end.shape[1]-1]
+    else:
+        include = np.ones((ray_end.shape[0]-1,ray_end.shape[1]-1),dtype=bool)
+
+    if subview is not None:
+        include = include & np.all(corner_subviews == subview,axis=(0,1))
+    else:
+        # Also don't do any cells which are split across subviews.
+        include = include & np.all(corner_subviews == corner_subviews[0,0],axis=(0,1))
+
+    # Any coordinates == NaN indicates sight lines which did not hit the model so we skip those polys.
+    include = include & ~np.any(np.isnan(corner_coords),axis=(0,1,4))
+
+    pixel_dir = corner_dirs.mean(axis=(0,1))
+    pixel_dir = pixel_dir / np.sqrt(np.sum(pixel_dir**2,axis=-1))[:,:,np.newaxis]
+
+    # Check if a pixel is "torn" in real space by checking if any of its sides
+    # are very close to parallel with the camera sight lines. If so, skip it.
+    sides = np.array([corner_coords[0,1] - corner_coords[0,0],
+                      corner_coords[1,1] - corner_coords[0,1],
+                      corner_coords[1,0] - corner_coords[1,1],
+                      corner_coords[0,0] - corner_coords[1,0],
+                      corner_coords[0,0] - corner_coords[1,1],
+                      corner_coords[0,1] - corner_coords[1,0]])
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        side_lengths = np.sqrt(np.sum(sides**2,axis=-1))
+        dot_prods = np.sum(pixel_dir[np.newaxis,:,:,:] * sides[:4],axis=-1) / side_lengths[:4]
+        torn = (dot_prods.max(axis=0) > 0.999) | (side_lengths.max(axis=0) > 8*side_lengths.min(axis=0))
+
+    include = include & ~torn
+
+    # Pixels to include, in order along the image columns.
+    xi,yi = np.nonzero(include.T)
+
+    # Create a quad representing each pixel, in VTK's legacy cell array format
+    # of the number of points followed by the point indices for each cell.
+    quads = np.stack( (np.full(xi.size,4),pointinds[yi,xi],pointinds[yi+1,xi],pointinds[yi+1,xi+1],pointinds[yi,xi+1]), axis=-1)
+    polys = vtk.vtkCellArray()
+    polys.SetCells(xi.size,numpy_to_vtk(quads.reshape(-1),deep=True,array_type=vtk.VTK_ID_TYPE))
+
+    # If we're mapping an image, colour the quads according to the image data
+    if image is not None:
+        im_inds = np.stack((yi,xi),axis=-1)
+        colours = _get_image_colours(fr,cmap,yi,xi)
 
     if verbose:
         lp.update(1.)
@@ -884,17 +851,27 @@ class MappedImageActor(vtk.vtkActor):
             # > single channel, assume 8-bit RGB: ensure correct datatype and throw away any extra channels
             fr = fr[:,:,:3].astype(np.uint8)
 
-        colours = vtk.vtkUnsignedCharArray()
-        colours.SetNumberOfComponents(3)
+        self.celldata.SetScalars(_get_image_colours(fr,cmap,self.image_inds[:,0],self.image_inds[:,1]))
 
-        for yi,xi in self.image_inds:
-            if len(fr.shape) < 3:
-                rgb = (np.array(cmap(fr[yi, xi]))[:-1] * 255).astype(np.uint8)
-                colours.InsertNextTypedTuple(rgb)
-            else:
-                colours.InsertNextTypedTuple(fr[yi, xi, :])
 
-        self.celldata.SetScalars(colours)
+def _get_image_colours(fr,cmap,yi,xi):
+    """
+    Get a VTK array of the RGB colours of a set of image pixels, for colouring mapped image actors.
+
+    Parameters:
+        fr (np.ndarray)    : Either a single channel image normalised to the colour limits, or an 8-bit RGB image.
+        cmap               : For single channel images, the matplotlib colour map to use.
+        yi,xi (np.ndarray) : Row and column indices of the pixels.
+
+    Returns:
+        vtkUnsignedCharArray containing the colour of each pixel.
+    """
+    if len(fr.shape) < 3:
+        rgb = (np.array(cmap(fr[yi,xi]))[:,:-1] * 255).astype(np.uint8)
+    else:
+        rgb = fr[yi,xi,:]
+
+    return numpy_to_vtk(rgb.reshape(-1,3),deep=True,array_type=vtk.VTK_UNSIGNED_CHAR)
 
 
 def get_wall_contour_actor(wall_contour,actor_type='contour',phi=None,toroidal_res=128):
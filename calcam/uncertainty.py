@@ -0,0 +1,218 @@
+'''
+* Copyright 2015-2024 European Atomic Energy Community (EURATOM)
+*
+* Licensed under the EUPL, Version 1.1 or - as soon they
+will be approved by the European Commission - subsequent
+versions of the EUPL (the "Licence");
+* You may not use this work except in compliance with the
+Licence.
+* You may obtain a copy of the Licence at:
+*
+* https://joinup.ec.europa.eu/software/page/eupl
+*
+* Unless required by applicable law or agreed to in
+writing, software distributed under the Licence is
+distributed on an "AS IS" basis,
+* WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+express or implied.
+* See the Licence for the specific language governing
+permissions and limitations under the Licence.
+'''
+
+
+"""
+Module for estimating the uncertainty of calibration results, by Monte Carlo
+propagation of the point pair fitting residuals through to the sight-line geometry.
+"""
+import copy
+
+import numpy as np
+
+from .calibration import Fitter, fit_batch
+from .pointpairs import PointPairs
+from .raycast import raycast_sightlines
+from . import misc
+
+
+class CalibrationUncertainty:
+    '''
+    Class to estimate the uncertainty in the sight-line geometry of a point
+    pair fitting calibration by Monte Carlo sampling.
+
+    A set of perturbed calibrations is created by bootstrap resampling of the point
+    pair fit residuals: for each sample, the fitted image positions of the point pairs
+    have randomly chosen residuals (from the original fit) added to them, and the
+    calibration is re-fitted with the same fit options. The spread of the results
+    calculated with the sample calibrations then gives an estimate of the uncertainty.
+    The re-fits are done in parallel.
+
+    Parameters:
+
+        calibration (calcam.Calibration) : Point pair fitting calibration to analyse.
+        n_samples (int)                  : Number of Monte Carlo samples to draw.
+        seed (int)                       : Optional seed for the random number generator, \
+                                           for reproducible results.
+        n_processes (int)                : Number of processes to use for re-fitting. \
+                                           Default is calcam.config.n_cpus.
+    '''
+    def __init__(self,calibration,n_samples=100,seed=None,n_processes=None):
+
+        if calibration._type != 'fit':
+            raise ValueError('Uncertainty estimation is only supported for point pair fitting calibrations!')
+
+        self.calibration = calibration
+        self.n_samples = n_samples
+
+        rng = np.random.RandomState(seed)
+
+        # Build the perturbed fitters for every sub-view, then do all the fits in one go.
+        fitters = []
+        subviews = []
+        for subview,view_model in enumerate(calibration.view_models):
+            if view_model is None:
+                continue
+            fitters = fitters + self._get_sample_fitters(subview,rng)
+            subviews = subviews + [subview] * n_samples
+
+        fitted_models = fit_batch(fitters,n_processes=n_processes,use_cache=False)
+
+        # Sample calibrations share everything except the view models with the original calibration.
+        self.samples = []
+        for sample in range(n_samples):
+            sample_calib = copy.copy(calibration)
+            sample_calib.view_models = list(calibration.view_models)
+            self.samples.append(sample_calib)
+
+        for sample_index,(subview,models) in enumerate(zip(subviews,fitted_models)):
+            if len(models) == 0:
+                raise Exception('Re-fitting calibration sample {:d} for sub-view {:d} failed.'.format(sample_index % n_samples,subview))
+            self.samples[sample_index % n_samples].view_models[subview] = models[0]
+
+
+    def _get_sample_fitters(self,subview,rng):
+        '''
+        Get Fitter objects for each Monte Carlo sample for a given sub-view.
+        '''
+        view_model = self.calibration.view_models[subview]
+        obj_points,im_points = self.calibration.pointpairs.get_pointpairs(subview)
+        obj_points = np.array(obj_points)
+        im_points = np.array(im_points)
+
+        # Residuals of the original fit, which are resampled for each sample.
+        fitted_points = np.reshape(view_model.project_points(obj_points),(-1,2))
+        residuals = im_points - fitted_points
+
+        fitters = []
+        for sample in range(self.n_samples):
+
+            sample_points = fitted_points + residuals[rng.randint(0,residuals.shape[0],residuals.shape[0]),:]
+
+            pointpairs = PointPairs()
+            for point in range(obj_points.shape[0]):
+                image_points = [None] * self.calibration.n_subviews
+                image_points[subview] = sample_points[point,:]
+                pointpairs.add_pointpair(obj_points[point,:],image_points)
+
+            fitter = Fitter(model=view_model.model)
+            fitter.set_image_shape(self.calibration.geometry.get_display_shape())
+            fitter.set_fitflags_strings(view_model.fit_options)
+            fitter.set_pointpairs(pointpairs,subview)
+            for _,ipp in self.calibration.intrinsics_constraints:
+                fitter.add_intrinsics_pointpairs(ipp,subview)
+
+            fitters.append(fitter)
+
+        return fitters
+
+
+    def get_pupilpos_std(self,subview=None):
+        '''
+        Get the standard deviation of the camera pupil position.
+
+        Parameters:
+
+            subview (int) : Which sub-view to get the result for. Only required for \
+                            calibrations with more than 1 sub-view.
+
+        Returns:
+
+            np.ndarray : 3 element array of the standard deviation of the X, Y and Z pupil coordinates in metres.
+        '''
+        return np.std([sample.get_pupilpos(subview=subview) for sample in self.samples],axis=0)
+
+
+    def get_los_direction_std(self,x=None,y=None,coords='Display'):
+        '''
+        Get the standard deviation of the sight-line direction unit vectors.
+
+        Parameters:
+
+            x,y (np.ndarray) : Image pixel coordinates at which to get the results. If not \
+                               specified, the result at the centre of every detector pixel is returned.
+            coords (str)     : Either ``Display`` or ``Original``, specifies which image orientation the provided x and y \
+                               inputs and/or shape of the returned array correspond to.
+
+        Returns:
+
+            np.ndarray : Array of the standard deviation of the [X,Y,Z] sight-line vector components, the same \
+                         shape as returned by :func:`calcam.Calibration.get_los_direction`. For small variations, \
+                         the vector norm along the last axis is the standard deviation of the sight-line angle in radians.
+        '''
+        return self._get_std(lambda sample: sample.get_los_direction(x,y,coords=coords))
+
+
+    def get_sightline_intersection_std(self,cadmodel,x=None,y=None,binning=1,coords='Display',status_callback=misc.LoopProgPrinter().update):
+        '''
+        Get the standard deviation of the positions where the camera sight-lines intersect a CAD model.
+        This requires ray casting for every sample, so can take a long time.
+
+        Parameters:
+
+            cadmodel (calcam.CADModel) : CAD model to intersect the sight-lines with.
+            x,y (np.ndarray)           : Image pixel coordinates at which to get the results. If not \
+                                         specified, the result is calculated for every detector pixel at the specified binning.
+            binning (int)              : If not giving x and y, pixel binning to use.
+            coords (str)               : Either ``Display`` or ``Original``, specifies which image orientation the provided x and y \
+                                         inputs and/or shape of the returned array correspond to.
+            status_callback (callable) : Callable which takes a single argument to be called with status updates. The argument will \
+                                         either be a string for textual status updates or a float from 0 to 1 specifying the progress \
+                                         of the calculation. If set to None, no status updates are issued.
+
+        Returns:
+
+            np.ndarray : Array of the standard deviation of the [X,Y,Z] intersection coordinates in metres, with shape \
+                         (h x w x 3) if not specifying x and y, otherwise the input x and y shape + (3,).
+        '''
+        if status_callback is not None:
+            status_callback('Ray casting {:d} calibration samples...'.format(self.n_samples))
+            status_callback(0.)
+
+        def raycast_sample(sample):
+            ray_ends = raycast_sightlines(sample,cadmodel,x,y,binning=binning,coords=coords,verbose=False).get_ray_end(coords=coords)
+            if status_callback is not None:
+                status_callback(float(self.samples.index(sample) + 1) / self.n_samples)
+            return ray_ends
+
+        return self._get_std(raycast_sample)
+
+
+    def _get_std(self,function):
+        '''
+        Calculate the standard deviation over the samples of the results of a given
+        function of a calibration. Uses running sums so that results for all
+        the samples do not need to be stored at once.
+        '''
+        total = None
+        total_squares = None
+
+        for sample in self.samples:
+            result = np.array(function(sample),dtype=np.float64)
+            if total is None:
+                total = np.zeros(result.shape)
+                total_squares = np.zeros(result.shape)
+            total += result
+            total_squares += result**2
+
+        mean = total / self.n_samples
+
+        return np.sqrt(np.maximum(total_squares / self.n_samples - mean**2,0))